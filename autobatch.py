@@ -0,0 +1,138 @@
+import torch
+from model import autocast
+from benchmark.synthetic import random_batch
+
+'''/
+memory-bounded micro-batches with gradient accumulation (train.py --memory-budget). Before
+training, the largest micro-batch that fits the budget is probed on the worst case of the
+training split: dialogues as long as its longest one (attention memory grows with the square
+of the dialogue length). A training step holds the weights, their gradients and Adam's two
+moments, plus the activations saved for backward. On the GPU the peak memory of a probe step
+is measured; on the CPU the saved activations are counted with saved_tensors_hooks, as in
+profiler.py.
+
+Batches of --batch-size dialogues are then split into micro-batches of at most that many
+dialogues (--micro-batch dialogues) or padded utterances (--micro-batch tokens), and their
+gradients are accumulated before the optimizer step. Every micro-batch loss is divided by
+the normaliser of the whole batch (MaskedNLLLoss.normaliser, MaskedKLDivLoss.normaliser),
+so the accumulated gradient is the gradient of the full batch.
+
+    micro_batcher, n, memory = tune(model, config, loss, max_len=110, budget=4 * 2**30, limit=16, unit='dialogues', device=device)
+    for data in micro_batcher.split(batch):
+        ...
+/'''
+
+def state_bytes(model):
+    """ weights, plus gradients and Adam's exp_avg and exp_avg_sq of the trainable ones """
+    return sum(p.numel() * p.element_size() * (4 if p.requires_grad else 1) for p in model.parameters())
+
+
+def step_bytes(model, config, loss, batch_size, seq_len, device, precision='fp32'):
+    """ activation memory of a training step of batch_size dialogues of seq_len utterances, None if it runs out of memory.
+    loss(outputs, labels, umask) is the training loss """
+    # the worst case: none of the dialogues is padded
+    textf, visuf, acouf, umask, qmask, label, lengths = random_batch(config, batch_size, seq_len, device)
+    parameters = {p.data_ptr() for p in model.parameters()}
+    seen, saved = set(), [0]
+
+    def pack(tensor):
+        if tensor.data_ptr() not in parameters and tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            with autocast(device, precision):
+                outputs = model(textf, visuf, acouf, umask, qmask, lengths)
+            loss(outputs, label.view(-1), umask).backward()
+        if cuda:
+            torch.cuda.synchronize(device)
+            return torch.cuda.max_memory_allocated(device) - start
+        return saved[0]
+    except torch.cuda.OutOfMemoryError:
+        return None
+    finally:
+        model.zero_grad(set_to_none=True)
+        if cuda:
+            torch.cuda.empty_cache()
+
+
+def largest(fits, limit):
+    """ the largest n in [1, limit] for which the monotone fits(n) holds, 0 if none """
+    if not fits(1):
+        return 0
+    low, high = 1, 2
+    while high <= limit and fits(high):
+        low, high = high, high * 2
+    high = min(high, limit + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+class MicroBatcher(object):
+    '''/
+    splits a collated batch (the layout of DialogueCollator and PackedDialogues.batch) into
+    micro-batches of at most max_dialogues dialogues or max_tokens padded utterances. The
+    dialogues are grouped longest first, so micro-batches are padded as little as possible;
+    a batch that fits is returned as is
+    /'''
+    def __init__(self, max_dialogues=None, max_tokens=None):
+        assert (max_dialogues is None) != (max_tokens is None), 'either max_dialogues or max_tokens'
+        self.max_dialogues = max_dialogues
+        self.max_tokens = max_tokens
+
+    def groups(self, lengths):
+        order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+        groups = [[]]
+        for i in order:
+            # the first (longest) dialogue of a group sets its padded length
+            size = len(groups[-1]) + 1
+            if groups[-1] and (size > self.max_dialogues if self.max_tokens is None else size * lengths[groups[-1][0]] > self.max_tokens):
+                groups.append([])
+            groups[-1].append(i)
+        return groups
+
+    def split(self, batch):
+        lengths = batch[6].tolist()
+        groups = self.groups(lengths)
+        if len(groups) == 1:
+            return [batch]
+        micro_batches = []
+        for group in groups:
+            seq_len = lengths[group[0]]
+            index = torch.tensor(group, device=batch[6].device)
+            micro_batches.append([x[:seq_len].index_select(1, index) for x in batch[:4]] +
+                                 [x[:, :seq_len].index_select(0, index) for x in batch[4:6]] +
+                                 [batch[6].index_select(0, index), [batch[7][i] for i in group]])
+        return micro_batches
+
+
+def tune(model, config, loss, max_len, budget, limit, unit='dialogues', device='cpu', precision='fp32'):
+    """ the largest number of dialogues of max_len utterances (at most limit) whose training step fits in budget bytes:
+    the MicroBatcher that splits batches accordingly, that number and the memory of its step """
+    device = torch.device(device)
+    fixed = state_bytes(model)
+    measured = {}
+
+    def fits(n):
+        measured[n] = step_bytes(model, config, loss, n, max_len, device, precision)
+        return measured[n] is not None and fixed + measured[n] <= budget
+
+    # the probe steps must not change the random streams of the training run
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        n = largest(fits, limit)
+    assert n > 0, 'a step on one dialogue of {} utterances needs {:.0f} MB, more than the budget of {:.0f} MB'.format(
+        max_len, (fixed + (measured[1] or float('inf'))) / 2**20, budget / 2**20)
+    micro_batcher = MicroBatcher(max_dialogues=n) if unit == 'dialogues' else MicroBatcher(max_tokens=n * max_len)
+    return micro_batcher, n, fixed + measured[n]
@@ -0,0 +1,45 @@
+import argparse, time
+import torch
+from model import MultiHeadedAttention
+
+'''/
+micro-benchmark of the attention backends in MultiHeadedAttention: forward+backward of
+one attention module, with and without the causal mask (their parity is checked by
+tests/test_attention.py).
+
+    python bench_attention.py --batch-size 16 --seq-len 110 --hidden_dim 1024
+/'''
+
+def benchmark(args):
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, args.seq_len, args.hidden_dim)
+    mask = torch.zeros(args.batch_size, 1, args.seq_len, dtype=torch.bool)
+    mask[1:, :, args.seq_len//2:] = True
+    reference = MultiHeadedAttention(args.n_head, args.hidden_dim, attention='reference')
+    fused = MultiHeadedAttention(args.n_head, args.hidden_dim, attention='fused')
+    fused.load_state_dict(reference.state_dict())
+    for causal in [False, True]:
+        for name, attn in [('reference', reference), ('fused', fused)]:
+            inputs = x.clone().requires_grad_()
+            for i in range(args.warmup + args.iters):
+                if i == args.warmup:
+                    start = time.perf_counter()
+                attn(inputs, inputs, inputs, mask=mask, causal=causal).sum().backward()
+            elapsed = (time.perf_counter() - start) / args.iters
+            print('{:>9} causal={}: {:.2f} ms / fwd+bwd'.format(name, causal, elapsed*1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--seq-len', type=int, default=110, help='dialogue length')
+    parser.add_argument('--hidden_dim', type=int, default=1024, help='hidden size')
+    parser.add_argument('--n_head', type=int, default=8, help='number of heads')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed iterations')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    benchmark(args)
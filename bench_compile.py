@@ -0,0 +1,108 @@
+import argparse, time
+import torch
+import torch.optim as optim
+from benchmark import synthetic
+from model import MaskedNLLLoss, MaskedKLDivLoss, Transformer_Based_Model, Transformer_Based_Model_diverse, compile_model
+
+'''/
+speed of the training step (forward, loss, backward, Adam) and of inference in eager mode
+and compiled with torch.compile, on random batches with the IEMOCAP and MELD feature sizes.
+Dialogue lengths change from step to step as in training; the compiled mode is the graph of
+train.py --compile (model.compile_model, dynamic shapes). The first compiled step is reported
+as compile time, with the number of steps after which compiling has paid it back.
+
+    python bench_compile.py --Dataset IEMOCAP --hidden_dim 1024 --modality atv --setting original
+/'''
+# dimensions, speakers, classes, batch size and longest dialogue used for each dataset
+SHAPES = {'IEMOCAP': dict(D_audio=1582, n_speakers=2, n_classes=6, batch_size=16, max_len=110),
+          'MELD': dict(D_audio=300, n_speakers=9, n_classes=7, batch_size=8, max_len=33)}
+D_text, D_visual = synthetic.D_text, synthetic.D_visual
+MODES = ['eager', 'compiled']
+
+
+def random_batch(shape, seq_len):
+    # the longest dialogue has seq_len utterances, the others are padded
+    textf, visuf, acouf, _, qmask, label, _ = synthetic.random_batch(dict(shape, D_text=D_text, D_visual=D_visual), shape['batch_size'], seq_len)
+    lengths = torch.randint(1, seq_len+1, (shape['batch_size'],))
+    lengths[0] = seq_len
+    umask = (torch.arange(seq_len).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    return textf, visuf, acouf, umask, qmask, label, lengths
+
+
+def train_step(model, optimizer, batch, n_modalities):
+    textf, visuf, acouf, umask, qmask, label, lengths = batch
+    loss_function, kl_loss = MaskedNLLLoss(), MaskedKLDivLoss()
+    optimizer.zero_grad()
+    outputs = model(textf, visuf, acouf, umask, qmask, lengths)
+    # same loss as train_or_eval_model: per-modality and fused NLL, per-modality KL to the fused distribution
+    flat = [out.view(-1, out.size(2)) for out in outputs]
+    log_probs, all_log_prob = flat[:n_modalities], flat[n_modalities]
+    kl_log_probs, kl_all_prob = flat[n_modalities+2:-1], flat[-1]
+    labels_ = label.view(-1)
+    loss = loss_function(all_log_prob, labels_, umask) + \
+           sum(loss_function(lp, labels_, umask) for lp in log_probs) + \
+           sum(kl_loss(lp, kl_all_prob, umask) for lp in kl_log_probs)
+    loss.backward()
+    optimizer.step()
+
+
+def inference_step(model, batch):
+    with torch.no_grad():
+        model(*batch[:5], batch[6])
+
+
+def run(args, mode, lengths):
+    shape = SHAPES[args.Dataset]
+    cls = Transformer_Based_Model_diverse if args.setting == 'realtime' else Transformer_Based_Model
+    torch.manual_seed(0)
+    model = cls(args.Dataset, 1, D_text, D_visual, shape['D_audio'], args.n_head, n_classes=shape['n_classes'],
+                hidden_dim=args.hidden_dim, n_speakers=shape['n_speakers'], dropout=0.5, modality=args.modality)
+    optimizer = optim.Adam(model.parameters(), lr=1e-5)
+    forward_model = compile_model(model) if mode == 'compiled' else model
+    n_modalities = len(model.encoders)
+    step = {'train': lambda batch: train_step(forward_model, optimizer, batch, n_modalities),
+            'inference': lambda batch: inference_step(forward_model, batch)}[args.step]
+    forward_model.train(args.step == 'train')
+
+    # the graph is traced with symbolic sizes, so one warm-up step covers every length
+    start = time.perf_counter()
+    step(random_batch(shape, max(lengths)))
+    warmup = time.perf_counter() - start
+
+    batches = [random_batch(shape, seq_len) for seq_len in lengths]
+    start = time.perf_counter()
+    for batch in batches:
+        step(batch)
+    elapsed = time.perf_counter() - start
+    utterances = sum(int(batch[3].sum()) for batch in batches)
+    return warmup, elapsed / len(batches), utterances / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--Dataset', default='IEMOCAP', choices=list(SHAPES), help='feature sizes and batch shapes to use')
+    parser.add_argument('--hidden_dim', type=int, default=1024, help='hidden size')
+    parser.add_argument('--n_head', type=int, default=8, help='number of heads')
+    parser.add_argument('--modality', default='atv', help='modality')
+    parser.add_argument('--setting', default='original', help='original or realtime')
+    parser.add_argument('--step', default='train', choices=['train', 'inference'], help='time training steps or inference forwards')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES, help='eager and compiled modes to compare')
+    parser.add_argument('--iters', type=int, default=20, help='timed steps')
+    parser.add_argument('--min-len', type=int, default=None, help='shortest dialogue of the timed steps (default a quarter of the longest)')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    max_len = SHAPES[args.Dataset]['max_len']
+    lengths = torch.randint(args.min_len or max_len // 4, max_len + 1, (args.iters,), generator=torch.Generator().manual_seed(0)).tolist()
+    results = {mode: run(args, mode, lengths) for mode in args.modes}
+    print('{} {} {} hidden {} {}, {} threads:'.format(args.Dataset, args.modality, args.setting, args.hidden_dim, args.step, torch.get_num_threads()))
+    for mode, (warmup, seconds, throughput) in results.items():
+        line = '{:<8} {:8.1f} ms/step {:7.0f} utt/sec'.format(mode, seconds * 1000, throughput)
+        if mode != 'eager' and 'eager' in results:
+            saved = results['eager'][1] - seconds
+            line += '  speed-up {:.2f}x, compile {:.0f}s, {}'.format(
+                results['eager'][1] / seconds, warmup,
+                'pays off after {:.0f} steps'.format(warmup / saved) if saved > 0 else 'never pays off')
+        print(line)
@@ -0,0 +1,82 @@
+import argparse, asyncio, json, time
+import numpy as np
+import torch
+from server import InferenceServer, load_predictor
+
+'''/
+load test of server.py: starts the server in-process on a free port and lets --clients
+concurrent keep-alive connections post --requests random dialogues each, once without
+batching (--max-batch-size 1) and once with micro-batching, and reports throughput and
+client-side p50/p99 latency for both
+
+    python bench_server.py --artifact sdt_inference.pt --clients 32 --requests 20
+/'''
+
+async def post(reader, writer, body):
+    writer.write('POST /predict HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(len(body)).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    payload = json.loads(await reader.readexactly(int(headers['content-length'])))
+    return status, payload
+
+
+def random_dialogue(config, rng, max_len):
+    n = int(rng.integers(1, max_len+1))
+    return json.dumps({'text': rng.standard_normal((n, config['D_text'])).round(3).tolist(),
+                       'audio': rng.standard_normal((n, config['D_audio'])).round(3).tolist(),
+                       'visual': rng.standard_normal((n, config['D_visual'])).round(3).tolist(),
+                       'speakers': rng.integers(0, config['n_speakers'], n).tolist()}).encode()
+
+
+async def client(port, bodies, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for body in bodies:
+        start = time.perf_counter()
+        status, payload = await post(reader, writer, body)
+        latencies.append(time.perf_counter() - start)
+        statuses.append(status)
+    writer.close()
+
+
+async def run(args, predictor, max_batch_size, bodies):
+    server = InferenceServer(predictor, max_batch_size=max_batch_size, max_latency_ms=args.max_latency_ms, max_queue=args.max_queue)
+    port = (await server.start(port=0)).sockets[0].getsockname()[1]
+    latencies, statuses = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, bodies[i::args.clients], latencies, statuses) for i in range(args.clients)])
+    elapsed = time.perf_counter() - start
+    metrics = server.batcher.metrics()
+    await server.close()
+    latencies = np.array(latencies) * 1000
+    print('max batch size {:>3}: {:.0f} dialogues/sec, client p50 {:.1f} ms, p99 {:.1f} ms, mean batch {}, rejected {}'.format(
+        max_batch_size, len(bodies)/elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99),
+        metrics['mean_batch_size'], statuses.count(503)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artifact', default=None, help='TorchScript artifact written by export.py')
+    parser.add_argument('--checkpoint', default=None, help='or a file written by train.py --save-model')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent connections')
+    parser.add_argument('--requests', type=int, default=20, help='dialogues posted by each client')
+    parser.add_argument('--max-len', type=int, default=30, help='longest random dialogue')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='batch size of the batched run')
+    parser.add_argument('--max-latency-ms', type=float, default=5.0, help='batching window')
+    parser.add_argument('--max-queue', type=int, default=256, help='waiting dialogues before 503')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    predictor = load_predictor(args.checkpoint, args.artifact)
+    rng = np.random.default_rng(0)
+    bodies = [random_dialogue(predictor.config, rng, args.max_len) for _ in range(args.clients * args.requests)]
+    for max_batch_size in [1, args.max_batch_size]:
+        asyncio.run(run(args, predictor, max_batch_size, bodies))
@@ -0,0 +1,9 @@
+'''/
+performance benchmarks on synthetic data with the real feature sizes and dialogue length
+distributions of IEMOCAP and MELD (no feature pickle or training run needed):
+
+    python -m benchmark run --Dataset IEMOCAP --out base.json
+    python -m benchmark compare base.json new.json --threshold 0.1
+
+synthetic.py writes the datasets, suites.py measures them and compare.py diffs two result files.
+/'''
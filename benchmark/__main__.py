@@ -0,0 +1,108 @@
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+import torch
+from convert_features import convert
+from benchmark.compare import load, report
+from benchmark.suites import configurations, bench_loading, bench_collate, bench_train, bench_inference, bench_checkpoint
+from benchmark.synthetic import PROFILES, write_pickle
+
+'''/
+    python -m benchmark run [--Dataset IEMOCAP MELD] [--suites loading collate train inference checkpoint] --out results.json
+    python -m benchmark compare base.json new.json [--threshold 0.1]
+
+run writes the results with the commit, torch version, device and thread count they were
+measured with; compare exits with status 1 when a metric regressed by more than --threshold.
+The model benchmarks vary one of --settings, --modalities, --hidden-dims, --batch-sizes and
+--seq-lens at a time around the first value of each (--full-grid runs every combination).
+The checkpoint suite runs every --checkpointing spec on the first model of the grid at
+every --seq-lens.
+/'''
+SUITES = ['loading', 'collate', 'train', 'inference', 'checkpoint']
+# dialogue lengths around the mean, short and longest dialogue of each dataset
+SEQ_LENS = {'IEMOCAP': [48, 16, 110], 'MELD': [10, 4, 33]}
+
+
+def commit():
+    try:
+        sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], stderr=subprocess.DEVNULL, text=True).strip()
+        return sha + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def meta(args, device):
+    return {'commit': commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'device': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor() or 'cpu',
+            'threads': torch.get_num_threads(), 'scale': args.scale, 'warmup': args.warmup, 'repeat': args.repeat}
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    results = []
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='sdt_bench_')
+    try:
+        for dataset in args.Dataset:
+            start = time.time()
+            if {'loading', 'collate'} & set(args.suites):
+                pickle_path = write_pickle(data_dir, dataset, args.scale)
+                store_dir = os.path.join(data_dir, '{}_features'.format(dataset.lower()))
+                convert(pickle_path, store_dir, dataset)
+            grid = configurations({'setting': args.settings, 'modality': args.modalities, 'hidden_dim': args.hidden_dims,
+                                   'batch_size': args.batch_sizes, 'seq_len': args.seq_lens or SEQ_LENS[dataset]}, args.full_grid)
+            for suite in args.suites:
+                if suite == 'loading':
+                    new = bench_loading(dataset, pickle_path, store_dir, args.warmup, args.repeat)
+                elif suite == 'collate':
+                    new = bench_collate(dataset, pickle_path, store_dir, args.batch_sizes, args.warmup, args.repeat)
+                elif suite == 'train':
+                    new = bench_train(dataset, grid, device, args.warmup, args.repeat)
+                elif suite == 'checkpoint':
+                    lengths = [dict(grid[0], seq_len=seq_len) for seq_len in args.seq_lens or SEQ_LENS[dataset]]
+                    new = bench_checkpoint(dataset, lengths, args.checkpointing, device, args.warmup, args.repeat)
+                else:
+                    new = bench_inference(dataset, grid, device, args.warmup, args.repeat)
+                for entry in new:
+                    print('{:<10} {:<8} {} {}'.format(entry['suite'], dataset, entry['params'], entry['metrics']), flush=True)
+                results += new
+            print('{}: {:.0f}s'.format(dataset, time.time() - start))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump({'meta': meta(args, device), 'results': results}, f, indent=1)
+    print('{} measurements -> {}'.format(len(results), args.out))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_run = commands.add_parser('run', help='run the benchmarks and write their results')
+    parser_run.add_argument('--Dataset', nargs='+', default=['IEMOCAP'], choices=list(PROFILES), help='feature sizes and dialogue lengths to simulate')
+    parser_run.add_argument('--suites', nargs='+', default=SUITES, choices=SUITES, help='benchmarks to run')
+    parser_run.add_argument('--scale', type=float, default=1.0, help='dialogues per split relative to the real dataset')
+    parser_run.add_argument('--data-dir', default=None, help='keep the synthetic pickle and feature store here (default a temporary directory)')
+    parser_run.add_argument('--settings', nargs='+', default=['original', 'realtime'], help='model classes (original or realtime)')
+    parser_run.add_argument('--modalities', nargs='+', default=['atv', 't', 'a', 'at'], help='modalities')
+    parser_run.add_argument('--hidden-dims', type=int, nargs='+', default=[256, 1024], help='hidden sizes')
+    parser_run.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 1, 32], help='dialogues per batch')
+    parser_run.add_argument('--seq-lens', type=int, nargs='+', default=None, help='utterances per dialogue (default per dataset: typical, short, longest)')
+    parser_run.add_argument('--checkpointing', nargs='+', default=['none', 'all:ffn', 'inter', 'all'], help='activation checkpointing specs of the checkpoint suite (see model.set_checkpointing)')
+    parser_run.add_argument('--full-grid', action='store_true', default=False, help='every combination instead of one axis at a time')
+    parser_run.add_argument('--warmup', type=int, default=2, help='untimed repetitions')
+    parser_run.add_argument('--repeat', type=int, default=10, help='timed repetitions')
+    parser_run.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    parser_run.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model benchmarks')
+    parser_run.add_argument('--out', default='benchmark.json', help='JSON file of the results')
+    parser_compare = commands.add_parser('compare', help='flag regressions between two result files')
+    parser_compare.add_argument('base', help='results of the reference commit')
+    parser_compare.add_argument('new', help='results to check')
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(1 if report(load(args.base), load(args.new), args.threshold) else 0)
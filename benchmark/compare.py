@@ -0,0 +1,53 @@
+import json
+
+'''/
+compares two result files of `python -m benchmark run` measurement by measurement (same
+suite, dataset and params). A metric regresses when it is worse than in the base file by
+more than the threshold (a relative change, 0.1 = 10%): slower for times, lower for rates.
+/'''
+LOWER_IS_BETTER = ['ms', 'ms_per_batch', 'ms_per_step', 'p50_ms', 'p99_ms', 'activation_mb']
+HIGHER_IS_BETTER = ['dialogues_per_sec', 'utt_per_sec']
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def key(entry):
+    return entry['suite'], entry['dataset'], json.dumps(entry['params'], sort_keys=True)
+
+
+def compare(base, new, threshold=0.1):
+    """ rows (suite, dataset, params, metric, base value, new value, relative change, status) of the measurements in both files """
+    base_entries = {key(entry): entry for entry in base['results']}
+    rows = []
+    for entry in new['results']:
+        old = base_entries.get(key(entry))
+        if old is None:
+            continue
+        for metric, value in entry['metrics'].items():
+            if metric not in old['metrics'] or not old['metrics'][metric]:
+                continue
+            change = value / old['metrics'][metric] - 1
+            worse = change if metric in LOWER_IS_BETTER else -change if metric in HIGHER_IS_BETTER else 0.0
+            status = 'REGRESSION' if worse > threshold else 'improved' if worse < -threshold else ''
+            rows.append(key(entry) + (metric, old['metrics'][metric], value, change, status))
+    return rows
+
+
+def report(base, new, threshold=0.1):
+    """ prints the comparison and returns the number of regressions """
+    rows = compare(base, new, threshold)
+    print('base {} ({}), new {} ({}), threshold {:.0%}'.format(base['meta']['commit'], base['meta']['date'],
+                                                                new['meta']['commit'], new['meta']['date'], threshold))
+    print('{:<10} {:<8} {:<64} {:<18} {:>10} {:>10} {:>8}'.format('suite', 'dataset', 'params', 'metric', 'base', 'new', 'change'))
+    for suite, dataset, params, metric, old, value, change, status in rows:
+        params = ' '.join('{}={}'.format(*item) for item in json.loads(params).items())
+        print('{:<10} {:<8} {:<64} {:<18} {:>10.3f} {:>10.3f} {:>+8.1%} {}'.format(suite, dataset, params, metric, old, value, change, status))
+    missing = {key(entry) for entry in base['results']} - {key(entry) for entry in new['results']}
+    if missing:
+        print('{} measurements of the base are not in the new results'.format(len(missing)))
+    regressions = sum(row[-1] == 'REGRESSION' for row in rows)
+    print('{} regressions in {} metrics'.format(regressions, len(rows)))
+    return regressions
@@ -0,0 +1,152 @@
+import itertools, time
+import numpy as np
+import torch
+import torch.optim as optim
+from dataloader import IEMOCAPDataset, MELDDataset, FeatureStoreDataset, PackedDialogues
+from autobatch import step_bytes
+from export import InferenceSDT
+from model import MaskedNLLLoss, MaskedKLDivLoss, build_model, DEFAULT_ATTENTION
+from train import get_loaders, sdt_loss
+from benchmark.synthetic import PROFILES, D_text, D_visual, random_batch
+
+'''/
+the benchmark suites. Each returns a list of results
+
+    {'suite': ..., 'dataset': ..., 'params': {...}, 'metrics': {...}}
+
+where params identify the measurement across runs (compare.py matches on them) and the
+metrics are medians over --repeat timed repetitions after --warmup untimed ones:
+
+- loading: opening both splits of the pickle and of the feature store, packing the training split
+- collate: one epoch of training batches from the pickle, the feature store, the bucketed
+  pickle and the packed split (train.get_loaders, as in training) per batch size
+- train: forward, loss (train.sdt_loss), backward and Adam on random full dialogues
+- inference: the fused distribution (export.InferenceSDT) without autograd
+- checkpoint: the training step and its activation memory (peak allocated on the GPU, saved
+  for backward on the CPU, see autobatch.step_bytes) per activation checkpointing spec
+/'''
+
+def timed(function, warmup, repeat, synchronize=False):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        if synchronize:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def result(suite, dataset, params, **metrics):
+    return {'suite': suite, 'dataset': dataset, 'params': params, 'metrics': {k: round(float(v), 4) for k, v in metrics.items()}}
+
+
+def configurations(axes, full=False):
+    """ the full grid of axes (name -> values), or one axis at a time around the first value of every axis """
+    names = list(axes)
+    if full:
+        return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+    base = {name: values[0] for name, values in axes.items()}
+    grid = [base]
+    for name, values in axes.items():
+        grid += [dict(base, **{name: value}) for value in values[1:]]
+    return grid
+
+
+def model_config(dataset, setting, modality, hidden_dim, n_head=8):
+    profile = PROFILES[dataset]
+    return dict(dataset=dataset, temp=1, D_text=D_text, D_visual=D_visual, D_audio=profile['D_audio'], n_head=n_head,
+                n_classes=profile['n_classes'], hidden_dim=hidden_dim, n_speakers=profile['n_speakers'], dropout=0.5,
+                modality=modality, attention=DEFAULT_ATTENTION, grouped=False, setting=setting)
+
+
+def bench_loading(dataset, pickle_path, store_dir, warmup, repeat):
+    cls = IEMOCAPDataset if dataset == 'IEMOCAP' else MELDDataset
+    trainset = cls(pickle_path)
+    sources = {'pickle': lambda: (cls(pickle_path), cls(pickle_path, train=False)),
+               'store': lambda: (FeatureStoreDataset(store_dir), FeatureStoreDataset(store_dir, train=False)),
+               'packed': lambda: PackedDialogues(trainset)}
+    return [result('loading', dataset, {'source': source}, ms=np.median(timed(function, warmup, repeat)) * 1000)
+            for source, function in sources.items()]
+
+
+def bench_collate(dataset, pickle_path, store_dir, batch_sizes, warmup, repeat):
+    cls = IEMOCAPDataset if dataset == 'IEMOCAP' else MELDDataset
+    splits = {'pickle': (cls(pickle_path), cls(pickle_path, train=False)),
+              'store': (FeatureStoreDataset(store_dir), FeatureStoreDataset(store_dir, train=False))}
+    sources = {'pickle': (splits['pickle'], {}), 'store': (splits['store'], {}),
+               'bucket': (splits['pickle'], {'bucket': True}), 'packed': (splits['pickle'], {'in_memory': True})}
+    results = []
+    for batch_size in batch_sizes:
+        for source, ((trainset, testset), options) in sources.items():
+            loader = get_loaders(trainset, testset, batch_size, valid=0.0, **options)[0]
+            epoch = lambda: [batch for batch in loader]
+            seconds = np.median(timed(epoch, warmup, repeat))
+            results.append(result('collate', dataset, {'source': source, 'batch_size': batch_size},
+                                   ms_per_batch=seconds / len(loader) * 1000, dialogues_per_sec=len(trainset) / seconds))
+    return results
+
+
+def models(dataset, grid, device):
+    """ (params, config, model) for the grid, building a model only when its setting, modality or hidden size changes """
+    key, model = None, None
+    for params in grid:
+        if key != (params['setting'], params['modality'], params['hidden_dim']):
+            key = (params['setting'], params['modality'], params['hidden_dim'])
+            torch.manual_seed(0)
+            config = model_config(dataset, *key)
+            model = build_model(config).to(device)
+        yield params, config, model
+
+
+def training_loss(outputs, labels_, umask):
+    return sdt_loss(outputs, labels_, umask, MaskedNLLLoss(), MaskedKLDivLoss())[0]
+
+
+def train_step(model, config, params, device):
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=1e-5)
+    textf, visuf, acouf, umask, qmask, label, lengths = random_batch(config, params['batch_size'], params['seq_len'], device)
+
+    def step():
+        optimizer.zero_grad()
+        outputs = model(textf, visuf, acouf, umask, qmask, lengths)
+        training_loss(outputs, label.view(-1), umask).backward()
+        optimizer.step()
+    return step
+
+
+def bench_train(dataset, grid, device, warmup, repeat):
+    results = []
+    for params, config, model in models(dataset, grid, device):
+        seconds = np.median(timed(train_step(model, config, params, device), warmup, repeat, device.type == 'cuda'))
+        results.append(result('train', dataset, params, ms_per_step=seconds * 1000,
+                              utt_per_sec=params['batch_size'] * params['seq_len'] / seconds))
+    return results
+
+
+def bench_checkpoint(dataset, grid, specs, device, warmup, repeat):
+    results = []
+    for params, config, model in models(dataset, grid, device):
+        for spec in specs:
+            model.set_checkpointing(None if spec == 'none' else spec)
+            seconds = np.median(timed(train_step(model, config, params, device), warmup, repeat, device.type == 'cuda'))
+            memory = step_bytes(model, config, training_loss, params['batch_size'], params['seq_len'], device)
+            results.append(result('checkpoint', dataset, dict(params, checkpointing=spec), ms_per_step=seconds * 1000,
+                                  activation_mb=memory / 2**20))
+        model.set_checkpointing(None)
+    return results
+
+
+def bench_inference(dataset, grid, device, warmup, repeat):
+    results = []
+    for params, config, model in models(dataset, grid, device):
+        wrapper = InferenceSDT(model).eval()
+        textf, visuf, acouf, umask, qmask, _, _ = random_batch(config, params['batch_size'], params['seq_len'], device)
+        with torch.no_grad():
+            times = timed(lambda: wrapper(textf, visuf, acouf, umask, qmask), warmup, repeat, device.type == 'cuda')
+        results.append(result('inference', dataset, params, p50_ms=np.percentile(times, 50) * 1000, p99_ms=np.percentile(times, 99) * 1000,
+                              utt_per_sec=params['batch_size'] * params['seq_len'] / np.median(times)))
+    return results
@@ -0,0 +1,76 @@
+import os, pickle
+import numpy as np
+import torch
+
+'''/
+synthetic IEMOCAP and MELD data: random features with the sizes of train.py's feat2dim,
+dialogue lengths drawn from a log-normal fitted to the mean and spread of the real splits
+(clipped to their shortest and longest dialogue), written as *_multimodal_features.pkl in
+the exact layout the dataset classes and convert_features.py read
+
+    path = write_pickle('/tmp/bench', 'MELD', scale=0.5)
+/'''
+FEAT2DIM = {'IS10': 1582, 'denseface': 342, 'MELD_audio': 300, 'text': 1024}
+
+# dialogues per split, utterances per dialogue (mean, std, min, max), speakers and classes of the real data
+PROFILES = {'IEMOCAP': dict(D_audio=FEAT2DIM['IS10'], n_speakers=2, n_classes=6, n_train=120, n_test=31,
+                            mean_len=49.0, std_len=17.0, min_len=8, max_len=110),
+            'MELD': dict(D_audio=FEAT2DIM['MELD_audio'], n_speakers=9, n_classes=7, n_train=1153, n_test=280,
+                         mean_len=9.6, std_len=5.8, min_len=1, max_len=33)}
+D_text, D_visual = FEAT2DIM['text'], FEAT2DIM['denseface']
+
+
+def dialogue_lengths(profile, n, rng):
+    sigma2 = np.log(1 + (profile['std_len'] / profile['mean_len']) ** 2)
+    lengths = rng.lognormal(np.log(profile['mean_len']) - sigma2 / 2, np.sqrt(sigma2), n)
+    return np.clip(np.round(lengths), profile['min_len'], profile['max_len']).astype(int).tolist()
+
+
+def features(rng, n, d):
+    return rng.standard_normal((n, d), dtype=np.float32)
+
+
+def write_pickle(out_dir, dataset, scale=1.0, seed=0):
+    """ writes <out_dir>/<dataset>_multimodal_features.pkl with round(scale * real) dialogues per split and returns its path """
+    profile = PROFILES[dataset]
+    rng = np.random.default_rng(seed)
+    n_train, n_test = max(2, round(profile['n_train'] * scale)), max(1, round(profile['n_test'] * scale))
+    if dataset == 'IEMOCAP':
+        vids = ['Ses{:05d}'.format(i) for i in range(n_train + n_test)]
+    else:
+        vids = list(range(n_train + n_test))
+    lengths = dict(zip(vids, dialogue_lengths(profile, len(vids), rng)))
+
+    speakers, labels, text, roberta, audio, visual, sentences = {}, {}, {}, [{}, {}, {}], {}, {}, {}
+    for vid, n in lengths.items():
+        who = rng.integers(0, profile['n_speakers'], n)
+        if dataset == 'IEMOCAP':
+            speakers[vid] = ['M' if s == 0 else 'F' for s in who]
+        else:
+            speakers[vid] = np.eye(profile['n_speakers'], dtype=int)[who].tolist()
+        labels[vid] = rng.integers(0, profile['n_classes'], n).tolist()
+        text[vid] = features(rng, n, D_text)
+        for r in roberta:
+            r[vid] = features(rng, n, D_text)
+        audio[vid] = features(rng, n, profile['D_audio'])
+        visual[vid] = features(rng, n, D_visual)
+        sentences[vid] = ['utterance {}'.format(i) for i in range(n)]
+    train_vids, test_vids = vids[:n_train], vids[n_train:]
+
+    fields = [vids, speakers, labels, text] + roberta + [audio, visual, sentences, train_vids, test_vids]
+    if dataset == 'MELD':
+        fields.append(None)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, '{}_multimodal_features.pkl'.format(dataset.lower()))
+    with open(path, 'wb') as f:
+        pickle.dump(tuple(fields), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def random_batch(config, batch_size, seq_len, device='cpu'):
+    """ model inputs of batch_size full dialogues of seq_len utterances: textf, visuf, acouf [seq_len, batch_size, D], umask, qmask, labels, lengths """
+    qmask = torch.nn.functional.one_hot(torch.randint(0, config['n_speakers'], (batch_size, seq_len)), config['n_speakers']).float()
+    batch = [torch.randn(seq_len, batch_size, config['D_text']), torch.randn(seq_len, batch_size, config['D_visual']),
+             torch.randn(seq_len, batch_size, config['D_audio']), torch.ones(batch_size, seq_len), qmask,
+             torch.randint(0, config['n_classes'], (batch_size, seq_len)), torch.full((batch_size,), seq_len)]
+    return [x.to(device) for x in batch]
@@ -0,0 +1,97 @@
+import os, queue, random, threading
+import numpy as np
+import torch
+
+'''/
+training checkpoints written from a background thread. save() only takes a CPU copy of
+the state (model, optimizer, RNG, epoch, ...) in the training thread; the pickling and the
+disk write happen in the writer thread, into a temporary file that is fsynced and renamed
+over the old checkpoint, so a crash mid-write never leaves a truncated checkpoint behind.
+
+    checkpointer = AsyncCheckpointer('checkpoints/run1')
+    checkpointer.save('last.pt', {'model': model.state_dict(), 'rng': rng_state(), ...})
+    checkpointer.close()
+/'''
+
+def snapshot(state):
+    """ CPU copy of every tensor (and container) of a nested state, safe to write while training goes on """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_training_checkpoint(path):
+    # also holds numpy and python RNG states, so this is a full (trusted) unpickle
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, directory, max_pending=2):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # at most max_pending snapshots wait in memory; save() only blocks if the disk falls that far behind
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None and self.error is None:
+                    self.write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def write(self, name, state):
+        path = self.path(name)
+        with open(path + '.tmp', 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('writing a checkpoint to {} failed'.format(self.directory)) from self.error
+
+    def save(self, name, state):
+        self.check()
+        self.queue.put((name, snapshot(state)))
+
+    def wait(self):
+        """ block until every queued checkpoint is on disk """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,74 @@
+import os, json, argparse, pickle
+import numpy as np
+
+'''/
+Converts a *_multimodal_features.pkl into a columnar feature store that
+dataloader.FeatureStoreDataset memory-maps:
+
+    <out_dir>/text.npy, audio.npy, visual.npy   [n_utterances, D] (float32 or float16)
+    <out_dir>/speakers.npy                      [n_utterances, n_speakers] one-hot, as in qmask
+    <out_dir>/labels.npy                        [n_utterances]
+    <out_dir>/offsets.npy                       [n_dialogues+1], utterances of dialogue i are offsets[i]:offsets[i+1]
+    <out_dir>/meta.json                         dialogue ids in store order and the train/test split
+
+Only the features the model uses are kept (roberta2/3/4 and videoSentence are dropped).
+
+    python convert_features.py --Dataset IEMOCAP --Data_dir ./data [--float16]
+/'''
+
+def load_pickle(path, dataset):
+    if dataset == 'IEMOCAP':
+        videoIDs, videoSpeakers, videoLabels, videoText, _, _, _, \
+        videoAudio, videoVisual, _, trainVid, testVid = pickle.load(open(path, 'rb'), encoding='latin1')
+        videoSpeakers = {vid: [[1,0] if x=='M' else [0,1] for x in spk] for vid, spk in videoSpeakers.items()}
+    else:
+        videoIDs, videoSpeakers, videoLabels, videoText, _, _, _, \
+        videoAudio, videoVisual, _, trainVid, testVid, _ = pickle.load(open(path, 'rb'))
+    return videoSpeakers, videoLabels, videoText, videoAudio, videoVisual, list(trainVid), list(testVid)
+
+
+def write_column(path, arrays, dtype):
+    # write dialogue by dialogue into a preallocated .npy, never holding the whole column twice
+    n = sum(len(a) for a in arrays)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n,) + np.asarray(arrays[0]).shape[1:])
+    start = 0
+    for a in arrays:
+        out[start:start+len(a)] = np.asarray(a, dtype=dtype)
+        start += len(a)
+    out.flush()
+    del out
+
+
+def convert(path, out_dir, dataset, float16=False):
+    videoSpeakers, videoLabels, videoText, videoAudio, videoVisual, trainVid, testVid = load_pickle(path, dataset)
+    keys = trainVid + testVid
+    os.makedirs(out_dir, exist_ok=True)
+
+    feature_dtype = np.float16 if float16 else np.float32
+    write_column(os.path.join(out_dir, 'text.npy'), [videoText[vid] for vid in keys], feature_dtype)
+    write_column(os.path.join(out_dir, 'audio.npy'), [videoAudio[vid] for vid in keys], feature_dtype)
+    write_column(os.path.join(out_dir, 'visual.npy'), [videoVisual[vid] for vid in keys], feature_dtype)
+    write_column(os.path.join(out_dir, 'speakers.npy'), [videoSpeakers[vid] for vid in keys], np.float32)
+    write_column(os.path.join(out_dir, 'labels.npy'), [videoLabels[vid] for vid in keys], np.int64)
+    lengths = [len(videoLabels[vid]) for vid in keys]
+    np.save(os.path.join(out_dir, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+
+    as_json = lambda vids: [int(vid) if isinstance(vid, np.integer) else vid for vid in vids]
+    meta = {'dataset': dataset, 'dtype': np.dtype(feature_dtype).name,
+            'keys': as_json(keys), 'trainVid': as_json(trainVid), 'testVid': as_json(testVid)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print('{}: {} dialogues, {} utterances -> {}'.format(dataset, len(keys), sum(lengths), out_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--Dataset', default='IEMOCAP', help='IEMOCAP or MELD')
+    parser.add_argument('--Data_dir', default='./data', help='directory of the *_multimodal_features.pkl')
+    parser.add_argument('--out', default=None, help='output directory (default <Data_dir>/<dataset>_features)')
+    parser.add_argument('--float16', action='store_true', default=False, help='store the features as float16')
+    args = parser.parse_args()
+
+    path = f'{args.Data_dir}/{args.Dataset.lower()}_multimodal_features.pkl'
+    out_dir = args.out or f'{args.Data_dir}/{args.Dataset.lower()}_features'
+    convert(path, out_dir, args.Dataset, args.float16)
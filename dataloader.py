@@ -1,7 +1,49 @@
 import torch
-from torch.utils.data import Dataset
-from torch.nn.utils.rnn import pad_sequence
-import pickle, pandas as pd
+from torch.utils.data import Dataset, Sampler
+import copy, os, json, pickle, numpy as np
+
+
+class DialogueCollator(object):
+    '''/
+    pads a list of dialogues (text, visual, audio, speakers, umask, labels, vid) into
+    [text, visual, audio, speakers] of shape [seq_len, batch_size, D], umask and labels of
+    shape [batch_size, seq_len], the lengths [batch_size] and the list of vids.
+    The padded tensors are allocated once per batch (or taken from reusable buffers when
+    reuse=True, in which case a batch is only valid until the next call) and filled row by row.
+    pin_memory allocates them in page-locked memory for asynchronous copies to the GPU
+    /'''
+    def __init__(self, pin_memory=False, reuse=False):
+        self.pin_memory = pin_memory
+        self.reuse = reuse
+        self.buffers = {}
+
+    def empty(self, name, shape, dtype):
+        numel = int(np.prod(shape))
+        if not self.reuse:
+            return torch.zeros(shape, dtype=dtype, pin_memory=self.pin_memory)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = self.buffers[name] = torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+        return buffer[:numel].view(shape).zero_()
+
+    def __call__(self, data):
+        batch_size = len(data)
+        lengths = torch.tensor([len(d[5]) for d in data], dtype=torch.long)
+        seq_len = int(lengths.max())
+        padded = [self.empty(name, (seq_len, batch_size, data[0][i].size(-1)), torch.float)
+                  for i, name in enumerate(['text', 'visual', 'audio', 'speakers'])]
+        umask = self.empty('umask', (batch_size, seq_len), torch.float)
+        labels = self.empty('labels', (batch_size, seq_len), torch.long)
+        for j, d in enumerate(data):
+            n = len(d[5])
+            for i in range(4):
+                padded[i][:n, j] = d[i]
+            umask[j, :n] = d[4]
+            labels[j, :n] = d[5]
+        return padded + [umask, labels, lengths, [d[6] for d in data]]
+
+
+collate_dialogues = DialogueCollator()
 
 
 class IEMOCAPDataset(Dataset):
@@ -28,9 +70,11 @@ class IEMOCAPDataset(Dataset):
     def __len__(self):
         return self.len
 
+    def dialogue_lengths(self):
+        return [len(self.videoLabels[vid]) for vid in self.keys]
+
     def collate_fn(self, data):
-        dat = pd.DataFrame(data)
-        return [pad_sequence(dat[i]) if i<4 else pad_sequence(dat[i], True) if i<6 else dat[i].tolist() for i in dat]
+        return collate_dialogues(data)
 
 
 class MELDDataset(Dataset):
@@ -57,6 +101,9 @@ class MELDDataset(Dataset):
     def __len__(self):
         return self.len
 
+    def dialogue_lengths(self):
+        return [len(self.videoLabels[vid]) for vid in self.keys]
+
     def return_labels(self):
         return_label = []
         for key in self.keys:
@@ -64,5 +111,193 @@ class MELDDataset(Dataset):
         return return_label
 
     def collate_fn(self, data):
-        dat = pd.DataFrame(data)
-        return [pad_sequence(dat[i]) if i<4 else pad_sequence(dat[i], True) if i<6 else dat[i].tolist() for i in dat]
\ No newline at end of file
+        return collate_dialogues(data)
+
+class FeatureStoreDataset(Dataset):
+    '''/
+    reads the columnar store written by convert_features.py. Every column is memory-mapped,
+    so opening is instant, memory grows only with the dialogues actually read and processes
+    on the same machine share the page cache
+    /'''
+    def __init__(self, path, train=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.videoText = np.load(os.path.join(path, 'text.npy'), mmap_mode='r')
+        self.videoAudio = np.load(os.path.join(path, 'audio.npy'), mmap_mode='r')
+        self.videoVisual = np.load(os.path.join(path, 'visual.npy'), mmap_mode='r')
+        self.videoSpeakers = np.load(os.path.join(path, 'speakers.npy'), mmap_mode='r')
+        self.videoLabels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        position = {vid: i for i, vid in enumerate(meta['keys'])}
+        self.keys = [x for x in (meta['trainVid'] if train else meta['testVid'])]
+        self.index = [position[vid] for vid in self.keys]
+
+        self.len = len(self.keys)
+
+    def rows(self, column, index):
+        i = self.index[index]
+        return torch.from_numpy(np.array(column[self.offsets[i]:self.offsets[i+1]], dtype=np.float32))
+
+    def __getitem__(self, index):
+        labels = self.rows(self.videoLabels, index).long()
+        return self.rows(self.videoText, index),\
+               self.rows(self.videoVisual, index),\
+               self.rows(self.videoAudio, index),\
+               self.rows(self.videoSpeakers, index),\
+               torch.ones(len(labels)),\
+               labels,\
+               self.keys[index]
+
+    def __len__(self):
+        return self.len
+
+    def dialogue_lengths(self):
+        return [int(self.offsets[i+1] - self.offsets[i]) for i in self.index]
+
+    def return_labels(self):
+        return [int(label) for i in self.index for label in self.videoLabels[self.offsets[i]:self.offsets[i+1]]]
+
+    def collate_fn(self, data):
+        return collate_dialogues(data)
+
+
+
+class BucketBatchSampler(Sampler):
+    '''/
+    batches dialogues of similar length to cut the padding attention runs on.
+    Every epoch the indices are shuffled, cut into buckets of bucket_size batches, sorted
+    by length inside each bucket and split into batches, and the batch order is shuffled.
+    Batches hold batch_size dialogues, or with max_tokens as many as fit in
+    max_tokens padded utterances (batch_size * longest dialogue). shuffle=False sorts the
+    whole split by length (for evaluation). padding_ratio is the share of padded utterances
+    in the batches of the last epoch
+    /'''
+    def __init__(self, lengths, batch_size, indices=None, max_tokens=None, bucket_size=4, shuffle=True):
+        self.lengths = lengths
+        self.indices = list(range(len(lengths))) if indices is None else list(indices)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.batches = self.make_batches()
+        self.fresh = True
+
+    def split(self, indices):
+        batches, batch, longest = [], [], 0
+        for i in indices:
+            longest_ = max(longest, self.lengths[i])
+            full = len(batch) == self.batch_size if self.max_tokens is None \
+                   else longest_ * (len(batch) + 1) > self.max_tokens
+            if batch and full:
+                batches.append(batch)
+                batch, longest_ = [], self.lengths[i]
+            batch.append(i)
+            longest = longest_
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def make_batches(self):
+        by_length = lambda i: self.lengths[i]
+        if not self.shuffle:
+            return self.split(sorted(self.indices, key=by_length))
+        indices = [self.indices[i] for i in torch.randperm(len(self.indices)).tolist()]
+        # with a token budget a bucket spans roughly bucket_size average batches
+        span = self.bucket_size * (self.batch_size if self.max_tokens is None
+                                   else max(1, self.max_tokens // max(1, int(np.mean(self.lengths)))))
+        batches = []
+        for start in range(0, len(indices), span):
+            batches += self.split(sorted(indices[start:start+span], key=by_length))
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+    @property
+    def padding_ratio(self):
+        padded = sum(len(batch) * max(self.lengths[i] for i in batch) for batch in self.batches)
+        return 1 - sum(self.lengths[i] for batch in self.batches for i in batch) / max(1, padded)
+
+    def set_epoch(self, epoch):
+        # the batches made in __init__ belong to epoch 0, any later epoch draws new ones
+        self.fresh = epoch == 0
+
+    def __iter__(self):
+        # the batches of the first epoch are made in __init__ so that len() is known
+        if not self.fresh:
+            self.batches = self.make_batches()
+        self.fresh = False
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class PackedDialogues(object):
+    '''/
+    a whole split converted once into packed tensors: every column holds the utterances of
+    all dialogues back to back ([n_utterances+1, D], the last row is zeros for the padding),
+    optionally on the GPU. batch() gathers a padded batch with the same layout as
+    DialogueCollator, so there is no per-dialogue Python work after loading
+    /'''
+    def __init__(self, dataset, device='cpu'):
+        items = [dataset[i] for i in range(len(dataset))]
+        self.device = torch.device(device)
+        self.keys = [d[6] for d in items]
+        self.lengths_cpu = torch.tensor([len(d[5]) for d in items], dtype=torch.long)
+        self.lengths = self.lengths_cpu.to(self.device)
+        self.offsets = (torch.cumsum(self.lengths_cpu, 0) - self.lengths_cpu).to(self.device)
+        self.padding_row = int(self.lengths_cpu.sum())
+
+        def pack(i):
+            rows = [d[i] for d in items]
+            return torch.cat(rows + [torch.zeros_like(rows[0][:1])]).to(self.device)
+        self.text, self.visual, self.audio, self.speakers = [pack(i) for i in range(4)]
+        self.labels = pack(5)
+
+    TENSORS = ['lengths', 'offsets', 'text', 'visual', 'audio', 'speakers', 'labels']
+
+    def to(self, device):
+        if torch.device(device) == self.device:
+            return self
+        packed = copy.copy(self)
+        packed.device = torch.device(device)
+        for name in self.TENSORS:
+            setattr(packed, name, getattr(self, name).to(packed.device))
+        return packed
+
+    def share_memory(self):
+        """ moves the CPU tensors to shared memory, so forked worker processes read the same pages """
+        for name in self.TENSORS + ['lengths_cpu']:
+            getattr(self, name).share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.keys)
+
+    def dialogue_lengths(self):
+        return self.lengths_cpu.tolist()
+
+    def batch(self, indices):
+        seq_len = int(self.lengths_cpu[indices].max())
+        indices = torch.as_tensor(indices, dtype=torch.long).to(self.device, non_blocking=True)
+        lengths = self.lengths[indices]
+        positions = torch.arange(seq_len, device=self.device).unsqueeze(1)
+        valid = positions < lengths.unsqueeze(0)  # [seq_len, batch_size]
+        rows = torch.where(valid, self.offsets[indices].unsqueeze(0) + positions,
+                           torch.full_like(positions, self.padding_row))
+        return [self.text[rows], self.visual[rows], self.audio[rows], self.speakers[rows],
+                valid.t().contiguous().float(), self.labels[rows.t().contiguous()], lengths, [self.keys[i] for i in indices.tolist()]]
+
+
+class PackedLoader(object):
+    '''/
+    iterates the batches of a batch sampler over PackedDialogues, in place of a DataLoader
+    /'''
+    def __init__(self, packed, batch_sampler):
+        self.packed = packed
+        self.batch_sampler = batch_sampler
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            yield self.packed.batch(indices)
+
+    def __len__(self):
+        return len(self.batch_sampler)
@@ -2,5 +2,5 @@ echo =======================
 for iter in 1 2 3 4 5 6 7 8 9 10
 do
 echo --- $iter ---
-python -u train.py --lr 0.0001 --batch-size 16 --epochs 150 --temp 1 --Dataset 'IEMOCAP'
+python -u train.py --lr 0.0001 --batch-size 16 --epochs 150 --temp 1 --Dataset 'IEMOCAP' --checkpoint-dir checkpoints/iemocap_$iter --resume
 done > sdt_iemocap.txt 2>&1 &
\ No newline at end of file
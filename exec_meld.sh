@@ -2,5 +2,5 @@ echo =======================
 for iter in 1 2 3 4 5 6 7 8 9 10
 do
 echo --- $iter ---
-python -u train.py --lr 0.000005 --batch-size 8 --epochs 50 --temp 8 --Dataset 'MELD'
+python -u train.py --lr 0.000005 --batch-size 8 --epochs 50 --temp 8 --Dataset 'MELD' --checkpoint-dir checkpoints/meld_$iter --resume
 done > sdt_meld.txt 2>&1 &
\ No newline at end of file
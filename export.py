@@ -0,0 +1,92 @@
+import argparse, json, time
+import torch
+import torch.nn as nn
+from model import PositionalEncoding, build_model
+from benchmark.synthetic import random_batch
+
+'''/
+Exports a model saved by train.py --save-model as a standalone TorchScript artifact.
+The dimensions, class count, temperature, modality and setting are baked into the graph
+and stored as config.json inside the archive, so serving needs neither the training code
+nor the argparse values it was trained with. The trace also fixes the table of positions,
+so the artifact takes dialogues of at most config['max_len'] utterances:
+
+    python export.py --checkpoint sdt.pt --out sdt_inference.pt [--int8]
+
+    module, config = load_artifact('sdt_inference.pt')
+    all_prob = module(textf, visuf, acouf, umask, qmask)   # [batch_size, seq_len, n_classes]
+
+textf/visuf/acouf are [seq_len, batch_size, D] (unused modalities may be zeros of any D),
+umask is [batch_size, seq_len] and qmask the one-hot speakers [batch_size, seq_len, n_speakers].
+/'''
+
+class InferenceSDT(nn.Module):
+    """ serving signature of a trained model: the fused class distribution of every utterance """
+    def __init__(self, model):
+        super(InferenceSDT, self).__init__()
+        self.model = model
+        # per-modality log probs come first, then all_log_prob and all_prob
+        self.all_prob_index = len(model.encoders) + 1
+
+    def forward(self, textf, visuf, acouf, u_mask, qmask):
+        return self.model(textf, visuf, acouf, u_mask, qmask)[self.all_prob_index]
+
+
+def load_checkpoint(path):
+    # the weights are memory-mapped, and a grouped model is rebuilt with one module per encoder
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    config = dict(checkpoint['config'], grouped=False)
+    model = build_model(config)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval(), config
+
+
+def example_inputs(config, batch_size, seq_len):
+    # all but the first dialogue padded from half their length on
+    textf, visuf, acouf, umask, qmask = random_batch(config, batch_size, seq_len)[:5]
+    umask[1:, seq_len//2:] = 0
+    return textf, visuf, acouf, umask, qmask
+
+
+def export(model, config, out):
+    # the windowed attention blocks the dialogue with Python ints, which a trace fixes to the example length
+    assert not config.get('window'), 'long-context (--window) models run eager, or utterance by utterance with streaming.py'
+    wrapper = InferenceSDT(model).eval()
+    # positions beyond the precomputed table are computed by a branch the trace does not keep
+    config = dict(config, max_len=min(m.pe.size(1) for m in model.modules() if isinstance(m, PositionalEncoding)))
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example_inputs(config, 2, 8), check_trace=False)
+        traced = torch.jit.freeze(traced)
+        # the trace must generalise to other batch sizes and dialogue lengths
+        worst = 0.0
+        for batch_size, seq_len in [(1, 1), (3, 13), (5, 40)]:
+            inputs = example_inputs(config, batch_size, seq_len)
+            valid = inputs[3].bool()
+            worst = max(worst, (wrapper(*inputs)[valid] - traced(*inputs)[valid]).abs().max().item())
+    assert worst < 1e-4, 'exported graph does not match the model ({:.2e})'.format(worst)
+    torch.jit.save(traced, out, _extra_files={'config.json': json.dumps(config)})
+    return worst
+
+
+def load_artifact(path, device='cpu'):
+    extra_files = {'config.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return module, json.loads(extra_files['config.json'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, help='file written by train.py --save-model')
+    parser.add_argument('--out', required=True, help='path of the TorchScript artifact')
+    parser.add_argument('--int8', action='store_true', default=False, help='export the dynamic int8 model of quantize.py (CPU only)')
+    args = parser.parse_args()
+
+    model, config = load_checkpoint(args.checkpoint)
+    if args.int8:
+        from quantize import quantize
+        model = quantize(model)
+    worst = export(model, config, args.out)
+    start = time.perf_counter()
+    module, _ = load_artifact(args.out)
+    print('exported {} {} model to {} (max abs diff {:.2e}, load {:.0f} ms)'.format(
+        config['modality'], config['setting'], args.out, worst, (time.perf_counter()-start)*1000))
@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+from sklearn.metrics import classification_report
+
+'''/
+streaming classification metrics. ConfusionMatrix accumulates the masked [true, predicted]
+counts of every batch on the device of the model (one bincount, no host copies or syncs per
+batch); accuracy, weighted F1 and the classification report are derived from the counts at
+the end and equal what sklearn computes from the concatenated labels, predictions and masks.
+/'''
+
+class ConfusionMatrix(object):
+    def __init__(self, n_classes, device='cpu'):
+        self.n_classes = n_classes
+        self.counts = torch.zeros(n_classes * n_classes, dtype=torch.float64, device=device)
+
+    def update(self, labels, preds, mask):
+        self.counts += torch.bincount(labels.view(-1) * self.n_classes + preds.view(-1), weights=mask.view(-1).double(),
+                                      minlength=self.n_classes * self.n_classes)
+
+    def matrix(self):
+        """ [true class, predicted class] counts as a numpy array """
+        return self.counts.view(self.n_classes, self.n_classes).cpu().numpy()
+
+    def total(self):
+        return float(self.counts.sum())
+
+    def accuracy(self):
+        matrix = self.matrix()
+        if matrix.sum() == 0:
+            return float('nan')
+        return round(np.trace(matrix) / matrix.sum() * 100, 2)
+
+    def fscore(self):
+        """ support-weighted F1 (sklearn average='weighted', 0 for classes that are never predicted) """
+        matrix = self.matrix()
+        if matrix.sum() == 0:
+            return float('nan')
+        tp, true, pred = np.diag(matrix), matrix.sum(1), matrix.sum(0)
+        precision = np.divide(tp, pred, out=np.zeros_like(tp), where=pred > 0)
+        recall = np.divide(tp, true, out=np.zeros_like(tp), where=true > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall > 0)
+        return round(float(np.sum(f1 * true) / true.sum()) * 100, 2)
+
+    def report(self, digits=4):
+        # sklearn's report of one weighted sample per non-empty cell
+        matrix = self.matrix()
+        true, pred = np.nonzero(matrix)
+        return classification_report(true, pred, sample_weight=matrix[true, pred], digits=digits, zero_division=0)
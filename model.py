@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import math
 
 '''/
@@ -17,9 +18,18 @@ class MaskedKLDivLoss(nn.Module):
         super(MaskedKLDivLoss, self).__init__()
         self.loss = nn.KLDivLoss(reduction='sum')
 
-    def forward(self, log_pred, target, mask):
+    def normaliser(self, mask):
+        """ the denominator of the loss of a batch: its number of utterances """
+        return torch.sum(mask)
+
+    def forward(self, log_pred, target, mask, normaliser=None):
+        # normaliser: of the whole batch when this is one of its micro-batches (see autobatch.py)
         mask_ = mask.view(-1, 1)
-        loss = self.loss(log_pred * mask_, target * mask_) / torch.sum(mask)   
+        if normaliser is None:
+            normaliser = self.normaliser(mask)
+        # padded rows get target 1 and log_pred 0, which adds nothing to the loss (like target 0)
+        # but keeps the gradient w.r.t. target finite, since target is not detached
+        loss = self.loss(log_pred * mask_, target * mask_ + (1 - mask_)) / normaliser
         return loss
 
 
@@ -29,18 +39,32 @@ class MaskedNLLLoss(nn.Module):
         self.weight = weight
         self.loss = nn.NLLLoss(weight=weight, reduction='sum')
 
-    def forward(self, pred, target, mask):
-        mask_ = mask.view(-1, 1)
+    def normaliser(self, target, mask):
+        """ the denominator of the loss of a batch: its utterances, weighted by the class weights if any """
         if type(self.weight) == type(None):
-            loss = self.loss(pred * mask_, target) / torch.sum(mask)
-        else:
-            loss = self.loss(pred * mask_, target) \
-                   / torch.sum(self.weight[target] * mask_.squeeze())  
+            return torch.sum(mask)
+        return torch.sum(self.weight[target] * mask.view(-1))
+
+    def forward(self, pred, target, mask, normaliser=None):
+        # normaliser: of the whole batch when this is one of its micro-batches (see autobatch.py)
+        mask_ = mask.view(-1, 1)
+        if normaliser is None:
+            normaliser = self.normaliser(target, mask)
+        loss = self.loss(pred * mask_, target) / normaliser
         return loss
 
 def gelu(x):
     return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
 
+
+def checkpointed(module, function, *args):
+    """ function(*args); when module.checkpoint is set, only the inputs are kept for backward while training and
+    the activations are recomputed there (with the same dropout masks, see Transformer_Based_Model.set_checkpointing) """
+    if module.checkpoint and module.training and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+    return function(*args)
+
+
 class PositionwiseFeedForward(nn.Module):
     def __init__(self, d_model, d_ff, dropout=0.1):
         super(PositionwiseFeedForward, self).__init__()
@@ -50,21 +74,63 @@ class PositionwiseFeedForward(nn.Module):
         self.actv = gelu
         self.dropout_1 = nn.Dropout(dropout)
         self.dropout_2 = nn.Dropout(dropout)
+        self.checkpoint = False
 
     def forward(self, x):
+        return checkpointed(self, self.feed_forward, x)
+
+    def feed_forward(self, x):
         inter = self.dropout_1(self.actv(self.w_1(self.layer_norm(x))))
         output = self.dropout_2(self.w_2(inter))
         return output + x
 
 
+'''/
+attention backends:
+fused: packed QKV (or KV) projection when the inputs are shared and
+       F.scaled_dot_product_attention, with the masks passed un-expanded
+reference: the original projections, masked_fill(-1e10), softmax, dropout and matmul
+/'''
+ATTENTION_BACKENDS = ['fused', 'reference']
+DEFAULT_ATTENTION = 'fused' if hasattr(F, 'scaled_dot_product_attention') else 'reference'
+# absolute: sinusoids added to the inputs; relative: ALiBi distance bias in the (windowed) attention
+POSITIONS = ['absolute', 'relative']
+
+
+def alibi_slopes(head_count):
+    """ the geometric per-head slopes of ALiBi (Press et al.), 2^-8/h ... 2^-8 """
+    return torch.tensor([2 ** (-8 * (i + 1) / head_count) for i in range(head_count)])
+
+
+def shift_blocks(x, shift, dim, fill=None):
+    """ block b of the result is block b+shift of x along dim; blocks beyond the ends are zero (or fill) """
+    if shift == 0:
+        return x
+    n = x.size(dim)
+    edge = torch.zeros_like(x.narrow(dim, 0, min(abs(shift), n)))
+    if fill is not None:
+        edge = edge + fill
+    if shift < 0:
+        return torch.cat([edge, x.narrow(dim, 0, n - edge.size(dim))], dim)
+    return torch.cat([x.narrow(dim, edge.size(dim), n - edge.size(dim)), edge], dim)
+
+
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, head_count, model_dim, dropout=0.1):
+    def __init__(self, head_count, model_dim, dropout=0.1, attention=DEFAULT_ATTENTION, window=None, summary=False, relative=False):
         assert model_dim % head_count == 0
+        assert attention in ATTENTION_BACKENDS
         self.dim_per_head = model_dim // head_count
         self.model_dim = model_dim
 
         super(MultiHeadedAttention, self).__init__()
         self.head_count = head_count
+        self.attention = attention
+        # long-context mode, see windowed_forward
+        self.window = window
+        self.summary = summary
+        self.relative = relative
+        if relative:
+            self.register_buffer('slopes', alibi_slopes(head_count), persistent=False)
 
         self.linear_k = nn.Linear(model_dim, head_count * self.dim_per_head)
         self.linear_v = nn.Linear(model_dim, head_count * self.dim_per_head)
@@ -73,7 +139,37 @@ class MultiHeadedAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.linear = nn.Linear(model_dim, model_dim)
 
-    def forward(self, key, value, query, mask=None):
+    '''/
+    mask: [batch_size, 1, key_len], True for padded keys. With causal=True every query
+    additionally only sees the keys up to its own position
+    /'''
+    def forward(self, key, value, query, mask=None, causal=False):
+        if self.window:
+            return self.windowed_forward(key, value, query, mask, causal)
+        if self.attention == 'fused':
+            return self.fused_forward(key, value, query, mask, causal)
+        if causal:
+            causal_mask = generate_causal_mask(query.size(1), query.device)
+            mask = ~causal_mask.unsqueeze(0) if mask is None else mask | ~causal_mask.unsqueeze(0)
+        return self.reference_forward(key, value, query, mask)
+
+    def project(self, key, value, query):
+        # one packed matmul for the inputs that are shared (plain nn.Linear only, the int8
+        # modules of quantize.py keep their packed weights to themselves)
+        if not isinstance(self.linear_q, nn.Linear):
+            return self.linear_q(query), self.linear_k(key), self.linear_v(value)
+        if key is value and value is query:
+            weight = torch.cat([self.linear_q.weight, self.linear_k.weight, self.linear_v.weight])
+            bias = torch.cat([self.linear_q.bias, self.linear_k.bias, self.linear_v.bias])
+            return F.linear(query, weight, bias).chunk(3, dim=-1)
+        if key is value:
+            weight = torch.cat([self.linear_k.weight, self.linear_v.weight])
+            bias = torch.cat([self.linear_k.bias, self.linear_v.bias])
+            key, value = F.linear(key, weight, bias).chunk(2, dim=-1)
+            return self.linear_q(query), key, value
+        return self.linear_q(query), self.linear_k(key), self.linear_v(value)
+
+    def fused_forward(self, key, value, query, mask, causal):
         batch_size = key.size(0)
         dim_per_head = self.dim_per_head
         head_count = self.head_count
@@ -87,6 +183,22 @@ class MultiHeadedAttention(nn.Module):
             return x.transpose(1, 2).contiguous() \
                 .view(batch_size, -1, head_count * dim_per_head)
 
+        query, key, value = [shape(x) for x in self.project(key, value, query)]
+        dropout_p = self.dropout.p if self.training else 0.0
+        if causal:
+            # padding only ever follows the valid utterances, so under the causal mask the
+            # valid queries never reach a padded key and the padding mask can be dropped
+            context = F.scaled_dot_product_attention(query, key, value, dropout_p=dropout_p, is_causal=True)
+        else:
+            attn_mask = None if mask is None else ~mask.unsqueeze(1)  # [batch_size, 1, 1, key_len]
+            context = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=dropout_p)
+        return self.linear(unshape(context))
+
+    def reference_forward(self, key, value, query, mask=None):
+        batch_size = key.size(0)
+        dim_per_head = self.dim_per_head
+        head_count = self.head_count
+
         key = self.linear_k(key).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
         value = self.linear_v(value).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
         query = self.linear_q(query).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
@@ -106,57 +218,205 @@ class MultiHeadedAttention(nn.Module):
         output = self.linear(context)
         return output
 
+    '''/
+    long-context attention over blocks of `window` utterances: an utterance attends to the
+    utterances of its own block and of the previous one (causal: only up to itself; otherwise
+    also the next block), so every utterance sees at most 2-3 windows of keys and time and
+    memory grow linearly with the dialogue length. With summary, the mean of the keys and
+    values of all earlier utterances (and, without the causal mask, of all later ones) is one
+    more key and value, computed for every block with a cumulative sum. With relative, the
+    scores get an ALiBi bias of -slope * distance per head instead of absolute positions
+    /'''
+    def windowed_forward(self, key, value, query, mask, causal):
+        batch_size, seq_len = query.size(0), query.size(1)
+        head_count, dim_per_head, window = self.head_count, self.dim_per_head, self.window
+        n_blocks = -(-seq_len // window)
+        padding = n_blocks * window - seq_len
+
+        def blocks(x):
+            # [batch_size, seq_len, model_dim] -> [batch_size, head_count, n_blocks, window, dim_per_head]
+            x = F.pad(x.view(batch_size, seq_len, head_count, dim_per_head).transpose(1, 2), (0, 0, 0, padding))
+            return x.view(batch_size, head_count, n_blocks, window, dim_per_head)
+        query, key, value = [blocks(x) for x in self.project(key, value, query)]
+        valid = torch.ones(batch_size, seq_len, dtype=torch.bool, device=query.device) if mask is None else ~mask.view(batch_size, seq_len)
+        valid = F.pad(valid, (0, padding)).view(batch_size, n_blocks, window)
+
+        # keys and values of the previous, own (and next) block of every block
+        shifts = [-1, 0] if causal else [-1, 0, 1]
+        keys = torch.cat([shift_blocks(key, s, 2) for s in shifts], 3)
+        values = torch.cat([shift_blocks(value, s, 2) for s in shifts], 3)
+        key_valid = torch.cat([shift_blocks(valid, s, 1) for s in shifts], 2)
+        positions = torch.arange(n_blocks * window, device=query.device).view(n_blocks, window)
+        query_pos = positions.unsqueeze(-1)                                               # [n_blocks, window, 1]
+        key_pos = torch.cat([positions + s * window for s in shifts], 1).unsqueeze(1)     # [n_blocks, 1, keys]
+        allowed = key_valid.view(batch_size, 1, n_blocks, 1, -1)
+        if causal:
+            allowed = allowed & (key_pos <= query_pos)
+        # every utterance sees itself, so no row is fully masked (padded queries included)
+        allowed = allowed | (key_pos == query_pos)
+        allowed = allowed.expand(batch_size, 1, n_blocks, window, keys.size(3))
+        distance = (query_pos - key_pos).abs().float().expand(n_blocks, window, keys.size(3))
+
+        if self.summary:
+            weights = valid.view(batch_size, 1, n_blocks, window, 1).to(key.dtype)
+            sums = [(x * weights).sum(3) for x in (key, value)] + [valid.sum(2).view(batch_size, 1, n_blocks).to(key.dtype)]
+            totals = [x.cumsum(2) for x in sums]
+            # block b summarises blocks < b-1 (the ones before its window) and, without the causal mask, blocks > b+1
+            slots = [[shift_blocks(x, -2, 2) for x in totals]]
+            if not causal:
+                slots.append([x[:, :, -1:] - shift_blocks(x, 1, 2, fill=x[:, :, -1:]) for x in totals])
+            for (key_sum, value_sum, count), edge in zip(slots, [-window - 1, 2 * window]):
+                keys = torch.cat([keys, (key_sum / count.clamp(min=1).unsqueeze(-1)).unsqueeze(3)], 3)
+                values = torch.cat([values, (value_sum / count.clamp(min=1).unsqueeze(-1)).unsqueeze(3)], 3)
+                seen = (count > 0).view(batch_size, 1, n_blocks, 1, 1).expand(batch_size, 1, n_blocks, window, 1)
+                allowed = torch.cat([allowed, seen], 4)
+                # the summary sits just outside the window
+                edge_pos = (positions[:, :1] + edge).unsqueeze(-1)
+                distance = torch.cat([distance, (query_pos - edge_pos).abs().float()], 2)
+
+        bias = -self.slopes.view(-1, 1, 1, 1) * distance if self.relative else None       # [head_count, n_blocks, window, keys]
+        dropout_p = self.dropout.p if self.training else 0.0
+        if self.attention == 'fused':
+            attn_mask = allowed if bias is None else bias.masked_fill(~allowed, float('-inf'))
+            context = F.scaled_dot_product_attention(query, keys, values, attn_mask=attn_mask, dropout_p=dropout_p)
+        else:
+            scores = torch.matmul(query / math.sqrt(dim_per_head), keys.transpose(-1, -2))
+            if bias is not None:
+                scores = scores + bias
+            scores = scores.masked_fill(~allowed, -1e10)
+            context = torch.matmul(self.dropout(self.softmax(scores)), values)
+        context = context.reshape(batch_size, head_count, n_blocks * window, dim_per_head)[:, :, :seq_len]
+        return self.linear(context.transpose(1, 2).contiguous().view(batch_size, seq_len, head_count * dim_per_head))
+
+    def windowed_step(self, key, value, query, cache):
+        """ step() in the long-context mode: the cache keeps the current and the previous block and the summary of older utterances """
+        batch_size, dim_per_head, window = key.size(0), self.dim_per_head, self.window
+        shape = lambda x: x.view(batch_size, -1, self.head_count, dim_per_head).transpose(1, 2)
+        query, key, value = [shape(x) for x in self.project(key, value, query)]
+        pos = cache.get('pos', 0)
+        if 'k' in cache:
+            key = torch.cat([cache['k'], key], dim=2)
+            value = torch.cat([cache['v'], value], dim=2)
+        # evict the block that left the window into the summary
+        first = max(0, (pos // window - 1) * window)
+        evicted = first - (pos + 1 - key.size(2))
+        if evicted > 0:
+            if self.summary:
+                cache['key_sum'] = cache.get('key_sum', 0) + key[:, :, :evicted].sum(2, keepdim=True)
+                cache['value_sum'] = cache.get('value_sum', 0) + value[:, :, :evicted].sum(2, keepdim=True)
+                cache['count'] = cache.get('count', 0) + evicted
+            key, value = key[:, :, evicted:], value[:, :, evicted:]
+        cache['k'], cache['v'], cache['pos'] = key, value, pos + 1
+
+        distance = torch.arange(pos - first, -1, -1, device=query.device, dtype=torch.float)
+        if cache.get('count'):
+            key = torch.cat([key, cache['key_sum'] / cache['count']], dim=2)
+            value = torch.cat([value, cache['value_sum'] / cache['count']], dim=2)
+            distance = torch.cat([distance, distance.new_tensor([pos - first + 1])])
+        scores = torch.matmul(query / math.sqrt(dim_per_head), key.transpose(2, 3))
+        if self.relative:
+            scores = scores - self.slopes.view(-1, 1, 1) * distance
+        context = torch.matmul(self.softmax(scores), value).transpose(1, 2).contiguous().view(batch_size, -1, self.model_dim)
+        return self.linear(context)
+
+    def step(self, key, value, query, cache):
+        """  attend one new query over the cached keys/values plus the new ones """
+        if self.window:
+            return self.windowed_step(key, value, query, cache)
+        batch_size = key.size(0)
+        dim_per_head = self.dim_per_head
+        head_count = self.head_count
+
+        key = self.linear_k(key).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
+        value = self.linear_v(value).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
+        query = self.linear_q(query).view(batch_size, -1, head_count, dim_per_head).transpose(1, 2)
+        if 'k' in cache:
+            key = torch.cat([cache['k'], key], dim=2)
+            value = torch.cat([cache['v'], value], dim=2)
+        cache['k'], cache['v'] = key, value
 
+        query = query / math.sqrt(dim_per_head)
+        scores = torch.matmul(query, key.transpose(2, 3))
+        attn = self.softmax(scores)
+        context = torch.matmul(attn, value).transpose(1, 2).\
+                    contiguous().view(batch_size, -1, head_count * dim_per_head)
+        output = self.linear(context)
+        return output
+
+
+def sinusoids(start, end, dim, device=None):
+    """ rows start..end-1 of the sinusoidal position table """
+    pe = torch.zeros(end - start, dim, device=device)
+    position = torch.arange(start, end, device=device).unsqueeze(1)
+    div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float, device=device) *
+                          -(math.log(10000.0) / dim)))
+    pe[:, 0::2] = torch.sin(position.float() * div_term)
+    pe[:, 1::2] = torch.cos(position.float() * div_term)
+    return pe
+
+
+'''/
+the first max_len positions are precomputed, later ones (dialogues longer than max_len) are
+computed on the fly. With relative positions (the long-context mode) the attention carries
+the positions and only the speaker embedding is added
+/'''
 class PositionalEncoding(nn.Module):
-    def __init__(self, dim, max_len=512):
+    def __init__(self, dim, max_len=512, relative=False):
         super(PositionalEncoding, self).__init__()
-        pe = torch.zeros(max_len, dim)
-        position = torch.arange(0, max_len).unsqueeze(1)
-        div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float) *
-                              -(math.log(10000.0) / dim)))
-        pe[:, 0::2] = torch.sin(position.float() * div_term)
-        pe[:, 1::2] = torch.cos(position.float() * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
-    def forward(self, x, speaker_emb):
-        L = x.size(1)
-        pos_emb = self.pe[:, :L]
+        self.relative = relative
+        self.register_buffer('pe', sinusoids(0, max_len, dim).unsqueeze(0))
+    def forward(self, x, speaker_emb, offset=0):
+        if self.relative:
+            return x + speaker_emb
+        L = x.size(-2)
+        pos_emb = self.pe[:, offset:offset+L]
+        if offset + L > self.pe.size(1):
+            extra = sinusoids(max(offset, self.pe.size(1)), offset + L, self.pe.size(2), self.pe.device)
+            pos_emb = torch.cat([pos_emb, extra.unsqueeze(0).to(self.pe.dtype)], 1)
         x = x + pos_emb + speaker_emb
         return x
 
 
 class TransformerEncoderLayer(nn.Module):
-    def __init__(self, d_model, heads, d_ff, dropout):
+    def __init__(self, d_model, heads, d_ff, dropout, attention=DEFAULT_ATTENTION, window=None, summary=False, relative=False):
         super(TransformerEncoderLayer, self).__init__()
         self.self_attn = MultiHeadedAttention(
-            heads, d_model, dropout=dropout)
+            heads, d_model, dropout=dropout, attention=attention, window=window, summary=summary, relative=relative)
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff, dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
 
+    # inputs_a is None (or inputs_b itself) for intra-modal attention
     def forward(self, iter, inputs_a, inputs_b, mask, setting):
-        if inputs_a.equal(inputs_b):
+        if inputs_a is None or inputs_a is inputs_b:
             if (iter != 0):
                 inputs_b = self.layer_norm(inputs_b)
             else:
                 inputs_b = inputs_b
 
-            #Ritesh: just fixing dimensional inconsistencies that occured coz of casual masking
-            if setting != 'realtime':
-                mask = mask.unsqueeze(1)
-            context = self.self_attn(inputs_b, inputs_b, inputs_b, mask=mask)
+            context = self.self_attn(inputs_b, inputs_b, inputs_b, mask=mask.unsqueeze(1),
+                                     causal=setting == 'realtime')
         else:
             if (iter != 0):
                 inputs_b = self.layer_norm(inputs_b)
             else:
                 inputs_b = inputs_b
 
-            if setting != 'realtime':
-                mask = mask.unsqueeze(1)
-            context = self.self_attn(inputs_a, inputs_a, inputs_b, mask=mask)
+            context = self.self_attn(inputs_a, inputs_a, inputs_b, mask=mask.unsqueeze(1),
+                                     causal=setting == 'realtime')
         
         out = self.dropout(context) + inputs_b
         return self.feed_forward(out)
+
+    def step(self, iter, inputs_a, inputs_b, cache):
+        if (iter != 0):
+            inputs_b = self.layer_norm(inputs_b)
+        if inputs_a is None:
+            context = self.self_attn.step(inputs_b, inputs_b, inputs_b, cache)
+        else:
+            context = self.self_attn.step(inputs_a, inputs_a, inputs_b, cache)
+        out = self.dropout(context) + inputs_b
+        return self.feed_forward(out)
 '''/
 Ritesh 
 Function for making casual mask
@@ -166,35 +426,36 @@ def generate_causal_mask(size, device):
 
 
 class TransformerEncoder(nn.Module):
-    def __init__(self, d_model, d_ff, heads, layers, dropout=0.1):
+    def __init__(self, d_model, d_ff, heads, layers, dropout=0.1, attention=DEFAULT_ATTENTION, self_attention=None,
+                 window=None, summary=False, relative=False):
         super(TransformerEncoder, self).__init__()
         self.d_model = d_model
         self.layers = layers
-        self.pos_emb = PositionalEncoding(d_model)
+        # intra- (True) or inter-modal (False) attention, fixed at construction; None compares the inputs
+        self.self_attention = self_attention
+        self.pos_emb = PositionalEncoding(d_model, relative=relative)
         self.transformer_inter = nn.ModuleList(
-            [TransformerEncoderLayer(d_model, heads, d_ff, dropout)
+            [TransformerEncoderLayer(d_model, heads, d_ff, dropout, attention, window, summary, relative)
              for _ in range(layers)])
         self.dropout = nn.Dropout(dropout)
+        self.checkpoint = False
+
+    def forward(self, x_a, x_b, mask, speaker_emb, setting):
+        return checkpointed(self, self.encode, x_a, x_b, mask, speaker_emb, setting)
 
     '''/Ritesh
     have designed and applied a casual mask for each batch so that to attention is given only to past utterances 
+    (the padding mask is passed down as is, the attention combines it with the causal mask)
     /'''
-    def forward(self, x_a, x_b, mask, speaker_emb, setting):
-        device = x_a.device
-        batch_size, seq_len , _ = x_a.size()
-        if setting =='realtime':
-            causal_mask = generate_causal_mask(seq_len, device)
-            padding_mask = mask.unsqueeze(1).to(device).bool()  # Shape: [batch_size, 1, seq_len]
-            combined_mask = causal_mask.unsqueeze(0) & padding_mask  # Shape: [batch_size, seq_len, seq_len]
-            inverted_mask = combined_mask.eq(0)
-        else:
-            inverted_mask = mask.eq(0)
-        
-        if x_a.equal(x_b):
+    def encode(self, x_a, x_b, mask, speaker_emb, setting):
+        inverted_mask = mask.eq(0)
+        self_attention = x_a.equal(x_b) if self.self_attention is None else self.self_attention
+
+        if self_attention:
             x_b = self.pos_emb(x_b, speaker_emb)
             x_b = self.dropout(x_b)
             for i in range(self.layers):
-                x_b = self.transformer_inter[i](i, x_b, x_b, inverted_mask, setting)
+                x_b = self.transformer_inter[i](i, None, x_b, inverted_mask, setting)
         else:
             x_a = self.pos_emb(x_a, speaker_emb)
             x_a = self.dropout(x_a)
@@ -204,6 +465,194 @@ class TransformerEncoder(nn.Module):
                 x_b = self.transformer_inter[i](i, x_a, x_b, inverted_mask, setting)
         return x_b
 
+    '''/
+    one utterance of the realtime setting: x_a and x_b are [batch_size, 1, d_model], pos is
+    the index of the utterance in the dialogue and cache holds one dict of keys/values per layer.
+    Under the causal mask every earlier utterance is visible, so no mask is needed here; with a
+    window the cache only keeps the visible utterances (and the summary of the older ones)
+    /'''
+    def step(self, x_a, x_b, speaker_emb, pos, cache):
+        if not cache:
+            cache.extend({} for _ in range(self.layers))
+        self_attention = x_a is x_b if self.self_attention is None else self.self_attention
+        if self_attention:
+            x_b = self.dropout(self.pos_emb(x_b, speaker_emb, pos))
+            for i in range(self.layers):
+                x_b = self.transformer_inter[i].step(i, None, x_b, cache[i])
+        else:
+            x_a = self.dropout(self.pos_emb(x_a, speaker_emb, pos))
+            x_b = self.dropout(self.pos_emb(x_b, speaker_emb, pos))
+            for i in range(self.layers):
+                x_b = self.transformer_inter[i].step(i, x_a, x_b, cache[i])
+        return x_b
+
+
+'''/
+Grouped execution of several TransformerEncoders with identical shapes (e.g. the nine
+intra- and inter-modal encoders). Their weights are stacked along a leading group
+dimension and every attention and feed-forward block runs as one batched matmul over all
+groups. The submodules mirror TransformerEncoder (transformer_inter.<i>.self_attn.linear_q, ...)
+so group_state_dict/ungroup_state_dict convert to and from the per-module parameters
+/'''
+class GroupedLinear(nn.Module):
+    def __init__(self, groups, in_features, out_features):
+        super(GroupedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(groups, out_features))
+        # same initialisation as one nn.Linear per group
+        for g in range(groups):
+            nn.init.kaiming_uniform_(self.weight[g], a=math.sqrt(5))
+            nn.init.uniform_(self.bias[g], -1 / math.sqrt(in_features), 1 / math.sqrt(in_features))
+
+    def forward(self, x, weight=None, bias=None):
+        # x: [groups, ..., in_features]
+        weight = self.weight if weight is None else weight
+        bias = self.bias if bias is None else bias
+        out = torch.baddbmm(bias.unsqueeze(1), x.reshape(x.size(0), -1, x.size(-1)), weight.transpose(1, 2))
+        return out.view(x.shape[:-1] + (weight.size(1),))
+
+
+class GroupedLayerNorm(nn.Module):
+    def __init__(self, groups, d_model, eps=1e-6):
+        super(GroupedLayerNorm, self).__init__()
+        self.weight = nn.Parameter(torch.ones(groups, d_model))
+        self.bias = nn.Parameter(torch.zeros(groups, d_model))
+        self.eps = eps
+
+    def forward(self, x):
+        shape = (x.size(0),) + (1,) * (x.dim() - 2) + (x.size(-1),)
+        return F.layer_norm(x, x.shape[-1:], eps=self.eps) * self.weight.view(shape) + self.bias.view(shape)
+
+
+class GroupedPositionwiseFeedForward(nn.Module):
+    def __init__(self, groups, d_model, d_ff, dropout=0.1):
+        super(GroupedPositionwiseFeedForward, self).__init__()
+        self.w_1 = GroupedLinear(groups, d_model, d_ff)
+        self.w_2 = GroupedLinear(groups, d_ff, d_model)
+        self.layer_norm = GroupedLayerNorm(groups, d_model, eps=1e-6)
+        self.actv = gelu
+        self.dropout_1 = nn.Dropout(dropout)
+        self.dropout_2 = nn.Dropout(dropout)
+        self.checkpoint = False
+
+    def forward(self, x):
+        return checkpointed(self, self.feed_forward, x)
+
+    def feed_forward(self, x):
+        inter = self.dropout_1(self.actv(self.w_1(self.layer_norm(x))))
+        output = self.dropout_2(self.w_2(inter))
+        return output + x
+
+
+class GroupedMultiHeadedAttention(nn.Module):
+    def __init__(self, groups, head_count, model_dim, dropout=0.1, attention=DEFAULT_ATTENTION):
+        assert model_dim % head_count == 0
+        assert attention in ATTENTION_BACKENDS
+        super(GroupedMultiHeadedAttention, self).__init__()
+        self.dim_per_head = model_dim // head_count
+        self.head_count = head_count
+        self.attention = attention
+
+        self.linear_k = GroupedLinear(groups, model_dim, model_dim)
+        self.linear_v = GroupedLinear(groups, model_dim, model_dim)
+        self.linear_q = GroupedLinear(groups, model_dim, model_dim)
+        self.softmax = nn.Softmax(dim=-1)
+        self.dropout = nn.Dropout(dropout)
+        self.linear = GroupedLinear(groups, model_dim, model_dim)
+
+    def forward(self, key_value, query, mask, causal):
+        # key_value, query: [groups, batch_size, seq_len, model_dim], mask: [batch_size, seq_len] True for padding
+        groups, batch_size, seq_len, _ = query.size()
+        dim_per_head = self.dim_per_head
+        head_count = self.head_count
+
+        def shape(x):
+            return x.view(groups * batch_size, seq_len, head_count, dim_per_head).transpose(1, 2)
+
+        weight = torch.cat([self.linear_k.weight, self.linear_v.weight], dim=1)
+        bias = torch.cat([self.linear_k.bias, self.linear_v.bias], dim=1)
+        key, value = self.linear_k(key_value, weight, bias).chunk(2, dim=-1)
+        query, key, value = shape(self.linear_q(query)), shape(key), shape(value)
+
+        mask = mask.unsqueeze(0).expand(groups, -1, -1).reshape(groups * batch_size, 1, 1, seq_len)
+        if self.attention == 'fused':
+            dropout_p = self.dropout.p if self.training else 0.0
+            if causal:
+                # see MultiHeadedAttention.fused_forward
+                context = F.scaled_dot_product_attention(query, key, value, dropout_p=dropout_p, is_causal=True)
+            else:
+                context = F.scaled_dot_product_attention(query, key, value, attn_mask=~mask, dropout_p=dropout_p)
+        else:
+            if causal:
+                mask = mask | ~generate_causal_mask(seq_len, query.device)
+            scores = torch.matmul(query / math.sqrt(dim_per_head), key.transpose(2, 3))
+            scores = scores.masked_fill(mask, -1e10)
+            context = torch.matmul(self.dropout(self.softmax(scores)), value)
+        context = context.transpose(1, 2).contiguous().view(groups, batch_size, seq_len, head_count * dim_per_head)
+        return self.linear(context)
+
+
+class GroupedTransformerEncoderLayer(nn.Module):
+    def __init__(self, groups, d_model, heads, d_ff, dropout, attention=DEFAULT_ATTENTION):
+        super(GroupedTransformerEncoderLayer, self).__init__()
+        self.self_attn = GroupedMultiHeadedAttention(groups, heads, d_model, dropout=dropout, attention=attention)
+        self.feed_forward = GroupedPositionwiseFeedForward(groups, d_model, d_ff, dropout)
+        self.layer_norm = GroupedLayerNorm(groups, d_model, eps=1e-6)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, iter, inputs_a, inputs_b, is_self, mask, setting):
+        if (iter != 0):
+            inputs_b = self.layer_norm(inputs_b)
+        # intra-modal groups attend over their own (normalised) input, inter-modal ones over the other modality
+        key_value = torch.where(is_self.view(-1, 1, 1, 1), inputs_b, inputs_a)
+        context = self.self_attn(key_value, inputs_b, mask, causal=setting == 'realtime')
+        out = self.dropout(context) + inputs_b
+        return self.feed_forward(out)
+
+
+class GroupedTransformerEncoder(nn.Module):
+    def __init__(self, names, d_model, d_ff, heads, layers, dropout=0.1, attention=DEFAULT_ATTENTION):
+        super(GroupedTransformerEncoder, self).__init__()
+        # names like 'a_t': source modality a attended from target modality t
+        self.names = list(names)
+        self.layers = layers
+        self.pos_emb = PositionalEncoding(d_model)
+        self.transformer_inter = nn.ModuleList(
+            [GroupedTransformerEncoderLayer(len(self.names), d_model, heads, d_ff, dropout, attention)
+             for _ in range(layers)])
+        self.dropout = nn.Dropout(dropout)
+        is_self = [name.split('_')[0] == name.split('_')[1] for name in self.names]
+        self.register_buffer('is_self', torch.tensor(is_self), persistent=False)
+        self.checkpoint = False
+
+    def forward(self, x_a, x_b, mask, speaker_emb, setting):
+        return checkpointed(self, self.encode, x_a, x_b, mask, speaker_emb, setting)
+
+    def encode(self, x_a, x_b, mask, speaker_emb, setting):
+        # x_a, x_b: lists with one [batch_size, seq_len, d_model] input per group, in the order of names
+        inverted_mask = mask.eq(0)
+        x_a = self.dropout(self.pos_emb(torch.stack(x_a), speaker_emb))
+        x_b = self.dropout(self.pos_emb(torch.stack(x_b), speaker_emb))
+        for i in range(self.layers):
+            x_b = self.transformer_inter[i](i, x_a, x_b, self.is_self, inverted_mask, setting)
+        return x_b.unbind(0)
+
+    def group_state_dict(self, state_dict, prefix, grouped_prefix):
+        """  stack the per-module entries prefix+'<name>.' into grouped_prefix (in place) """
+        for key in [k for k in self.state_dict() if k != 'pos_emb.pe']:
+            state_dict[grouped_prefix+key] = torch.stack([state_dict.pop(prefix+name+'.'+key) for name in self.names])
+        for name in self.names:
+            state_dict[grouped_prefix+'pos_emb.pe'] = state_dict.pop(prefix+name+'.pos_emb.pe')
+
+    def ungroup_state_dict(self, state_dict, prefix, grouped_prefix):
+        """  inverse of group_state_dict """
+        for key in [k for k in self.state_dict() if k != 'pos_emb.pe']:
+            for name, value in zip(self.names, state_dict.pop(grouped_prefix+key).unbind(0)):
+                state_dict[prefix+name+'.'+key] = value
+        pe = state_dict.pop(grouped_prefix+'pos_emb.pe')
+        for name in self.names:
+            state_dict[prefix+name+'.pos_emb.pe'] = pe
+
 
 class Unimodal_GatedFusion(nn.Module):
     def __init__(self, hidden_size, dataset):
@@ -218,6 +667,17 @@ class Unimodal_GatedFusion(nn.Module):
         final_rep = z * a
         return final_rep
 
+'''/
+reduced precision: bf16 autocasts the encoders, fusion and heads while the
+losses and the softmax/log_softmax outputs of the model stay in fp32
+/'''
+PRECISIONS = ['fp32', 'bf16']
+
+
+def autocast(device, precision):
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
 '''/
 Ritesh:
 have made three Multimodal_GatedFusion functions used for different modalities
@@ -290,211 +750,214 @@ class CausalConv1d(nn.Module):
         # Apply the convolution
         return self.conv1d(x_padded)
 
+    def step(self, x, history):
+        # x: [batch_size, in_channels, 1], history: last kernel_size-1 inputs or None
+        if history is None:
+            history = x.new_zeros(x.size(0), x.size(1), self.kernel_size - 1)
+        x_padded = torch.cat([history, x], dim=-1)
+        return self.conv1d(x_padded), x_padded[:, :, 1:]
+
+'''/
+Ritesh:
+encoders and heads actually used by each modality. For every target modality the
+intra-modal encoder comes first, followed by the inter-modal ones in t, a, v order,
+which is the order their outputs are concatenated before features_reduce_*
+/'''
+MODALITIES = ['t', 'a', 'at', 'atv']
+
+
+def modality_encoders(modality):
+    used = [m for m in 'tav' if m in modality]
+    return [(m, [m] + [src for src in used if src != m]) for m in used]
+
+
 class Transformer_Based_Model(nn.Module):
     def __init__(self, dataset, temp, D_text, D_visual, D_audio, n_head,
-                 n_classes, hidden_dim, n_speakers, dropout):
+                 n_classes, hidden_dim, n_speakers, dropout, modality='atv', attention=DEFAULT_ATTENTION,
+                 grouped=False, setting='original', window=None, summary=False, positions='absolute'):
         super(Transformer_Based_Model, self).__init__()
+        assert modality in MODALITIES
+        assert positions in POSITIONS
+        assert window or (not summary and positions == 'absolute'), 'summary slots and relative positions need a window'
+        assert not (window and grouped), 'the long-context mode runs ungrouped'
         self.temp = temp
         self.n_classes = n_classes
         self.n_speakers = n_speakers
+        # modality and setting are fixed at construction, so forward has no data-dependent branches
+        self.modality = modality
+        self.setting = setting
+        # long-context mode (MultiHeadedAttention.windowed_forward): attention windows of `window` utterances
+        self.window = window
+        self.encoders = modality_encoders(modality)
         if self.n_speakers == 2:
             padding_idx = 2
         if self.n_speakers == 9:
             padding_idx = 9
         self.speaker_embeddings = nn.Embedding(n_speakers+1, hidden_dim, padding_idx)
-        
-        # Temporal convolutional layers(original)
-        self.textf_input = nn.Conv1d(D_text, hidden_dim, kernel_size=1, padding=0, bias=False)
-        self.acouf_input= nn.Conv1d(D_audio, hidden_dim, kernel_size=1, padding=0, bias=False)
-        self.visuf_input = nn.Conv1d(D_visual, hidden_dim, kernel_size=1, padding=0, bias=False)
-        
-        # Intra- and Inter-modal Transformers
-        self.t_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.a_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.v_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
 
-        self.a_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.t_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.v_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-
-        self.v_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.t_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.a_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        
-        # Unimodal-level Gated Fusion
-        self.t_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.a_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.v_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        self.a_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.t_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.v_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        self.v_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.t_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.a_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        # One modality only
-        self.features_reduce_t = nn.Linear(hidden_dim, hidden_dim)  
-        self.features_reduce_a = nn.Linear(hidden_dim, hidden_dim)
-        self.features_reduce_v = nn.Linear(hidden_dim, hidden_dim)
-
-        # For 'at' modality
-        self.features_reduce_t_AT = nn.Linear(2*hidden_dim, hidden_dim)  
-        self.features_reduce_a_AT = nn.Linear(2*hidden_dim, hidden_dim)   
-
-        # One 'atv' modality
-        self.features_reduce_t_ATV = nn.Linear(3*hidden_dim, hidden_dim)  
-        self.features_reduce_a_ATV = nn.Linear(3*hidden_dim, hidden_dim)
-        self.features_reduce_v_ATV = nn.Linear(3*hidden_dim, hidden_dim)
+        # Temporal convolutional layers, only for the modalities in use
+        input_dims = {'t': D_text, 'a': D_audio, 'v': D_visual}
+        input_names = {'t': 'textf_input', 'a': 'acouf_input', 'v': 'visuf_input'}
+        for m, _ in self.encoders:
+            setattr(self, input_names[m], self.build_input(input_dims[m], hidden_dim))
+
+        # Intra- and Inter-modal Transformers followed by Unimodal-level Gated Fusion
+        # (grouped: all encoders in one batched module, saved and loaded as the per-module parameters)
+        self.grouped = grouped
+        if grouped:
+            self.encoder_group = GroupedTransformerEncoder([src+'_'+m for m, sources in self.encoders for src in sources],
+                                                           d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1,
+                                                           dropout=dropout, attention=attention)
+            self._register_state_dict_hook(Transformer_Based_Model.ungroup_encoders)
+            self._register_load_state_dict_pre_hook(self.group_encoders)
+        for m, sources in self.encoders:
+            for src in sources:
+                if not grouped:
+                    setattr(self, src+'_'+m, TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout,
+                                                                      attention=attention, self_attention=src == m, window=window,
+                                                                      summary=summary, relative=positions == 'relative'))
+                setattr(self, src+'_'+m+'_gate', Unimodal_GatedFusion(hidden_dim, dataset))
+
+        # features_reduce_t / _t_AT / _t_ATV depending on the number of modalities
+        suffix = {1: '', 2: '_AT', 3: '_ATV'}[len(self.encoders)]
+        for m, sources in self.encoders:
+            setattr(self, 'features_reduce_'+m+suffix, nn.Linear(len(sources)*hidden_dim, hidden_dim))
 
         # Multimodal-level Gated Fusion for single, double and triple modality
-        self.last_gate_one= Multimodal_GatedFusion_one(hidden_dim)
-        self.last_gate_two= Multimodal_GatedFusion_two(hidden_dim)
-        self.last_gate_three= Multimodal_GatedFusion_three(hidden_dim)
+        if len(self.encoders) == 1:
+            self.last_gate_one = Multimodal_GatedFusion_one(hidden_dim)
+        elif len(self.encoders) == 2:
+            self.last_gate_two = Multimodal_GatedFusion_two(hidden_dim)
+        else:
+            self.last_gate_three = Multimodal_GatedFusion_three(hidden_dim)
 
         # Emotion Classifier
-        self.t_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
-        self.a_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
-        self.v_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
+        for m, _ in self.encoders:
+            setattr(self, m+'_output_layer', nn.Sequential(
+                nn.ReLU(),
+                nn.Dropout(dropout),
+                nn.Linear(hidden_dim, n_classes)
+                ))
         self.all_output_layer = nn.Linear(hidden_dim, n_classes)
 
-    def forward(self, textf, visuf, acouf, u_mask, qmask, dia_len, modality, setting):
-        spk_idx = torch.argmax(qmask, -1)
-        origin_spk_idx = spk_idx
-        if self.n_speakers == 2:
-            for i, x in enumerate(dia_len):
-                spk_idx[i, x:] = (2*torch.ones(origin_spk_idx[i].size(0)-x)).int().cuda()
-        if self.n_speakers == 9:
-            for i, x in enumerate(dia_len):
-                spk_idx[i, x:] = (9*torch.ones(origin_spk_idx[i].size(0)-x)).int().cuda()
+    def build_input(self, in_dim, hidden_dim):
+        return nn.Conv1d(in_dim, hidden_dim, kernel_size=1, padding=0, bias=False)
+
+    @staticmethod
+    def project_input(layer, x):
+        # x: [seq_len, batch_size, D]. The kernel_size 1 convolution is the same linear map at every
+        # utterance, so it runs as one matmul on [batch_size, seq_len, D] instead of permute, conv1d
+        # and transpose (the strided conv output also made torch.compile specialise on seq_len)
+        if not isinstance(layer, (nn.Conv1d, CausalConv1d)):
+            # the convolution replaced by an (int8) Linear, see quantize.py
+            return layer(x.transpose(0, 1))
+        conv = layer.conv1d if isinstance(layer, CausalConv1d) else layer
+        assert conv.kernel_size == (1,)
+        return F.linear(x.transpose(0, 1), conv.weight.squeeze(-1), conv.bias)
+
+    @staticmethod
+    def ungroup_encoders(module, state_dict, prefix, local_metadata):
+        module.encoder_group.ungroup_state_dict(state_dict, prefix, prefix+'encoder_group.')
+
+    def group_encoders(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        if prefix+self.encoder_group.names[0]+'.pos_emb.pe' in state_dict:
+            self.encoder_group.group_state_dict(state_dict, prefix, prefix+'encoder_group.')
+
+    def encoder_names(self, group='all'):
+        """ the encoders (src_m) of a group: all, intra, inter, the encoders of a modality (t, a, v) or one encoder (e.g. a_t) """
+        names = [src+'_'+m for m, sources in self.encoders for src in sources]
+        if group in ('intra', 'inter'):
+            return [name for name in names if (name.split('_')[0] == name.split('_')[1]) == (group == 'intra')]
+        if group in ('t', 'a', 'v'):
+            return [name for name in names if name.endswith('_'+group)]
+        assert group == 'all' or group in names, 'no encoder group {} in modality {}'.format(group, self.modality)
+        return names if group == 'all' else [group]
+
+    def set_checkpointing(self, spec):
+        '''/
+        activation checkpointing of the encoders (train.py --activation-checkpointing): spec is a
+        comma-separated list of encoder groups (see encoder_names), each optionally with :ffn to
+        recompute only the feed-forward blocks instead of the whole encoder, e.g. 'inter', 't,a:ffn'
+        or 'all:ffn'. The grouped encoders run as one module, so they are checkpointed all or none.
+        Only the inputs of a checkpointed module are kept for backward; the intermediate
+        activations (including the attention probabilities of the reference backend) are recomputed
+        /'''
+        modules = [self.encoder_group] if self.grouped else [getattr(self, name) for name in self.encoder_names()]
+        for encoder in modules:
+            encoder.checkpoint = False
+            for layer in encoder.transformer_inter:
+                layer.feed_forward.checkpoint = False
+        for group in filter(None, (spec or '').split(',')):
+            group, _, level = group.partition(':')
+            assert level in ('', 'ffn'), 'unknown checkpointing level {}'.format(level)
+            names = self.encoder_names(group)
+            if self.grouped:
+                assert set(names) == set(self.encoder_group.names), 'the grouped encoders can only be checkpointed together (all)'
+            for encoder in ([self.encoder_group] if self.grouped else [getattr(self, name) for name in names]):
+                if level == 'ffn':
+                    for layer in encoder.transformer_inter:
+                        layer.feed_forward.checkpoint = True
+                else:
+                    encoder.checkpoint = True
+
+    def forward(self, textf, visuf, acouf, u_mask, qmask, dia_len=None, modality=None, setting=None):
+        assert modality in (None, self.modality) and setting in (None, self.setting)
+        modality, setting = self.modality, self.setting
+        # padded utterances get the padding speaker (n_speakers), on the device of the batch;
+        # dia_len is implied by u_mask and only kept for compatibility
+        spk_idx = torch.argmax(qmask, -1).masked_fill(u_mask == 0, self.n_speakers)
         spk_embeddings = self.speaker_embeddings(spk_idx)
 
         # Temporal convolutional layers
-        textf = self.textf_input(textf.permute(1, 2, 0)).transpose(1, 2)
-        acouf = self.acouf_input(acouf.permute(1, 2, 0)).transpose(1, 2)
-        visuf = self.visuf_input(visuf.permute(1, 2, 0)).transpose(1, 2)
+        features = {}
+        if 't' in modality:
+            features['t'] = self.project_input(self.textf_input, textf)
+        if 'a' in modality:
+            features['a'] = self.project_input(self.acouf_input, acouf)
+        if 'v' in modality:
+            features['v'] = self.project_input(self.visuf_input, visuf)
 
         # Intra- and Inter-modal Transformers
-        t_t_transformer_out = self.t_t(textf, textf, u_mask, spk_embeddings, setting)
-        a_t_transformer_out = self.a_t(acouf, textf, u_mask, spk_embeddings, setting)
-        v_t_transformer_out = self.v_t(visuf, textf, u_mask, spk_embeddings, setting)
-
-        a_a_transformer_out = self.a_a(acouf, acouf, u_mask, spk_embeddings, setting)
-        t_a_transformer_out = self.t_a(textf, acouf, u_mask, spk_embeddings, setting)
-        v_a_transformer_out = self.v_a(visuf, acouf, u_mask, spk_embeddings, setting)
-
-        v_v_transformer_out = self.v_v(visuf, visuf, u_mask, spk_embeddings, setting)
-        t_v_transformer_out = self.t_v(textf, visuf, u_mask, spk_embeddings, setting)
-        a_v_transformer_out = self.a_v(acouf, visuf, u_mask, spk_embeddings, setting)
+        if self.grouped:
+            outs = iter(self.encoder_group([features[src] for m, sources in self.encoders for src in sources],
+                                           [features[m] for m, sources in self.encoders for src in sources],
+                                           u_mask, spk_embeddings, setting))
+            encoded = [[next(outs) for src in sources] for m, sources in self.encoders]
+        else:
+            encoded = [[getattr(self, src+'_'+m)(features[src], features[m], u_mask, spk_embeddings, setting)
+                        for src in sources] for m, sources in self.encoders]
+        return self.fuse(encoded)
 
+    def fuse(self, encoded):
         # Unimodal-level Gated Fusion
-        t_t_transformer_out = self.t_t_gate(t_t_transformer_out)
-        a_t_transformer_out = self.a_t_gate(a_t_transformer_out)
-        v_t_transformer_out = self.v_t_gate(v_t_transformer_out)
-
-        a_a_transformer_out = self.a_a_gate(a_a_transformer_out)
-        t_a_transformer_out = self.t_a_gate(t_a_transformer_out)
-        v_a_transformer_out = self.v_a_gate(v_a_transformer_out)
-
-        v_v_transformer_out = self.v_v_gate(v_v_transformer_out)
-        t_v_transformer_out = self.t_v_gate(t_v_transformer_out)
-        a_v_transformer_out = self.a_v_gate(a_v_transformer_out)
-
-        if modality=='t':
-            t_transformer_out = self.features_reduce_t(t_t_transformer_out) 
-            all_transformer_out = self.last_gate_one(t_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-
-            return t_log_prob, all_log_prob, all_prob,\
-                   kl_t_log_prob, kl_all_prob
-
-        elif modality=='a':
-            a_transformer_out = self.features_reduce_a(a_a_transformer_out) 
-            all_transformer_out = self.last_gate_one(a_transformer_out) 
-
-            # Emotion Classifier
-            a_final_out = self.a_output_layer(a_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-            return a_log_prob, all_log_prob, all_prob,\
-                   kl_a_log_prob, kl_all_prob
-
-        elif modality=='at':
-            t_transformer_out = self.features_reduce_t_AT(torch.cat([t_t_transformer_out, a_t_transformer_out], dim=-1))
-            a_transformer_out = self.features_reduce_a_AT(torch.cat([a_a_transformer_out, t_a_transformer_out], dim=-1))
-            all_transformer_out = self.last_gate_two(t_transformer_out, a_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            a_final_out = self.a_output_layer(a_transformer_out) 
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-
-            return t_log_prob, a_log_prob, all_log_prob, all_prob, \
-               kl_t_log_prob, kl_a_log_prob , kl_all_prob
-
+        suffix = {1: '', 2: '_AT', 3: '_ATV'}[len(self.encoders)]
+        reduced = []
+        for (m, sources), outs in zip(self.encoders, encoded):
+            outs = [getattr(self, src+'_'+m+'_gate')(out) for src, out in zip(sources, outs)]
+            reduce = getattr(self, 'features_reduce_'+m+suffix)
+            reduced.append(reduce(torch.cat(outs, dim=-1) if len(outs) > 1 else outs[0]))
+
+        # Multimodal-level Gated Fusion
+        if len(reduced) == 1:
+            all_transformer_out = self.last_gate_one(reduced[0])
+        elif len(reduced) == 2:
+            all_transformer_out = self.last_gate_two(reduced[0], reduced[1])
         else:
-            t_transformer_out = self.features_reduce_t_ATV(torch.cat([t_t_transformer_out, a_t_transformer_out, v_t_transformer_out], dim=-1))
-            a_transformer_out = self.features_reduce_a_ATV(torch.cat([a_a_transformer_out, t_a_transformer_out, v_a_transformer_out], dim=-1))
-            v_transformer_out = self.features_reduce_v_ATV(torch.cat([v_v_transformer_out, t_v_transformer_out, a_v_transformer_out], dim=-1))
-            all_transformer_out = self.last_gate_three(t_transformer_out, a_transformer_out, v_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            a_final_out = self.a_output_layer(a_transformer_out)
-            v_final_out = self.v_output_layer(v_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
+            all_transformer_out = self.last_gate_three(reduced[0], reduced[1], reduced[2])
 
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            v_log_prob = F.log_softmax(v_final_out, 2)
+        # Emotion Classifier (the softmaxes always run in fp32, also under bf16 autocast)
+        final_outs = [getattr(self, m+'_output_layer')(out).float() for (m, _), out in zip(self.encoders, reduced)]
+        all_final_out = self.all_output_layer(all_transformer_out).float()
 
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
+        log_probs = [F.log_softmax(out, 2) for out in final_outs]
+        all_log_prob = F.log_softmax(all_final_out, 2)
+        all_prob = F.softmax(all_final_out, 2)
 
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_v_log_prob = F.log_softmax(v_final_out /self.temp, 2)
+        kl_log_probs = [F.log_softmax(out /self.temp, 2) for out in final_outs]
+        kl_all_prob = F.softmax(all_final_out /self.temp, 2)
 
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-
-            return t_log_prob, a_log_prob, v_log_prob, all_log_prob, all_prob, \
-               kl_t_log_prob, kl_a_log_prob, kl_v_log_prob, kl_all_prob
+        # (t, a, v log probs), all_log_prob, all_prob, (t, a, v kl log probs), kl_all_prob
+        return tuple(log_probs) + (all_log_prob, all_prob) + tuple(kl_log_probs) + (kl_all_prob,)
 
 '''/Ritesh
 This is the realtime model:
@@ -502,208 +965,63 @@ Changes:
 1. used casual convolution
 2. casual masking in TransformerEncoder
 /'''
-class Transformer_Based_Model_diverse(nn.Module):
-    def __init__(self, dataset, temp, D_text, D_visual, D_audio, n_head,
-                 n_classes, hidden_dim, n_speakers, dropout):
-        super(Transformer_Based_Model_diverse, self).__init__()
-        self.temp = temp
-        self.n_classes = n_classes
-        self.n_speakers = n_speakers
-        if self.n_speakers == 2:
-            padding_idx = 2
-        if self.n_speakers == 9:
-            padding_idx = 9
-        self.speaker_embeddings = nn.Embedding(n_speakers+1, hidden_dim, padding_idx)
-        
-        # Temporal convolutional layers(realtime)
-        self.textf_input = CausalConv1d(D_text, hidden_dim, kernel_size=1)
-        self.acouf_input = CausalConv1d(D_audio, hidden_dim, kernel_size=1)
-        self.visuf_input = CausalConv1d(D_visual, hidden_dim, kernel_size=1)
-
-        # Intra- and Inter-modal Transformers
-        self.t_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.a_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.v_t = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-
-        self.a_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.t_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.v_a = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-
-        self.v_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.t_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        self.a_v = TransformerEncoder(d_model=hidden_dim, d_ff=hidden_dim, heads=n_head, layers=1, dropout=dropout)
-        
-        # Unimodal-level Gated Fusion
-        self.t_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.a_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.v_t_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        self.a_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.t_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.v_a_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        self.v_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.t_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-        self.a_v_gate = Unimodal_GatedFusion(hidden_dim, dataset)
-
-        # One modality only
-        self.features_reduce_t = nn.Linear(hidden_dim, hidden_dim)  
-        self.features_reduce_a = nn.Linear(hidden_dim, hidden_dim)
-        self.features_reduce_v = nn.Linear(hidden_dim, hidden_dim)
+class Transformer_Based_Model_diverse(Transformer_Based_Model):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('setting', 'realtime')
+        super(Transformer_Based_Model_diverse, self).__init__(*args, **kwargs)
 
-        # For 'at' modality
-        self.features_reduce_t_AT = nn.Linear(2*hidden_dim, hidden_dim)  
-        self.features_reduce_a_AT = nn.Linear(2*hidden_dim, hidden_dim)   
-
-        # One 'atv' modality
-        self.features_reduce_t_ATV = nn.Linear(3*hidden_dim, hidden_dim)  
-        self.features_reduce_a_ATV = nn.Linear(3*hidden_dim, hidden_dim)
-        self.features_reduce_v_ATV = nn.Linear(3*hidden_dim, hidden_dim)
-
-        # Multimodal-level Gated Fusion for single, double and triple modality
-        self.last_gate_one= Multimodal_GatedFusion_one(hidden_dim)
-        self.last_gate_two= Multimodal_GatedFusion_two(hidden_dim)
-        self.last_gate_three= Multimodal_GatedFusion_three(hidden_dim)
-
-        # Emotion Classifier
-        self.t_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
-        self.a_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
-        self.v_output_layer = nn.Sequential(
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_dim, n_classes)
-            )
-        self.all_output_layer = nn.Linear(hidden_dim, n_classes)
-
-    def forward(self, textf, visuf, acouf, u_mask, qmask, dia_len, modality, setting):
-        spk_idx = torch.argmax(qmask, -1)
-        origin_spk_idx = spk_idx
-        if self.n_speakers == 2:
-            for i, x in enumerate(dia_len):
-                spk_idx[i, x:] = (2*torch.ones(origin_spk_idx[i].size(0)-x)).int().cuda()
-        if self.n_speakers == 9:
-            for i, x in enumerate(dia_len):
-                spk_idx[i, x:] = (9*torch.ones(origin_spk_idx[i].size(0)-x)).int().cuda()
-        spk_embeddings = self.speaker_embeddings(spk_idx)
+    def build_input(self, in_dim, hidden_dim):
+        # Temporal convolutional layers(realtime)
+        return CausalConv1d(in_dim, hidden_dim, kernel_size=1)
+
+    '''/
+    incremental version of forward for the realtime setting: consumes the next utterance
+    of every dialogue in the batch (textf, visuf, acouf: [batch_size, D], spk_idx: [batch_size])
+    and returns the same tuple as forward for that utterance only, each of shape
+    [batch_size, 1, n_classes]. state holds the causal convolution history and the cached
+    keys/values of every encoder; start with an empty dict
+    /'''
+    def step(self, textf, visuf, acouf, spk_idx, state):
+        assert not self.grouped, 'load the state_dict into a model with grouped=False for streaming'
+        pos = state.get('pos', 0)
+        spk_embeddings = self.speaker_embeddings(spk_idx.long().view(-1, 1))
 
         # Temporal convolutional layers
-        textf = self.textf_input(textf.permute(1, 2, 0)).transpose(1, 2)
-        acouf = self.acouf_input(acouf.permute(1, 2, 0)).transpose(1, 2)
-        visuf = self.visuf_input(visuf.permute(1, 2, 0)).transpose(1, 2)
+        conv_history = state.setdefault('conv', {})
+        inputs = {'t': (self.textf_input, textf) if 't' in self.modality else None,
+                  'a': (self.acouf_input, acouf) if 'a' in self.modality else None,
+                  'v': (self.visuf_input, visuf) if 'v' in self.modality else None}
+        features = {}
+        for m, _ in self.encoders:
+            conv, x = inputs[m]
+            out, conv_history[m] = conv.step(x.unsqueeze(-1), conv_history.get(m))
+            features[m] = out.transpose(1, 2)
 
         # Intra- and Inter-modal Transformers
-        t_t_transformer_out = self.t_t(textf, textf, u_mask, spk_embeddings, setting)
-        a_t_transformer_out = self.a_t(acouf, textf, u_mask, spk_embeddings, setting)
-        v_t_transformer_out = self.v_t(visuf, textf, u_mask, spk_embeddings, setting)
+        caches = state.setdefault('cache', {})
+        encoded = [[getattr(self, src+'_'+m).step(features[src], features[m], spk_embeddings, pos,
+                                                  caches.setdefault(src+'_'+m, []))
+                    for src in sources] for m, sources in self.encoders]
+        state['pos'] = pos + 1
+        return self.fuse(encoded)
 
-        a_a_transformer_out = self.a_a(acouf, acouf, u_mask, spk_embeddings, setting)
-        t_a_transformer_out = self.t_a(textf, acouf, u_mask, spk_embeddings, setting)
-        v_a_transformer_out = self.v_a(visuf, acouf, u_mask, spk_embeddings, setting)
 
-        v_v_transformer_out = self.v_v(visuf, visuf, u_mask, spk_embeddings, setting)
-        t_v_transformer_out = self.t_v(textf, visuf, u_mask, spk_embeddings, setting)
-        a_v_transformer_out = self.a_v(acouf, visuf, u_mask, spk_embeddings, setting)
-
-        # Unimodal-level Gated Fusion
-        t_t_transformer_out = self.t_t_gate(t_t_transformer_out)
-        a_t_transformer_out = self.a_t_gate(a_t_transformer_out)
-        v_t_transformer_out = self.v_t_gate(v_t_transformer_out)
-
-        a_a_transformer_out = self.a_a_gate(a_a_transformer_out)
-        t_a_transformer_out = self.t_a_gate(t_a_transformer_out)
-        v_a_transformer_out = self.v_a_gate(v_a_transformer_out)
-
-        v_v_transformer_out = self.v_v_gate(v_v_transformer_out)
-        t_v_transformer_out = self.t_v_gate(t_v_transformer_out)
-        a_v_transformer_out = self.a_v_gate(a_v_transformer_out)
-
-        if modality=='t':
-            t_transformer_out = self.features_reduce_t(t_t_transformer_out) 
-            all_transformer_out = self.last_gate_one(t_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-
-            return t_log_prob, all_log_prob, all_prob,\
-                   kl_t_log_prob, kl_all_prob
-
-        elif modality=='a':
-            a_transformer_out = self.features_reduce_a(a_a_transformer_out) 
-            all_transformer_out = self.last_gate_one(a_transformer_out) 
-
-            # Emotion Classifier
-            a_final_out = self.a_output_layer(a_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-            return a_log_prob, all_log_prob, all_prob,\
-                   kl_a_log_prob, kl_all_prob
-
-        elif modality=='at':
-            t_transformer_out = self.features_reduce_t_AT(torch.cat([t_t_transformer_out, a_t_transformer_out], dim=-1))
-            a_transformer_out = self.features_reduce_a_AT(torch.cat([a_a_transformer_out, t_a_transformer_out], dim=-1))
-            all_transformer_out = self.last_gate_two(t_transformer_out, a_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            a_final_out = self.a_output_layer(a_transformer_out) 
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
-
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
-
-            return t_log_prob, a_log_prob, all_log_prob, all_prob, \
-               kl_t_log_prob, kl_a_log_prob , kl_all_prob
-
-        else:
-            t_transformer_out = self.features_reduce_t_ATV(torch.cat([t_t_transformer_out, a_t_transformer_out, v_t_transformer_out], dim=-1))
-            a_transformer_out = self.features_reduce_a_ATV(torch.cat([a_a_transformer_out, t_a_transformer_out, v_a_transformer_out], dim=-1))
-            v_transformer_out = self.features_reduce_v_ATV(torch.cat([v_v_transformer_out, t_v_transformer_out, a_v_transformer_out], dim=-1))
-            all_transformer_out = self.last_gate_three(t_transformer_out, a_transformer_out, v_transformer_out) 
-
-            # Emotion Classifier
-            t_final_out = self.t_output_layer(t_transformer_out)
-            a_final_out = self.a_output_layer(a_transformer_out)
-            v_final_out = self.v_output_layer(v_transformer_out)
-            all_final_out = self.all_output_layer(all_transformer_out)
-
-            t_log_prob = F.log_softmax(t_final_out, 2)
-            a_log_prob = F.log_softmax(a_final_out, 2)
-            v_log_prob = F.log_softmax(v_final_out, 2)
-
-            all_log_prob = F.log_softmax(all_final_out, 2)
-            all_prob = F.softmax(all_final_out, 2)
+'''/
+the constructor arguments of a model as a plain dict (saved next to the weights by
+train.py --save-model and baked into the exported artifact), and the model they build
+/'''
+def build_model(config):
+    cls = Transformer_Based_Model_diverse if config.get('setting') == 'realtime' else Transformer_Based_Model
+    return cls(**config)
 
-            kl_t_log_prob = F.log_softmax(t_final_out /self.temp, 2)
-            kl_a_log_prob = F.log_softmax(a_final_out /self.temp, 2)
-            kl_v_log_prob = F.log_softmax(v_final_out /self.temp, 2)
 
-            kl_all_prob = F.softmax(all_final_out /self.temp, 2)
 
-            return t_log_prob, a_log_prob, v_log_prob, all_log_prob, all_prob, \
-               kl_t_log_prob, kl_a_log_prob, kl_v_log_prob, kl_all_prob
\ No newline at end of file
+'''/
+train.py --compile: one torch.compile graph with dynamic batch size and dialogue length. The
+random numbers of dropout come from the regular (ATen) generator instead of being generated
+inside the fused kernels: on the CPU Inductor's in-kernel generator is slower than the eager
+bernoulli, and it alone made compiled training slower than eager (see bench_compile.py).
+The setting is an option of this graph only, the global Inductor config is left alone
+/'''
+def compile_model(model):
+    return torch.compile(model, dynamic=True, options={'fallback_random': True})
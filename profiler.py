@@ -0,0 +1,193 @@
+import collections, contextlib, time
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils.flop_counter import flop_registry
+
+'''/
+per-module instrumentation of a model (train.py --profile). Hooks on the direct children
+of the model (input projections, encoders, gates, features_reduce_*, multimodal fusion,
+heads) attribute time, FLOPs and saved activations to them:
+
+- forward: from the forward pre-hook to the forward hook of the module (regions such as
+  the loss are timed the same way with region()).
+- backward: from the backward pre-hook of a module (the gradient of its output is ready)
+  to the backward pre-hook of the next one. Backward runs the modules one after the other
+  in reverse, so every backward op, including weight gradients that are computed after the
+  gradient of a module's inputs, falls into exactly one window.
+- FLOPs: one extra step under a dispatch mode that counts the matmul/attention/conv ops of
+  torch.utils.flop_counter into the module whose window is open.
+- activation memory: on CUDA the peak allocated memory of each forward and backward window
+  above the memory allocated when the window opened (transient buffers included), and the
+  peak of the whole step. On the CPU, where there is no allocator to ask, the tensors a
+  module saves for backward (parameters excluded, views of one storage counted once) are
+  reported instead: a proxy that misses transient buffers.
+
+Every module forward is also a record_function range, so a torch.profiler trace taken
+meanwhile shows the module names.
+
+    profiler = ModuleProfiler(model, synchronize=cuda)      # synchronize: CUDA timings and peak memory
+    with profiler.step():
+        outputs = model(*inputs)
+        with profiler.region('loss'):
+            loss = loss_fn(outputs)
+        profiler.backward(loss, 'loss')
+    print(profiler.table())
+/'''
+
+class FlopCounter(TorchDispatchMode):
+    def __init__(self, profiler):
+        super(FlopCounter, self).__init__()
+        self.profiler = profiler
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        if func._overloadpacket in flop_registry:
+            profiler = self.profiler
+            phase = 'backward' if profiler.window else 'forward'
+            name = profiler.window or (profiler.stack[-1] if profiler.stack else 'other')
+            profiler.flops[name][phase] += flop_registry[func._overloadpacket](*args, **kwargs, out=out)
+        return out
+
+
+class ModuleProfiler(object):
+    def __init__(self, model, synchronize=False):
+        self.model = model
+        self.synchronize = synchronize
+        self.names = [name for name, _ in model.named_children()]
+        self.times = collections.defaultdict(collections.Counter)
+        self.flops = collections.defaultdict(collections.Counter)
+        self.saved = collections.Counter()
+        self.peak = collections.Counter()
+        self.step_peak, self.step_start, self.marked = 0, 0, 0
+        self.steps = 0
+        self.stack, self.ranges, self.started = [], [], {}
+        self.window, self.window_start = None, None
+        self.parameters = {p.data_ptr() for p in model.parameters()}
+        self.handles = []
+        for name, module in model.named_children():
+            self.handles += [module.register_forward_pre_hook(lambda m, i, name=name: self.enter(name)),
+                             module.register_forward_hook(lambda m, i, o, name=name: self.exit(name)),
+                             module.register_full_backward_pre_hook(lambda m, g, name=name: self.open_window(name))]
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def mark(self):
+        """ CUDA: peak allocated memory since the previous mark, above the memory allocated at that mark """
+        if not self.synchronize:
+            return 0
+        peak = torch.cuda.max_memory_allocated()
+        self.step_peak = max(self.step_peak, peak - self.step_start)
+        torch.cuda.reset_peak_memory_stats()
+        last, self.marked = self.marked, torch.cuda.memory_allocated()
+        return peak - last
+
+    def enter(self, name):
+        self.stack.append(name)
+        self.ranges.append(torch.autograd.profiler.record_function(name).__enter__())
+        self.mark()
+        self.started[name] = self.now()
+
+    def exit(self, name):
+        self.times[name]['forward'] += self.now() - self.started.pop(name)
+        self.peak[name] = max(self.peak[name], self.mark())
+        self.stack.pop()
+        self.ranges.pop().__exit__(None, None, None)
+
+    @contextlib.contextmanager
+    def region(self, name):
+        """ forward work outside the modules (e.g. the loss) as a row of its own """
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit(name)
+
+    def open_window(self, name):
+        if self.window is None:
+            return
+        now = self.now()
+        self.times[self.window]['backward'] += now - self.window_start
+        self.peak[self.window] = max(self.peak[self.window], self.mark())
+        self.window, self.window_start = name, now
+
+    def backward(self, loss, name='loss'):
+        """ loss.backward() with its time split into the backward windows of the modules (name gets the first one) """
+        self.mark()
+        self.window, self.window_start = name, self.now()
+        try:
+            loss.backward()
+        finally:
+            self.times[self.window]['backward'] += self.now() - self.window_start
+            self.peak[self.window] = max(self.peak[self.window], self.mark())
+            self.window = None
+
+    def pack(self, tensor):
+        # tensors saved for backward, by the module running when they are saved (weights excluded)
+        if tensor.data_ptr() not in self.parameters and tensor.data_ptr() not in self.seen:
+            self.seen.add(tensor.data_ptr())
+            self.saved[self.stack[-1] if self.stack else 'other'] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    @contextlib.contextmanager
+    def step(self):
+        """ one training step: its saved activations replace those of the previous step """
+        self.seen = set()
+        self.saved.clear()
+        if self.synchronize:
+            torch.cuda.reset_peak_memory_stats()
+            self.step_start = self.marked = torch.cuda.memory_allocated()
+        with torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor):
+            yield
+        self.mark()
+        self.steps += 1
+
+    def count_flops(self, run_step):
+        """ FLOPs per module of one step (not part of the timings) """
+        self.flops.clear()
+        times, self.times = self.times, collections.defaultdict(collections.Counter)
+        with FlopCounter(self):
+            run_step()
+        self.times = times
+        self.peak.clear()
+        self.step_peak = 0
+
+    def add(self, name, phase, seconds):
+        """ time of work outside forward and backward (e.g. the optimizer) """
+        self.times[name][phase] += seconds
+
+    def rows(self):
+        steps = max(1, self.steps)
+        names = [n for n in self.names if n in self.times] + [n for n in self.times if n not in self.names]
+        return [{'module': name, 'forward_ms': self.times[name]['forward'] / steps * 1000, 'backward_ms': self.times[name]['backward'] / steps * 1000,
+                 'forward_gflop': self.flops[name]['forward'] / 1e9, 'backward_gflop': self.flops[name]['backward'] / 1e9,
+                 'saved_mb': self.saved[name] / 2**20, 'peak_mb': self.peak[name] / 2**20 if self.synchronize else None} for name in names]
+
+    def memory(self, rows):
+        """ activation memory of the step: the measured peak on CUDA, the sum of the saved tensors (a proxy) on the CPU """
+        return self.step_peak / 2**20 if self.synchronize else sum(r['saved_mb'] for r in rows)
+
+    def table(self, step_ms=None):
+        # on the CPU the memory column is the saved-for-backward proxy (see above)
+        memory = 'peak_mb' if self.synchronize else 'saved_mb'
+        lines = ['{:<24} {:>10} {:>10} {:>10} {:>10} {:>12}'.format('module', 'fwd ms', 'bwd ms', 'fwd GFLOP', 'bwd GFLOP',
+                                                                   'peak MB' if self.synchronize else 'saved MB*')]
+        rows = self.rows()
+        for row in rows:
+            lines.append('{module:<24} {forward_ms:>10.3f} {backward_ms:>10.3f} {forward_gflop:>10.4f} {backward_gflop:>10.4f} {memory:>12.2f}'.format(
+                memory=row[memory], **row))
+        lines.append('{:<24} {:>10.3f} {:>10.3f} {:>10.4f} {:>10.4f} {:>12}'.format(
+            'sum', *[sum(r[k] for r in rows) for k in ['forward_ms', 'backward_ms', 'forward_gflop', 'backward_gflop']], ''))
+        lines.append('{:<24} {:>57.2f}'.format('step peak' if self.synchronize else 'step (sum of saved)', self.memory(rows)))
+        if step_ms is not None:
+            lines.append('{:<24} {:>21.3f}'.format('step (wall)', step_ms))
+        if not self.synchronize:
+            lines.append('* saved for backward, a proxy of the activation memory on the CPU (peak memory is measured on CUDA)')
+        return '\n'.join(lines)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
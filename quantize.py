@@ -0,0 +1,97 @@
+import argparse, copy, io, time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from sklearn.metrics import f1_score
+from dataloader import IEMOCAPDataset, MELDDataset, FeatureStoreDataset
+from model import CausalConv1d
+from export import InferenceSDT, load_checkpoint
+
+'''/
+dynamic int8 quantisation for CPU serving. Every nn.Linear (attention projections, feed
+forward, gates, features_reduce_* and the heads) gets int8 weights and activations that
+are quantised per batch; the 1x1 Conv1d input projections are the same linear map per
+utterance, so they are turned into nn.Linear first and quantised the same way.
+The harness compares the fp32 and int8 model on the test split (weighted F1, latency, size):
+
+    python quantize.py --checkpoint sdt.pt --Data_dir ./data [--feature-store] [--batch-size 1]
+/'''
+INPUT_LAYERS = ['textf_input', 'acouf_input', 'visuf_input']
+
+
+def conv_to_linear(layer):
+    conv = layer.conv1d if isinstance(layer, CausalConv1d) else layer
+    assert conv.kernel_size == (1,)
+    linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+    linear.weight.data.copy_(conv.weight.data.squeeze(-1))
+    if conv.bias is not None:
+        linear.bias.data.copy_(conv.bias.data)
+    return linear
+
+
+def quantize(model):
+    """ int8 copy of a trained (non-grouped) model, for forward only; the fp32 model is left as is """
+    assert not model.grouped, 'load the state_dict into a model with grouped=False to quantise it'
+    model = copy.deepcopy(model).eval()
+    for name in INPUT_LAYERS:
+        if hasattr(model, name):
+            setattr(model, name, conv_to_linear(getattr(model, name)))
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def test_loader(config, data_dir, feature_store, batch_size):
+    if feature_store:
+        testset = FeatureStoreDataset(f'{data_dir}/{config["dataset"].lower()}_features', train=False)
+    elif config['dataset'] == 'MELD':
+        testset = MELDDataset(f'{data_dir}/meld_multimodal_features.pkl', train=False)
+    else:
+        testset = IEMOCAPDataset(f'{data_dir}/iemocap_multimodal_features.pkl', train=False)
+    return DataLoader(testset, batch_size=batch_size, collate_fn=testset.collate_fn, num_workers=0)
+
+
+def evaluate(model, loader):
+    wrapper = InferenceSDT(model).eval()
+    preds, labels, masks, latencies = [], [], [], []
+    with torch.no_grad():
+        for data in loader:
+            textf, visuf, acouf, qmask, umask, label, lengths = data[:-1]
+            start = time.perf_counter()
+            all_prob = wrapper(textf, visuf, acouf, umask, qmask.permute(1, 0, 2))
+            latencies.append(time.perf_counter() - start)
+            preds.append(torch.argmax(all_prob, 2).view(-1).numpy())
+            labels.append(label.view(-1).numpy())
+            masks.append(umask.view(-1).numpy())
+    preds, labels, masks = np.concatenate(preds), np.concatenate(labels), np.concatenate(masks)
+    fscore = round(f1_score(labels, preds, sample_weight=masks, average='weighted')*100, 2)
+    return fscore, np.array(latencies)*1000, int(masks.sum())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, help='file written by train.py --save-model')
+    parser.add_argument('--Data_dir', default='./data', help='dataset directory')
+    parser.add_argument('--feature-store', action='store_true', default=False, help='read the test split from the converted feature store')
+    parser.add_argument('--batch-size', type=int, default=1, help='dialogues per request')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model, config = load_checkpoint(args.checkpoint)
+    loader = test_loader(config, args.Data_dir, args.feature_store, args.batch_size)
+    results = {}
+    for name, candidate in [('fp32', model), ('int8', quantize(model))]:
+        evaluate(candidate, loader)  # warm up the allocator and the int8 kernels
+        fscore, latencies, utterances = evaluate(candidate, loader)
+        results[name] = latencies.sum()
+        print('{}: test_fscore {}, latency p50 {:.2f} ms, p99 {:.2f} ms per batch, {:.0f} utt/sec, size {:.1f} MB'.format(
+            name, fscore, np.percentile(latencies, 50), np.percentile(latencies, 99), utterances/latencies.sum()*1000,
+            model_size(candidate)/2**20))
+    print('int8 speed-up {:.2f}x'.format(results['fp32']/results['int8']))
@@ -0,0 +1,41 @@
+import fcntl, json, os
+
+'''/
+append-only store of experiment results, one JSON object per line. Every append takes an
+exclusive flock on the file, writes a whole line and fsyncs it, so any number of concurrent
+runs (processes or machines sharing the file system) can report into the same file without
+losing or interleaving records, unlike the read-modify-write of record_*.pk.
+
+    ResultsStore('results.jsonl').append({'best_fscore': 65.1, ...})
+    results = ResultsStore('results.jsonl').read()
+/'''
+
+class ResultsStore(object):
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, result):
+        line = json.dumps(result, default=str) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                lines = f.read().split('\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        # a line is only complete with its newline (a crash may leave a partial last line)
+        return [json.loads(line) for line in lines[:-1] if line.strip()]
@@ -0,0 +1,87 @@
+import argparse, contextlib, os, shlex, time
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import train
+from dataloader import IEMOCAPDataset, MELDDataset, FeatureStoreDataset, PackedDialogues
+
+'''/
+runs train.py for several seeds (and configs) concurrently, in place of the sequential loops
+of exec_*.sh. The dataset is loaded and packed once in the parent and put in shared memory;
+the worker processes are forked from it and read the same pages (train.py --in-memory).
+Every run appends its result to the --results store and logs to <log-dir>/<config>_seed<seed>.log;
+at the end the best test F1 of each config is summarised over the seeds:
+
+    python run_seeds.py --seeds 0 1 2 3 4 --workers 5 --threads 2 \
+        --train-args "--Dataset MELD --Data_dir ./data --epochs 150 --lr 0.0001 --batch-size 16" \
+        --config "--temp 1" --config "--temp 8"
+/'''
+shared = {}
+# train.py arguments that select the data: every run shares the dataset loaded from --train-args
+DATA_ARGS = ['Dataset', 'Data_dir', 'feature_store']
+
+
+def init_worker(datasets, threads):
+    shared['datasets'] = datasets
+    torch.set_num_threads(threads)
+
+
+def load_datasets(args):
+    """ (trainset, testset) of the train.py arguments, packed into shared CPU memory """
+    if args.feature_store:
+        path = f'{args.Data_dir}/{args.Dataset.lower()}_features'
+        splits = [FeatureStoreDataset(path), FeatureStoreDataset(path, train=False)]
+    else:
+        path = f'{args.Data_dir}/{args.Dataset.lower()}_multimodal_features.pkl'
+        dataset = MELDDataset if args.Dataset == 'MELD' else IEMOCAPDataset
+        splits = [dataset(path), dataset(path, train=False)]
+    return tuple(PackedDialogues(split).share_memory() for split in splits)
+
+
+def run(train_args, config, seed, results, log_dir):
+    args = train.get_parser().parse_args(train_args + config + ['--seed', str(seed), '--results', results, '--in-memory'])
+    name = '{}_seed{}'.format('_'.join(a.lstrip('-') for a in config) or 'default', seed)
+    with open(os.path.join(log_dir, name + '.log'), 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        result = train.main(args, datasets=shared['datasets'])
+    return ' '.join(config), seed, result['best_fscore']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, nargs='+', default=list(range(10)), help='one run per seed (and config)')
+    parser.add_argument('--workers', type=int, default=2, help='concurrent runs')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads of each run')
+    parser.add_argument('--results', default='results.jsonl', help='JSON lines store the runs append to')
+    parser.add_argument('--log-dir', default='logs', help='stdout of every run goes to a file here')
+    parser.add_argument('--train-args', default='', help='train.py arguments shared by all runs')
+    parser.add_argument('--config', action='append', default=None, help='train.py arguments of one config (repeatable)')
+    args = parser.parse_args()
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    train_args = shlex.split(args.train_args)
+    configs = [shlex.split(c) for c in args.config or ['']]
+    data_args = train.get_parser().parse_args(train_args)
+    for config in configs:
+        # fail on bad arguments before anything is forked
+        config_args = train.get_parser().parse_args(train_args + config)
+        changed = [name for name in DATA_ARGS if getattr(config_args, name) != getattr(data_args, name)]
+        if changed:
+            parser.error('--config "{}" changes {}; the data is shared by all runs, set it in --train-args'.format(' '.join(config), ', '.join(changed)))
+    start = time.time()
+    datasets = load_datasets(data_args)
+    print('loaded {} into shared memory in {:.1f}s'.format(data_args.Dataset, time.time()-start))
+
+    scores = {' '.join(config): [] for config in configs}
+    # fork, so the workers inherit the packed tensors instead of receiving pickled copies
+    context = torch.multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=init_worker, initargs=(datasets, args.threads)) as pool:
+        futures = [pool.submit(run, train_args, config, seed, args.results, args.log_dir) for config in configs for seed in args.seeds]
+        for future in as_completed(futures):
+            config, seed, fscore = future.result()
+            scores[config].append(fscore)
+            print('{} seed {}: best test F1 {} ({:.0f}s)'.format(config or 'default', seed, fscore, time.time()-start))
+
+    print('{} runs in {:.0f}s, results in {}'.format(len(futures), time.time()-start, args.results))
+    for config, fscores in scores.items():
+        print('{}: F1 mean {:.2f} std {:.2f} max {:.2f} over {} seeds'.format(
+            config or 'default', np.mean(fscores), np.std(fscores), np.max(fscores), len(fscores)))
@@ -0,0 +1,279 @@
+import argparse, asyncio, collections, json, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from dataloader import DialogueCollator
+from export import InferenceSDT, load_artifact, load_checkpoint
+
+'''/
+asyncio HTTP (or Unix socket) inference service. Whole dialogues are posted as JSON:
+
+    POST /predict  {"text": [[...], ...], "audio": [[...], ...], "visual": [[...], ...], "speakers": [0, 1, ...]}
+               ->  {"emotions": [3, 1, ...], "probs": [[...], ...]}     one entry per utterance
+    GET  /metrics  request, batch and latency (p50/p99, submit to reply) counters
+    GET  /health
+
+speakers are indices or one-hot rows as in qmask; modalities the model does not use may be left out.
+Requests are coalesced into padded batches of up to --max-batch-size dialogues: a batch is run
+as soon as it is full or --max-latency-ms after its first dialogue arrived. At most --max-queue
+dialogues wait; beyond that requests are refused with 503 right away (back-pressure).
+Bodies larger than --max-body-bytes are refused with 413 before they are read, and the JSON
+is parsed on a worker thread, so a large dialogue does not hold up the event loop. Dialogues
+longer than the model takes (max_len of an exported artifact) are refused with 400, and if a
+batch still fails its dialogues are rerun one by one, so only the failing request gets the 500.
+
+    python server.py --artifact sdt_inference.pt --port 8000 [--unix /tmp/sdt.sock]
+/'''
+
+class Predictor(object):
+    """ runs one padded batch of parsed dialogues through the model (called from a worker thread) """
+    def __init__(self, module, config, device='cpu'):
+        self.module = module
+        self.config = config
+        self.device = torch.device(device)
+        # longest dialogue the module takes, None if any (the eager model computes further positions on the fly)
+        self.max_len = config.get('max_len')
+        self.collate = DialogueCollator(pin_memory=self.device.type == 'cuda')
+
+    def parse(self, body):
+        speakers = torch.as_tensor(body['speakers'])
+        if speakers.dim() == 1:
+            speakers = torch.nn.functional.one_hot(speakers.long(), self.config['n_speakers'])
+        n = speakers.size(0)
+        if n == 0 or speakers.shape != (n, self.config['n_speakers']):
+            raise ValueError('speakers must be {} indices or one-hot rows'.format(self.config['n_speakers']))
+        if self.max_len is not None and n > self.max_len:
+            raise ValueError('dialogues of at most {} utterances are supported, got {}'.format(self.max_len, n))
+        features = []
+        for m, key in [('t', 'text'), ('v', 'visual'), ('a', 'audio')]:
+            dim = self.config['D_' + key]
+            if body.get(key) is None:
+                if m in self.config['modality']:
+                    raise ValueError('the model needs {} features'.format(key))
+                features.append(torch.zeros(n, dim))
+                continue
+            x = torch.as_tensor(body[key], dtype=torch.float)
+            if x.shape != (n, dim):
+                raise ValueError('{} features must be [{}, {}], got {}'.format(key, n, dim, list(x.shape)))
+            features.append(x)
+        return features + [speakers.float(), torch.ones(n), torch.zeros(n, dtype=torch.long), None]
+
+    def __call__(self, dialogues):
+        text, visual, audio, speakers, umask, _, lengths, _ = self.collate(dialogues)
+        text, visual, audio, speakers, umask = [x.to(self.device, non_blocking=True) for x in [text, visual, audio, speakers, umask]]
+        with torch.no_grad():
+            all_prob = self.module(text, visual, audio, umask, speakers.permute(1, 0, 2)).float().cpu()
+        return [all_prob[j, :n] for j, n in enumerate(lengths.tolist())]
+
+
+class MicroBatcher(object):
+    def __init__(self, predictor, max_batch_size=16, max_latency_ms=5.0, max_queue=256, window=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # one model call at a time, off the event loop so requests keep being accepted meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = collections.deque(maxlen=window)
+        self.counters = collections.Counter()
+
+    def submit(self, dialogue):
+        """ future of the class distributions of one parsed dialogue; raises asyncio.QueueFull when saturated """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((dialogue, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            raise
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.predictor, [d for d, _, _ in batch])
+            except Exception:
+                # one bad dialogue must not fail the others: rerun them one by one
+                outputs = await loop.run_in_executor(self.executor, self.run_each, [d for d, _, _ in batch])
+            now = time.perf_counter()
+            for (_, future, start), out in zip(batch, outputs):
+                self.latencies.append(now - start)
+                if isinstance(out, Exception):
+                    self.counters['errors'] += 1
+                if future.done():
+                    continue
+                if isinstance(out, Exception):
+                    future.set_exception(out)
+                else:
+                    future.set_result(out)
+            self.counters['batches'] += 1
+            self.counters['dialogues'] += len(batch)
+            self.counters['utterances'] += sum(len(d[5]) for d, _, _ in batch)
+
+    def run_each(self, dialogues):
+        """ the output of every dialogue run on its own, or the exception it raised """
+        outputs = []
+        for dialogue in dialogues:
+            try:
+                outputs.append(self.predictor([dialogue])[0])
+            except Exception as e:
+                outputs.append(e)
+        return outputs
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        percentile = lambda q: round(float(np.percentile(latencies, q)), 3) if len(latencies) else None
+        return dict(self.counters, queue_depth=self.queue.qsize(),
+                    mean_batch_size=round(self.counters['dialogues'] / max(1, self.counters['batches']), 2),
+                    latency_ms={'p50': percentile(50), 'p99': percentile(99), 'window': len(latencies)})
+
+
+class InferenceServer(object):
+    def __init__(self, predictor, max_body_bytes=32 * 2**20, **batcher_args):
+        self.predictor = predictor
+        self.max_body_bytes = max_body_bytes
+        self.batcher_args = batcher_args
+        # the handler task of every open connection
+        self.connections = {}
+
+    async def start(self, host='127.0.0.1', port=8000, unix=None):
+        self.batcher = MicroBatcher(self.predictor, **self.batcher_args)
+        self.worker = asyncio.ensure_future(self.batcher.run())
+        if unix:
+            self.server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        # idle keep-alive connections see EOF and their handlers return
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        self.batcher.executor.shutdown()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics()
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+        self.batcher.counters['requests'] += 1
+        try:
+            # off the event loop: decoding a long dialogue of 1024-d features takes milliseconds
+            dialogue = await asyncio.get_running_loop().run_in_executor(None, lambda: self.predictor.parse(json.loads(body)))
+        except (ValueError, KeyError, TypeError, RuntimeError) as e:
+            self.batcher.counters['bad_requests'] += 1
+            return 400, {'error': str(e)}
+        try:
+            all_prob = await self.batcher.submit(dialogue)
+        except asyncio.QueueFull:
+            return 503, {'error': 'server busy, retry later'}
+        except Exception as e:
+            return 500, {'error': str(e)}
+        return 200, {'emotions': torch.argmax(all_prob, -1).tolist(), 'probs': all_prob.tolist()}
+
+    @staticmethod
+    async def respond(writer, status, payload, keep_alive):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error',
+                   503: 'Service Unavailable'}
+        data = json.dumps(payload).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+            status, reasons[status], len(data), 'keep-alive' if keep_alive else 'close').encode() + data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, just enough for JSON requests with a Content-Length.
+        # Malformed and oversized requests are answered and the connection is closed, since the rest of the stream cannot be trusted
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) < 2:
+                    await self.respond(writer, 400, {'error': 'malformed request line'}, False)
+                    break
+                method, path = parts[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'}, False)
+                    break
+                if length > self.max_body_bytes:
+                    await self.respond(writer, 413, {'error': 'body of {} bytes exceeds {}'.format(length, self.max_body_bytes)}, False)
+                    break
+                body = await reader.readexactly(length)
+                status, payload = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+
+def load_predictor(checkpoint=None, artifact=None, device='cpu'):
+    if artifact:
+        module, config = load_artifact(artifact, device)
+    else:
+        model, config = load_checkpoint(checkpoint)
+        module = InferenceSDT(model).to(device).eval()
+    return Predictor(module, config, device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artifact', default=None, help='TorchScript artifact written by export.py')
+    parser.add_argument('--checkpoint', default=None, help='or a file written by train.py --save-model')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='TCP port')
+    parser.add_argument('--unix', default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--device', default='cpu', help='cpu or cuda')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='dialogues per model call')
+    parser.add_argument('--max-latency-ms', type=float, default=5.0, help='longest wait for a batch to fill up')
+    parser.add_argument('--max-queue', type=int, default=256, help='waiting dialogues before requests are refused with 503')
+    parser.add_argument('--max-body-bytes', type=int, default=32 * 2**20, help='largest request body, larger ones are refused with 413')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    args = parser.parse_args()
+    assert args.artifact or args.checkpoint, 'pass --artifact or --checkpoint'
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    server = InferenceServer(load_predictor(args.checkpoint, args.artifact, args.device), max_body_bytes=args.max_body_bytes, max_batch_size=args.max_batch_size,
+                             max_latency_ms=args.max_latency_ms, max_queue=args.max_queue)
+
+    async def main():
+        await server.start(args.host, args.port, args.unix)
+        print('serving on {}'.format(args.unix or '{}:{}'.format(args.host, args.port)))
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
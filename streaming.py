@@ -0,0 +1,54 @@
+import torch
+from model import Transformer_Based_Model_diverse, autocast
+
+'''/
+Incremental inference for the realtime model (Transformer_Based_Model_diverse).
+Instead of re-running the whole dialogue for every new utterance, the engine keeps
+the keys/values of each encoder and the causal convolution history, so each turn
+only costs the projections of one utterance plus attention over the cached ones.
+The emotions it returns are the same as a full-sequence forward in the realtime setting.
+
+    streamer = StreamingSDT(model)
+    for text, audio, visual, speaker in dialogue:
+        emotion, prob = streamer.step(text, audio, visual, speaker)
+/'''
+class StreamingSDT(object):
+    def __init__(self, model, precision='fp32'):
+        assert isinstance(model, Transformer_Based_Model_diverse), 'streaming needs the realtime model'
+        self.model = model.eval()
+        self.precision = precision
+        self.reset()
+
+    def reset(self):
+        """  start a new dialogue """
+        self.state = {}
+
+    def __len__(self):
+        return self.state.get('pos', 0)
+
+    def prepare(self, x):
+        if x is None:
+            return None
+        x = torch.as_tensor(x, dtype=torch.float, device=self.device)
+        return x.unsqueeze(0) if x.dim() == 1 else x
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def step(self, text, audio, visual, speaker):
+        """
+        text, audio, visual: features of the newest utterance, [D] or [batch_size, D]
+        (modalities the model does not use may be None). speaker: speaker index or
+        one-hot speaker vector, as in qmask. Returns the predicted emotion and the
+        class distribution for that utterance.
+        """
+        speaker = torch.as_tensor(speaker, device=self.device)
+        if speaker.is_floating_point():
+            speaker = torch.argmax(speaker, -1)
+        with torch.no_grad(), autocast(self.device, self.precision):
+            out = self.model.step(self.prepare(text), self.prepare(visual), self.prepare(audio),
+                                  speaker.view(-1), self.state)
+        # per-modality log probs come first, then all_log_prob and all_prob, as in forward
+        all_prob = out[len(self.model.encoders)+1].squeeze(1)
+        return torch.argmax(all_prob, -1), all_prob
@@ -0,0 +1,133 @@
+import argparse, contextlib, math, os, shlex, time
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import train
+from results import ResultsStore
+from run_seeds import init_worker, load_datasets, shared
+
+'''/
+random hyperparameter search with asynchronous successive halving (ASHA, stopping variant).
+Trials run concurrently in forked worker processes on one dataset packed in shared memory
+(as in run_seeds.py). A trial reports its validation F1 at the rungs --min-epochs * eta^k;
+it goes on to the next rung only while it is in the top 1/eta of all the values recorded at
+that rung so far, so most trials stop after a few epochs and only the best ones reach --epochs.
+Rung values are shared through a locked JSON lines file (<results>.rungs), and every trial
+appends its params and validation/test curves to --results:
+
+    python sweep.py --trials 27 --workers 4 --threads 2 --min-epochs 2 --eta 3 \
+        --train-args "--Dataset IEMOCAP --Data_dir ./data --epochs 54 --valid 0.1" \
+        --space lr=loguniform:1e-5:1e-3 --space temp=choice:1,2,4,8
+
+a parameter is any train.py argument (by its dest, e.g. hidden_dim or gamma_1), sampled
+from loguniform:LOW:HIGH, uniform:LOW:HIGH or choice:A,B,...
+/'''
+DEFAULT_SPACE = ['lr=loguniform:1e-5:1e-3', 'temp=choice:1,2,4,8', 'dropout=uniform:0.1:0.6', 'hidden_dim=choice:256,512,1024',
+                 'gamma_1=uniform:0.5:2', 'gamma_2=uniform:0.5:2', 'gamma_3=uniform:0.5:2']
+
+
+def parse_space(specs, defaults):
+    space = {}
+    for spec in specs:
+        name, _, distribution = spec.partition('=')
+        kind, _, values = distribution.partition(':')
+        assert hasattr(defaults, name), 'train.py has no argument {}'.format(name)
+        cast = type(getattr(defaults, name))
+        if kind == 'choice':
+            space[name] = (kind, [cast(v) for v in values.split(',')])
+        elif kind in ('uniform', 'loguniform'):
+            space[name] = (kind, [float(v) for v in values.split(':')])
+        else:
+            raise ValueError('unknown distribution {} of {}'.format(kind, name))
+    return space
+
+
+def sample(space, rng):
+    params = {}
+    for name, (kind, values) in space.items():
+        if kind == 'choice':
+            params[name] = values[rng.integers(len(values))]
+        elif kind == 'uniform':
+            params[name] = float(rng.uniform(*values))
+        else:
+            params[name] = float(math.exp(rng.uniform(math.log(values[0]), math.log(values[1]))))
+    return params
+
+
+class Pruner(object):
+    """ report() hook of train.main: records the value at each rung and stops the trial unless it is in the top 1/eta there """
+    def __init__(self, path, trial, rungs, eta):
+        self.store = ResultsStore(path)
+        self.trial = trial
+        self.rungs = rungs
+        self.eta = eta
+        self.last = 0
+
+    def __call__(self, epoch, value):
+        # with --eval-every the report of a rung comes with the first evaluated epoch after it
+        reached = [rung for rung in self.rungs if self.last < rung <= epoch]
+        self.last = epoch
+        if not reached:
+            return False
+        self.store.append({'trial': self.trial, 'rung': reached[-1], 'value': value})
+        values = sorted(r['value'] for r in self.store.read() if r['rung'] == reached[-1])
+        return value < values[-max(1, len(values) // self.eta)]
+
+
+def run_trial(trial, train_args, params, results, rungs, eta, log_dir):
+    args = train.get_parser().parse_args(train_args + ['--results', results, '--in-memory'])
+    for name, value in params.items():
+        setattr(args, name, value)
+    args.trial = trial
+    with open(os.path.join(log_dir, 'trial{}.log'.format(trial)), 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        result = train.main(args, datasets=shared['datasets'], report=Pruner(results + '.rungs', trial, rungs, eta))
+    return trial, params, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=27, help='number of sampled configurations')
+    parser.add_argument('--workers', type=int, default=2, help='concurrent trials')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads of each trial')
+    parser.add_argument('--min-epochs', type=int, default=1, help='epochs every trial gets (first rung)')
+    parser.add_argument('--eta', type=int, default=3, help='reduction factor between rungs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sampler (trials are seeded with their index)')
+    parser.add_argument('--space', action='append', default=None, help='NAME=DISTRIBUTION (repeatable, replaces the default space)')
+    parser.add_argument('--results', default='sweep.jsonl', help='JSON lines store of the trials')
+    parser.add_argument('--log-dir', default='logs/sweep', help='stdout of every trial goes to a file here')
+    parser.add_argument('--train-args', default='--valid 0.1', help='train.py arguments shared by all trials (--epochs is the full budget)')
+    args = parser.parse_args()
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    train_args = shlex.split(args.train_args)
+    data_args = train.get_parser().parse_args(train_args)
+    assert data_args.valid > 0, 'trials are pruned on the validation F1, pass --valid in --train-args'
+    space = parse_space(args.space or DEFAULT_SPACE, data_args)
+    rungs = [args.min_epochs]
+    while rungs[-1] * args.eta < data_args.epochs:
+        rungs.append(rungs[-1] * args.eta)
+    if os.path.exists(args.results + '.rungs'):
+        os.remove(args.results + '.rungs')
+    print('rungs at epochs {} of {}'.format(rungs, data_args.epochs))
+
+    start = time.time()
+    datasets = load_datasets(data_args)
+    rng = np.random.default_rng(args.seed)
+    trials = [sample(space, rng) for _ in range(args.trials)]
+    finished = []
+    context = torch.multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=init_worker, initargs=(datasets, args.threads)) as pool:
+        futures = [pool.submit(run_trial, i, train_args + ['--seed', str(i)], params, args.results, rungs, args.eta, args.log_dir)
+                   for i, params in enumerate(trials)]
+        for future in as_completed(futures):
+            trial, params, result = future.result()
+            curve = result['all_valid_fscore']
+            epochs = result['eval_epochs'][-1]
+            finished.append((max(curve), result['all_fscore'][int(np.argmax(curve))], epochs, trial, params))
+            print('trial {} {}: {} epochs, best valid F1 {} ({:.0f}s)'.format(trial, params, epochs, max(curve), time.time()-start))
+
+    epochs = sum(f[2] for f in finished)
+    print('{} trials in {:.0f}s, {} epochs instead of {} ({:.1f}x less), curves in {}'.format(
+        len(finished), time.time()-start, epochs, len(finished)*data_args.epochs, len(finished)*data_args.epochs/epochs, args.results))
+    for valid_fscore, test_fscore, n, trial, params in sorted(finished, key=lambda f: (-f[2], -f[0]))[:5]:
+        print('trial {}: valid F1 {}, test F1 {} (at the best valid epoch), {} epochs, {}'.format(trial, valid_fscore, test_fscore, n, params))
@@ -0,0 +1,130 @@
+import collections, queue, threading, time
+import torch
+
+'''/
+low-overhead training telemetry. The training loop marks the end of every phase of a step
+(data wait, H2D copy, forward, loss, backward, optimizer); the time since the previous mark
+is added to that phase, and epoch_summary() reports the mean milliseconds per step. Gradient
+histograms are only taken every histogram_every steps, as bucket counts computed on the
+device (no full gradient copies), and everything meant for the TensorBoard writer goes
+through a bounded queue drained by a background thread: when the writer falls behind,
+records are dropped (and counted) instead of stalling training. The time spent in the
+telemetry itself is measured and reported as overhead.
+
+    telemetry = Telemetry(writer, histogram_every=100, enabled=True)
+    telemetry.start()
+    for data in loader:
+        telemetry.mark('data')
+        ...
+        optimizer.step()
+        telemetry.mark('optimizer')
+        telemetry.step(model)
+    print(telemetry.epoch_summary(epoch))
+    telemetry.close()
+/'''
+PHASES = ['data', 'h2d', 'forward', 'loss', 'backward', 'optimizer']
+
+
+class Telemetry(object):
+    def __init__(self, writer=None, histogram_every=0, enabled=False, synchronize=False, bins=64, max_pending=1000):
+        self.writer = writer
+        self.histogram_every = histogram_every if writer is not None else 0
+        self.enabled = enabled
+        # on the GPU the phases are only separated by waiting for the kernels at every mark
+        self.synchronize = synchronize and enabled and torch.cuda.is_available()
+        self.bins = bins
+        self.totals = collections.Counter()
+        self.steps = 0
+        self.global_step = 0
+        self.overhead = 0.0
+        self.dropped = 0
+        self.last = self.started = self.stepped = time.perf_counter()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if writer is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            function, arguments = item
+            function(*arguments)
+
+    def put(self, function, *arguments):
+        """ runs function(*arguments) on the writer thread, or drops it if too many records are waiting """
+        if self.writer is None:
+            return
+        try:
+            self.queue.put_nowait((function, arguments))
+        except queue.Full:
+            self.dropped += 1
+
+    def scalar(self, tag, value, step):
+        if self.writer is not None:
+            self.put(self.writer.add_scalar, tag, value, step)
+
+    def start(self):
+        self.last = self.started = self.stepped = time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[phase] += now - self.last
+        self.last = now
+
+    def step(self, model):
+        self.steps += 1
+        self.global_step += 1
+        if self.histogram_every and self.global_step % self.histogram_every == 0:
+            start = time.perf_counter()
+            self.histograms(model)
+            self.overhead += time.perf_counter() - start
+            # the sampling is not part of the next step's data wait
+            self.last = time.perf_counter()
+        self.stepped = time.perf_counter()
+
+    def histograms(self, model):
+        # bucket counts and moments per gradient on the device, one small copy to the host for all of them
+        names, stats = [], []
+        for name, param in model.named_parameters():
+            if param.grad is None:
+                continue
+            grad = param.grad.detach().float()
+            # histc over [min, max] of the data, without reading the range back to the host first
+            stats.append(torch.cat([torch.stack([grad.min(), grad.max(), grad.sum(), grad.pow(2).sum()]), torch.histc(grad, self.bins)]))
+            names.append((name, grad.numel()))
+        if not stats:
+            return
+        self.put(self.write_histograms, names, torch.stack(stats).cpu(), self.global_step)
+
+    def write_histograms(self, names, stats, step):
+        for (name, numel), row in zip(names, stats.double()):
+            low, high, total, squares = row[:4].tolist()
+            limits = torch.linspace(low, high, self.bins + 1)[1:].tolist()
+            self.writer.add_histogram_raw(name, low, high, numel, total, squares, limits, row[4:].tolist(), step)
+
+    def epoch_summary(self, epoch):
+        """ mean ms per training step of every phase since the last summary, the telemetry overhead and the dropped records """
+        steps = max(1, self.steps)
+        summary = {phase: round(self.totals[phase] / steps * 1000, 3) for phase in PHASES if phase in self.totals}
+        train_time = self.stepped - self.started
+        summary['overhead_pct'] = round(self.overhead / train_time * 100, 2) if train_time > 0 else 0.0
+        summary['dropped'] = self.dropped
+        for phase in PHASES:
+            if phase in summary:
+                self.scalar('step_ms/' + phase, summary[phase], epoch)
+        self.totals.clear()
+        self.steps = 0
+        self.overhead = 0.0
+        return summary
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
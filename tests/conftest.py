@@ -0,0 +1,4 @@
+import os, sys
+
+# the modules live at the top of the repository, next to train.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
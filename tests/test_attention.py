@@ -0,0 +1,34 @@
+import pytest
+import torch
+from benchmark.synthetic import random_batch
+from model import build_model
+
+# a small IEMOCAP model
+CONFIG = dict(dataset='IEMOCAP', temp=1, D_text=32, D_visual=16, D_audio=24, n_head=4, n_classes=6, hidden_dim=32,
+              n_speakers=2)
+
+
+@pytest.mark.parametrize('train', [False, True])
+@pytest.mark.parametrize('setting', ['original', 'realtime'])
+@pytest.mark.parametrize('modality', ['t', 'at', 'atv'])
+def test_fused_matches_reference(modality, setting, train):
+    torch.manual_seed(0)
+    # the backends draw their dropout masks differently, so training runs without dropout
+    config = dict(CONFIG, modality=modality, setting=setting, dropout=0.0 if train else 0.5)
+    models = [build_model(dict(config, attention=attention)).train(train) for attention in ['reference', 'fused']]
+    models[1].load_state_dict(models[0].state_dict())
+    textf, visuf, acouf, umask, qmask, _, lengths = random_batch(config, 4, 13)
+    # padded dialogues of 13, 9, 5 and 1 utterances
+    for i, length in enumerate([13, 9, 5, 1]):
+        umask[i, length:] = 0
+    valid = umask.bool()
+
+    with torch.set_grad_enabled(train):
+        outputs = [model(textf, visuf, acouf, umask, qmask, lengths) for model in models]
+    for reference, fused in zip(*outputs):
+        torch.testing.assert_close(fused[valid], reference[valid], rtol=0, atol=1e-5)
+    if train:
+        for model, outs in zip(models, outputs):
+            outs[len(model.encoders)][valid].sum().backward()
+        for (name, reference), fused in zip(models[0].named_parameters(), models[1].parameters()):
+            torch.testing.assert_close(fused.grad, reference.grad, rtol=1e-4, atol=1e-5, msg=name)
@@ -0,0 +1,37 @@
+import pytest
+import torch
+from benchmark.synthetic import random_batch
+from model import build_model
+
+# a small IEMOCAP model
+CONFIG = dict(dataset='IEMOCAP', temp=1, D_text=32, D_visual=16, D_audio=24, n_head=4, n_classes=6, hidden_dim=32,
+              n_speakers=2, dropout=0.5)
+
+
+def assert_state_dicts_equal(state_dict, expected):
+    assert sorted(state_dict) == sorted(expected)
+    for key, value in expected.items():
+        assert torch.equal(state_dict[key], value), key
+
+
+@pytest.mark.parametrize('setting', ['original', 'realtime'])
+@pytest.mark.parametrize('modality', ['t', 'at', 'atv'])
+def test_grouped_round_trip(modality, setting):
+    torch.manual_seed(0)
+    config = dict(CONFIG, modality=modality, setting=setting)
+    per_module = build_model(config).eval()
+    grouped = build_model(dict(config, grouped=True)).eval()
+    grouped.load_state_dict(per_module.state_dict())
+    # the grouped model saves the per-module parameters, and they load back unchanged
+    assert_state_dicts_equal(grouped.state_dict(), per_module.state_dict())
+    round_trip = build_model(config)
+    round_trip.load_state_dict(grouped.state_dict())
+    assert_state_dicts_equal(round_trip.state_dict(), per_module.state_dict())
+
+    textf, visuf, acouf, umask, qmask, _, lengths = random_batch(config, 4, 13)
+    umask[1:, 9:] = 0
+    with torch.no_grad():
+        outputs = [model(textf, visuf, acouf, umask, qmask, lengths) for model in (per_module, grouped)]
+    valid = umask.bool()
+    for expected, out in zip(*outputs):
+        torch.testing.assert_close(out[valid], expected[valid], rtol=0, atol=1e-5)
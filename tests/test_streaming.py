@@ -0,0 +1,38 @@
+import pytest
+import torch
+from benchmark.synthetic import random_batch
+from model import build_model
+from streaming import StreamingSDT
+
+# a small realtime IEMOCAP model
+CONFIG = dict(dataset='IEMOCAP', temp=1, D_text=32, D_visual=16, D_audio=24, n_head=4, n_classes=6, hidden_dim=32,
+              n_speakers=2, dropout=0.5, setting='realtime')
+
+
+def streamed(model, textf, visuf, acouf, qmask):
+    """ all_prob of every utterance, fed to StreamingSDT one at a time: [batch_size, seq_len, n_classes] """
+    streamer = StreamingSDT(model)
+    probs = [streamer.step(textf[i], acouf[i], visuf[i], qmask[:, i])[1] for i in range(textf.size(0))]
+    return torch.stack(probs, 1)
+
+
+@pytest.mark.parametrize('modality', ['t', 'a', 'at', 'atv'])
+def test_streaming_matches_realtime_forward(modality):
+    torch.manual_seed(0)
+    model = build_model(dict(CONFIG, modality=modality)).eval()
+    textf, visuf, acouf, umask, qmask, _, lengths = random_batch(CONFIG, 3, 17)
+    with torch.no_grad():
+        all_prob = model(textf, visuf, acouf, umask, qmask, lengths)[len(model.encoders)+1]
+    torch.testing.assert_close(streamed(model, textf, visuf, acouf, qmask), all_prob, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('positions', ['absolute', 'relative'])
+@pytest.mark.parametrize('summary', [False, True])
+def test_windowed_streaming_matches_windowed_forward(summary, positions):
+    # longer than two windows (older blocks are evicted into the summary) and than the 512 precomputed positions
+    torch.manual_seed(0)
+    model = build_model(dict(CONFIG, modality='atv', window=8, summary=summary, positions=positions)).eval()
+    textf, visuf, acouf, umask, qmask, _, lengths = random_batch(CONFIG, 2, 530)
+    with torch.no_grad():
+        all_prob = model(textf, visuf, acouf, umask, qmask, lengths)[len(model.encoders)+1]
+    torch.testing.assert_close(streamed(model, textf, visuf, acouf, qmask), all_prob, rtol=0, atol=1e-5)
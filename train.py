@@ -1,14 +1,21 @@
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
-import numpy as np, argparse, time
+import numpy as np, argparse, itertools, time, random
 import torch
 import torch.optim as optim
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
-from dataloader import IEMOCAPDataset, MELDDataset
-from model import MaskedNLLLoss, MaskedKLDivLoss, Transformer_Based_Model, Transformer_Based_Model_diverse
-from sklearn.metrics import f1_score, confusion_matrix, accuracy_score, classification_report
+from torch.utils.data.sampler import SubsetRandomSampler, BatchSampler
+from dataloader import IEMOCAPDataset, MELDDataset, FeatureStoreDataset, BucketBatchSampler, PackedDialogues, PackedLoader
+from model import MaskedNLLLoss, MaskedKLDivLoss, build_model, compile_model, \
+    ATTENTION_BACKENDS, DEFAULT_ATTENTION, POSITIONS, PRECISIONS, autocast
+from export import load_checkpoint
+from checkpoint import AsyncCheckpointer, load_training_checkpoint, rng_state, set_rng_state
+from results import ResultsStore
+from metrics import ConfusionMatrix
+from telemetry import Telemetry
+from autobatch import tune
+from quantize import INPUT_LAYERS, conv_to_linear
 import pickle as pk
 import datetime
  
@@ -18,34 +25,43 @@ def get_train_valid_sampler(trainset, valid=0.1, dataset='MELD'):
     split = int(valid*size)
     return SubsetRandomSampler(idx[split:]), SubsetRandomSampler(idx[:split])
 
-def get_MELD_loaders(batch_size=32, valid=0.1, num_workers=0, pin_memory=False):
-    # trainset = MELDDataset('/content/drive/MyDrive/STD_data/meld_multimodal_features.pkl')
-    trainset = MELDDataset(data_path)
-    train_sampler, valid_sampler = get_train_valid_sampler(trainset, valid, 'MELD')
-    train_loader = DataLoader(trainset,
-                              batch_size=batch_size,
-                              sampler=train_sampler,
-                              collate_fn=trainset.collate_fn,
-                              num_workers=num_workers,
-                              pin_memory=pin_memory)
-    valid_loader = DataLoader(trainset,
-                              batch_size=batch_size,
-                              sampler=valid_sampler,
-                              collate_fn=trainset.collate_fn,
-                              num_workers=num_workers,
-                              pin_memory=pin_memory)
-
-    testset = MELDDataset(data_path, train=False)
-    test_loader = DataLoader(testset,
-                             batch_size=batch_size,
-                             collate_fn=testset.collate_fn,
-                             num_workers=num_workers,
-                             pin_memory=pin_memory)
-    return train_loader, valid_loader, test_loader
-
+def get_bucket_samplers(trainset, testset, batch_size, valid=0.1, max_tokens=None, eval_batch_size=None):
+    lengths = trainset.dialogue_lengths()
+    split = int(valid*len(trainset))
+    eval_batch_size = eval_batch_size or batch_size
+    return BucketBatchSampler(lengths, batch_size, range(split, len(trainset)), max_tokens), \
+           BucketBatchSampler(lengths, eval_batch_size, range(split), max_tokens, shuffle=False), \
+           BucketBatchSampler(testset.dialogue_lengths(), eval_batch_size, max_tokens=max_tokens, shuffle=False)
+
+def get_packed_loaders(trainset, testset, batch_size=32, valid=0.1, bucket=False, max_tokens=None, device='cpu', eval_batch_size=None):
+    # splits that are packed already (e.g. in shared memory) are only moved to the device
+    trainset, testset = [dataset.to(device) if isinstance(dataset, PackedDialogues) else PackedDialogues(dataset, device)
+                         for dataset in [trainset, testset]]
+    eval_batch_size = eval_batch_size or batch_size
+    if bucket:
+        samplers = get_bucket_samplers(trainset, testset, batch_size, valid, max_tokens, eval_batch_size)
+    else:
+        train_sampler, valid_sampler = get_train_valid_sampler(trainset, valid)
+        samplers = [BatchSampler(train_sampler, batch_size, False), BatchSampler(valid_sampler, eval_batch_size, False),
+                    BatchSampler(range(len(testset)), eval_batch_size, False)]
+    return [PackedLoader(dataset, sampler) for dataset, sampler in zip([trainset, trainset, testset], samplers)]
+
+def get_loaders(trainset, testset, batch_size=32, valid=0.1, num_workers=0, pin_memory=False, bucket=False, max_tokens=None,
+                in_memory=False, device='cpu', eval_batch_size=None):
+    # validation and test run without autograd and may use larger batches
+    eval_batch_size = eval_batch_size or batch_size
+    # batches sized by padded utterances are always bucketed
+    bucket = bucket or max_tokens is not None
+    if in_memory:
+        return get_packed_loaders(trainset, testset, batch_size, valid, bucket, max_tokens, device, eval_batch_size)
+    if bucket:
+        samplers = get_bucket_samplers(trainset, testset, batch_size, valid, max_tokens, eval_batch_size)
+        return [DataLoader(dataset,
+                           batch_sampler=sampler,
+                           collate_fn=dataset.collate_fn,
+                           num_workers=num_workers,
+                           pin_memory=pin_memory) for dataset, sampler in zip([trainset, trainset, testset], samplers)]
 
-def get_IEMOCAP_loaders(batch_size=32, valid=0.1, num_workers=0, pin_memory=False):
-    trainset = IEMOCAPDataset(data_path)
     train_sampler, valid_sampler = get_train_valid_sampler(trainset, valid)
     train_loader = DataLoader(trainset,
                               batch_size=batch_size,
@@ -54,147 +70,223 @@ def get_IEMOCAP_loaders(batch_size=32, valid=0.1, num_workers=0, pin_memory=Fals
                               num_workers=num_workers,
                               pin_memory=pin_memory)
     valid_loader = DataLoader(trainset,
-                              batch_size=batch_size,
+                              batch_size=eval_batch_size,
                               sampler=valid_sampler,
                               collate_fn=trainset.collate_fn,
                               num_workers=num_workers,
                               pin_memory=pin_memory)
-
-    testset = IEMOCAPDataset(data_path, train=False)
     test_loader = DataLoader(testset,
-                             batch_size=batch_size,
+                             batch_size=eval_batch_size,
                              collate_fn=testset.collate_fn,
                              num_workers=num_workers,
                              pin_memory=pin_memory)
     return train_loader, valid_loader, test_loader
 
-
-def train_or_eval_model(model, loss_function, kl_loss, dataloader, epoch, optimizer=None, train=False, gamma_1=1.0, gamma_2=1.0, gamma_3=1.0):
-    losses, preds, labels, masks = [], [], [], []
-
-    assert not train or optimizer!=None
-    if train:
-        model.train()
+def get_MELD_loaders(batch_size=32, valid=0.1, num_workers=0, pin_memory=False, store=False, bucket=False, max_tokens=None,
+                     in_memory=False, device='cpu', datasets=None, eval_batch_size=None):
+    # trainset = MELDDataset('/content/drive/MyDrive/STD_data/meld_multimodal_features.pkl')
+    if datasets is not None:
+        trainset, testset = datasets
     else:
-        model.eval()
-
-    for data in dataloader:
-        if train:
-            optimizer.zero_grad()
-        
-        textf, visuf, acouf, qmask, umask, label = [d.cuda() for d in data[:-1]] if cuda else data[:-1] 
-        qmask = qmask.permute(1, 0, 2)
-        lengths = [(umask[j] == 1).nonzero().tolist()[-1][0] + 1 for j in range(len(umask))]
-        '''/
-        Ritesh
-        for each modality, there is slight difference in the loss calculation, else same
-        /'''
-
-        if modality=='t' or modality=='a':
-            log_prob1, all_log_prob, all_prob, \
-            kl_log_prob1, kl_all_prob = model(textf, visuf, acouf, umask, qmask, lengths, modality, setting)
-
-            lp_1 = log_prob1.view(-1, log_prob1.size()[2])
-            lp_all = all_log_prob.view(-1, all_log_prob.size()[2])
-            labels_ = label.view(-1)
-
-            kl_lp_1 = kl_log_prob1.view(-1, kl_log_prob1.size()[2])
-            kl_p_all = kl_all_prob.view(-1, kl_all_prob.size()[2])
-
-            loss = gamma_1 * loss_function(lp_all, labels_, umask) + \
-                    gamma_2 * (loss_function(lp_1, labels_, umask) ) + \
-                   gamma_3 * (kl_loss(kl_lp_1, kl_p_all, umask))
-
-        elif modality=='at':
-            log_prob1, log_prob2, all_log_prob, all_prob, \
-            kl_log_prob1, kl_log_prob2, kl_all_prob = model(textf, visuf, acouf, umask, qmask, lengths, modality, setting)
-
-            lp_1 = log_prob1.view(-1, log_prob1.size()[2])
-            lp_2 = log_prob2.view(-1, log_prob2.size()[2])
-            lp_all = all_log_prob.view(-1, all_log_prob.size()[2])
-            labels_ = label.view(-1)
+        trainset = FeatureStoreDataset(data_path) if store else MELDDataset(data_path)
+        testset = FeatureStoreDataset(data_path, train=False) if store else MELDDataset(data_path, train=False)
+    return get_loaders(trainset, testset, batch_size, valid, num_workers, pin_memory, bucket, max_tokens, in_memory, device, eval_batch_size)
 
-            kl_lp_1 = kl_log_prob1.view(-1, kl_log_prob1.size()[2])
-            kl_lp_2 = kl_log_prob2.view(-1, kl_log_prob2.size()[2])
-            kl_p_all = kl_all_prob.view(-1, kl_all_prob.size()[2])
 
+def get_IEMOCAP_loaders(batch_size=32, valid=0.1, num_workers=0, pin_memory=False, store=False, bucket=False, max_tokens=None,
+                        in_memory=False, device='cpu', datasets=None, eval_batch_size=None):
+    if datasets is not None:
+        trainset, testset = datasets
+    else:
+        trainset = FeatureStoreDataset(data_path) if store else IEMOCAPDataset(data_path)
+        testset = FeatureStoreDataset(data_path, train=False) if store else IEMOCAPDataset(data_path, train=False)
+    return get_loaders(trainset, testset, batch_size, valid, num_workers, pin_memory, bucket, max_tokens, in_memory, device, eval_batch_size)
 
-            loss =  gamma_1 * loss_function(lp_all, labels_, umask) + \
-                    gamma_2 * (loss_function(lp_1, labels_, umask) + loss_function(lp_2, labels_, umask)) + \
-                    gamma_3 * (kl_loss(kl_lp_1, kl_p_all, umask) + kl_loss(kl_lp_2, kl_p_all, umask))
-
-        else:
-            log_prob1, log_prob2, log_prob3, all_log_prob, all_prob, \
-            kl_log_prob1, kl_log_prob2, kl_log_prob3, kl_all_prob = model(textf, visuf, acouf, umask, qmask, lengths, modality, setting)
 
-            lp_1 = log_prob1.view(-1, log_prob1.size()[2])
-            lp_2 = log_prob2.view(-1, log_prob2.size()[2])
-            lp_3 = log_prob3.view(-1, log_prob3.size()[2])
-            lp_all = all_log_prob.view(-1, all_log_prob.size()[2])
+def sdt_loss(outputs, labels_, umask, loss_function, kl_loss, gamma_1=1.0, gamma_2=1.0, gamma_3=1.0, normalisers=(None, None)):
+    '''/
+    Ritesh
+    for each modality, there is slight difference in the loss calculation, else same:
+    the outputs hold one log prob and one kl log prob per modality around all_log_prob,
+    all_prob and kl_all_prob (see Transformer_Based_Model.fuse).
+    normalisers are the NLL and KL denominators of the whole batch when this is a micro-batch
+    /'''
+    n = (len(outputs) - 3) // 2
+    nll_normaliser, kl_normaliser = normalisers
+    flatten = lambda x: x.view(-1, x.size()[2])
+    lp_all, kl_p_all = flatten(outputs[n]), flatten(outputs[-1])
+    loss = gamma_1 * loss_function(lp_all, labels_, umask, nll_normaliser) + \
+           gamma_2 * sum(loss_function(flatten(lp), labels_, umask, nll_normaliser) for lp in outputs[:n]) + \
+           gamma_3 * sum(kl_loss(flatten(kl_lp), kl_p_all, umask, kl_normaliser) for kl_lp in outputs[n+2:-1])
+    return loss, lp_all
+
+
+def train_or_eval_model(model, loss_function, kl_loss, dataloader, epoch, optimizer=None, train=False, gamma_1=1.0, gamma_2=1.0, gamma_3=1.0,
+                        precision='fp32', teacher=None, gamma_4=1.0, distill_temp=1.0, micro_batcher=None):
+    """ one epoch; returns the average loss and the ConfusionMatrix of the predictions (evaluation runs in evaluate_model).
+    With a micro_batcher (--memory-budget), every batch runs as micro-batches whose gradients add up before the optimizer step """
+    if not train:
+        return evaluate_model(model, loss_function, kl_loss, dataloader, precision, gamma_1, gamma_2, gamma_3)
+    assert optimizer!=None
+    model.train()
+    confusion = ConfusionMatrix(n_classes, device)
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    telemetry.start()
+    for batch in dataloader:
+        telemetry.mark('data')
+        optimizer.zero_grad()
+        micro_batches = micro_batcher.split(batch) if micro_batcher is not None else [batch]
+        normalisers, batch_utterances = (None, None), None
+        if len(micro_batches) > 1:
+            # every micro-batch loss is divided by the denominators of the whole batch, so the gradients add up to the batch gradient
+            batch_umask, batch_labels = batch[4].to(device, non_blocking=True), batch[5].to(device, non_blocking=True).view(-1)
+            normalisers = (loss_function.normaliser(batch_labels, batch_umask), kl_loss.normaliser(batch_umask))
+            batch_utterances = batch_umask.sum()
+
+        for data in micro_batches:
+            textf, visuf, acouf, qmask, umask, label, lengths = [d.to(device, non_blocking=True) for d in data[:-1]]
+            qmask = qmask.permute(1, 0, 2)
+            telemetry.mark('h2d')
+            with autocast(device, precision):
+                outputs = model(textf, visuf, acouf, umask, qmask, lengths, modality, setting)
+            telemetry.mark('forward')
             labels_ = label.view(-1)
+            loss, lp_all = sdt_loss(outputs, labels_, umask, loss_function, kl_loss, gamma_1, gamma_2, gamma_3, normalisers)
 
-            kl_lp_1 = kl_log_prob1.view(-1, kl_log_prob1.size()[2])
-            kl_lp_2 = kl_log_prob2.view(-1, kl_log_prob2.size()[2])
-            kl_lp_3 = kl_log_prob3.view(-1, kl_log_prob3.size()[2])
-            kl_p_all = kl_all_prob.view(-1, kl_all_prob.size()[2])
-
-            loss = gamma_1 * loss_function(lp_all, labels_, umask) + \
-                    gamma_2 * (loss_function(lp_1, labels_, umask) + loss_function(lp_2, labels_, umask) + loss_function(lp_3, labels_, umask)) + \
-                   gamma_3 * (kl_loss(kl_lp_1, kl_p_all, umask) + kl_loss(kl_lp_2, kl_p_all, umask) + kl_loss(kl_lp_3, kl_p_all, umask))
-
-
-        # ORIGINAL #
-        # log_prob1, log_prob2, log_prob3, all_log_prob, all_prob, \
-        # kl_log_prob1, kl_log_prob2, kl_log_prob3, kl_all_prob = model(textf, visuf, acouf, umask, qmask, lengths)
+            # ORIGINAL #
+            # log_prob1, log_prob2, log_prob3, all_log_prob, all_prob, \
+            # kl_log_prob1, kl_log_prob2, kl_log_prob3, kl_all_prob = model(textf, visuf, acouf, umask, qmask, lengths)
         
-        # lp_1 = log_prob1.view(-1, log_prob1.size()[2])
-        # lp_2 = log_prob2.view(-1, log_prob2.size()[2])
-        # lp_3 = log_prob3.view(-1, log_prob3.size()[2])
-        # lp_all = all_log_prob.view(-1, all_log_prob.size()[2])
-        # labels_ = label.view(-1)
+            # lp_1 = log_prob1.view(-1, log_prob1.size()[2])
+            # lp_2 = log_prob2.view(-1, log_prob2.size()[2])
+            # lp_3 = log_prob3.view(-1, log_prob3.size()[2])
+            # lp_all = all_log_prob.view(-1, all_log_prob.size()[2])
+            # labels_ = label.view(-1)
 
-        # kl_lp_1 = kl_log_prob1.view(-1, kl_log_prob1.size()[2])
-        # kl_lp_2 = kl_log_prob2.view(-1, kl_log_prob2.size()[2])
-        # kl_lp_3 = kl_log_prob3.view(-1, kl_log_prob3.size()[2])
-        # kl_p_all = kl_all_prob.view(-1, kl_all_prob.size()[2])
+            # kl_lp_1 = kl_log_prob1.view(-1, kl_log_prob1.size()[2])
+            # kl_lp_2 = kl_log_prob2.view(-1, kl_log_prob2.size()[2])
+            # kl_lp_3 = kl_log_prob3.view(-1, kl_log_prob3.size()[2])
+            # kl_p_all = kl_all_prob.view(-1, kl_all_prob.size()[2])
 
         
-        # loss = gamma_1 * loss_function(lp_all, labels_, umask) + \
-        #         gamma_2 * (loss_function(lp_1, labels_, umask) + loss_function(lp_2, labels_, umask) + loss_function(lp_3, labels_, umask)) + \
-        #        gamma_3 * (kl_loss(kl_lp_1, kl_p_all, umask) + kl_loss(kl_lp_2, kl_p_all, umask) + kl_loss(kl_lp_3, kl_p_all, umask))
-
-        '''/
-        No changes below
-        /'''
-        lp_ = all_prob.view(-1, all_prob.size()[2])
-
-        pred_ = torch.argmax(lp_,1)
-        preds.append(pred_.data.cpu().numpy())
-        labels.append(labels_.data.cpu().numpy())
-        masks.append(umask.view(-1).cpu().numpy())
-
-        losses.append(loss.item()*masks[-1].sum())
-        if train:
-            loss.backward()
-            if args.tensorboard:
-                for param in model.named_parameters():
-                    writer.add_histogram(param[0], param[1].grad, epoch)
-            optimizer.step()
-
-    if preds!=[]:
-        preds = np.concatenate(preds)
-        labels = np.concatenate(labels)
-        masks = np.concatenate(masks)
-    else:
-        return float('nan'), float('nan'), [], [], [], float('nan')
+            # loss = gamma_1 * loss_function(lp_all, labels_, umask) + \
+            #         gamma_2 * (loss_function(lp_1, labels_, umask) + loss_function(lp_2, labels_, umask) + loss_function(lp_3, labels_, umask)) + \
+            #        gamma_3 * (kl_loss(kl_lp_1, kl_p_all, umask) + kl_loss(kl_lp_2, kl_p_all, umask) + kl_loss(kl_lp_3, kl_p_all, umask))
+
+            '''/
+            distillation: while training, the fused distribution of the model also follows the
+            softened all_prob of a frozen teacher (log_softmax is shift invariant, so softening
+            the log probs by 1/T is the same as softening the logits)
+            /'''
+            if teacher is not None:
+                with torch.no_grad(), autocast(device, precision):
+                    teacher_log_prob = teacher(textf, visuf, acouf, umask, qmask)[len(teacher.encoders)]
+                teacher_prob = torch.softmax(teacher_log_prob.view(-1, teacher_log_prob.size(2)).float() / distill_temp, 1)
+                loss = loss + gamma_4 * kl_loss(torch.log_softmax(lp_all / distill_temp, 1), teacher_prob, umask, normalisers[1])
+
+            # metrics stay on the device, no host copy or sync per batch
+            all_prob = outputs[len(outputs)//2]
+            confusion.update(labels_, torch.argmax(all_prob, 2), umask)
+            # a micro-batch loss is its share of the loss of the whole batch
+            loss_sum += loss.detach().double() * (umask.sum() if batch_utterances is None else batch_utterances)
+            telemetry.mark('loss')
 
-    avg_loss = round(np.sum(losses)/np.sum(masks), 4)
-    avg_accuracy = round(accuracy_score(labels,preds, sample_weight=masks)*100, 2)
-    avg_fscore = round(f1_score(labels,preds, sample_weight=masks, average='weighted')*100, 2)  
-    return avg_loss, avg_accuracy, labels, preds, masks, avg_fscore
-
-
-if __name__ == '__main__':
+            loss.backward()
+            telemetry.mark('backward')
+        optimizer.step()
+        telemetry.mark('optimizer')
+        # gradient histograms every --histogram-every steps, written by a background thread
+        telemetry.step(model)
+
+    return round(float(loss_sum) / confusion.total(), 4) if confusion.total() else float('nan'), confusion
+
+
+def evaluate_model(model, loss_function, kl_loss, dataloader, precision='fp32', gamma_1=1.0, gamma_2=1.0, gamma_3=1.0):
+    """ validation/test pass without autograd: the average loss and the ConfusionMatrix of the predictions """
+    model.eval()
+    confusion = ConfusionMatrix(n_classes, device)
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    with torch.no_grad():
+        for data in dataloader:
+            textf, visuf, acouf, qmask, umask, label, lengths = [d.to(device, non_blocking=True) for d in data[:-1]]
+            with autocast(device, precision):
+                outputs = model(textf, visuf, acouf, umask, qmask.permute(1, 0, 2), lengths, modality, setting)
+            labels_ = label.view(-1)
+            loss, _ = sdt_loss(outputs, labels_, umask, loss_function, kl_loss, gamma_1, gamma_2, gamma_3)
+            confusion.update(labels_, torch.argmax(outputs[len(outputs)//2], 2), umask)
+            loss_sum += loss.double() * umask.sum()
+    return round(float(loss_sum) / confusion.total(), 4) if confusion.total() else float('nan'), confusion
+
+
+def eval_inference(model, dataloader, precision='fp32'):
+    """ test fscore and throughput of a model of any modality and setting (e.g. a distillation teacher) """
+    model.eval()
+    confusion = ConfusionMatrix(n_classes, device)
+    start_time = time.time()
+    with torch.no_grad(), autocast(device, precision):
+        for data in dataloader:
+            textf, visuf, acouf, qmask, umask, label, lengths = [d.to(device, non_blocking=True) for d in data[:-1]]
+            all_prob = model(textf, visuf, acouf, umask, qmask.permute(1, 0, 2))[len(model.encoders)+1]
+            confusion.update(label, torch.argmax(all_prob, 2), umask)
+    utterances = confusion.total()
+    return confusion.fscore(), round(utterances/(time.time() - start_time), 1)
+
+
+def profile_model(config, loader, loss_function, kl_loss, steps, trace_dir=None):
+    """ train.py --profile: per-module forward/backward time, FLOPs and activation memory over a few training steps """
+    # imported here: the profiler needs torch.utils.flop_counter, training does not
+    from profiler import ModuleProfiler
+    model = build_model(config)
+    model.set_checkpointing(args.activation_checkpointing)
+    # the 1x1 input convolutions run as F.linear (no module call); as nn.Linear the hooks see them
+    for name in INPUT_LAYERS:
+        if hasattr(model, name):
+            setattr(model, name, conv_to_linear(getattr(model, name)))
+    model.to(device).train()
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.l2)
+    profiler = ModuleProfiler(model, synchronize=args.cuda)
+    batches = list(itertools.islice(itertools.cycle(loader), steps))
+
+    def step(data):
+        textf, visuf, acouf, qmask, umask, label, lengths = [d.to(device, non_blocking=True) for d in data[:-1]]
+        optimizer.zero_grad()
+        with autocast(device, args.precision):
+            outputs = model(textf, visuf, acouf, umask, qmask.permute(1, 0, 2), lengths, config['modality'], config['setting'])
+        with profiler.region('loss'):
+            loss, _ = sdt_loss(outputs, label.view(-1), umask, loss_function, kl_loss, args.gamma_1, args.gamma_2, args.gamma_3)
+        profiler.backward(loss, 'loss')
+        start = profiler.now()
+        optimizer.step()
+        profiler.add('optimizer.step', 'backward', profiler.now() - start)
+
+    # the FLOP count also warms up the allocator (and Adam's state) before the timed steps
+    profiler.count_flops(lambda: step(batches[0]))
+    start = profiler.now()
+    for data in batches:
+        with profiler.step():
+            step(data)
+    step_ms = (profiler.now() - start) / steps * 1000
+    print('profile of modality {}, setting {}: {} steps, {} utterances per step (ms per step)'.format(
+        config['modality'], config['setting'], steps, int(sum(d[4].sum() for d in batches) / steps)))
+    print(profiler.table(step_ms))
+    rows = profiler.rows()
+    memory = profiler.memory(rows)
+
+    if trace_dir:
+        os.makedirs(trace_dir, exist_ok=True)
+        path = os.path.join(trace_dir, 'trace_{}_{}.json'.format(config['modality'], config['setting']))
+        activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if args.cuda else [])
+        with torch.profiler.profile(activities=activities, profile_memory=True, record_shapes=True) as trace:
+            for data in batches[:3]:
+                step(data)
+        trace.export_chrome_trace(path)
+        print('trace written to {}'.format(path))
+    profiler.remove()
+    return rows, step_ms, memory
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--no-cuda', action='store_true', default=False, help='does not use GPU')
     parser.add_argument('--lr', type=float, default=0.0001, metavar='LR', help='learning rate')
@@ -206,30 +298,105 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=150, metavar='E', help='number of epochs')
     parser.add_argument('--temp', type=int, default=1, metavar='temp', help='temp')
     parser.add_argument('--tensorboard', action='store_true', default=False, help='Enables tensorboard log')
+    parser.add_argument('--histogram-every', type=int, default=100, metavar='N', help='with --tensorboard, log gradient histograms every N training steps (0 disables)')
+    parser.add_argument('--telemetry', action='store_true', default=False, help='time the phases of every training step and print them per epoch')
     parser.add_argument('--class-weight', action='store_true', default=True, help='use class weights')
     parser.add_argument('--Dataset', default='IEMOCAP', help='dataset to train and test')
     parser.add_argument('--Data_dir', default='./data', help='data directory to train and test')
+    parser.add_argument('--feature-store', action='store_true', default=False, help='read the memory-mapped store written by convert_features.py')
+    parser.add_argument('--bucket', action='store_true', default=False, help='batch dialogues of similar length together')
+    parser.add_argument('--max-tokens', type=int, default=None, metavar='MT', help='size batches by padded utterances instead of --batch-size (implies --bucket)')
+    parser.add_argument('--in-memory', action='store_true', default=False, help='pack the dataset into tensors on the training device once and batch by index gathers')
     parser.add_argument('--modality', default='atv', help='modality to be used for training and testing')
     parser.add_argument('--setting', default='original', help='original for original and realtime for realtime setting')
-
-    args = parser.parse_args()
+    parser.add_argument('--attention', default=DEFAULT_ATTENTION, choices=ATTENTION_BACKENDS, help='fused (scaled_dot_product_attention) or reference attention')
+    parser.add_argument('--grouped', action='store_true', default=False, help='run the cross-modal encoders as one batched module')
+    parser.add_argument('--window', type=int, default=None, metavar='W', help='long dialogues: attend over windows of W utterances (the own and previous window, and the next one unless realtime)')
+    parser.add_argument('--window-summary', action='store_true', default=False, help='with --window, add the mean of the utterances outside the window as one more key')
+    parser.add_argument('--positions', default='absolute', choices=POSITIONS, help='absolute (sinusoids) or relative (distance bias in attention, needs --window) positions')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='fp32 or bf16 autocast for training and evaluation')
+    parser.add_argument('--compile', action='store_true', default=False, help='train with a torch.compile graph of the model (evaluation stays eager)')
+    parser.add_argument('--save-model', default=None, metavar='PATH', help='save the config and weights of the best epoch (see export.py)')
+    parser.add_argument('--seed', type=int, default=None, help='seed torch, numpy and random (unseeded by default)')
+    parser.add_argument('--checkpoint-dir', default=None, metavar='DIR', help='write last.pt (periodic) and best.pt (best test F1) training checkpoints here')
+    parser.add_argument('--checkpoint-every', type=int, default=1, metavar='N', help='write last.pt every N epochs')
+    parser.add_argument('--resume', action='store_true', default=False, help='continue from <checkpoint-dir>/last.pt if it exists')
+    parser.add_argument('--teacher', default=None, metavar='PATH', help='distil from the all_prob of a model saved with --save-model')
+    parser.add_argument('--distill-temp', type=float, default=1.0, help='temperature of the teacher and student distributions in distillation')
+    parser.add_argument('--gamma-distill', type=float, default=1.0, help='weight of the distillation loss')
+    parser.add_argument('--valid', type=float, default=0.0, help='fraction of the training dialogues held out for validation')
+    parser.add_argument('--gamma-1', type=float, default=1.0, help='weight of the fused classification loss')
+    parser.add_argument('--gamma-2', type=float, default=1.0, help='weight of the per-modality classification losses')
+    parser.add_argument('--gamma-3', type=float, default=1.0, help='weight of the self-distillation (KL) losses')
+    parser.add_argument('--eval-batch-size', type=int, default=None, metavar='BS', help='batch size of validation and test (default --batch-size)')
+    parser.add_argument('--eval-every', type=int, default=1, metavar='N', help='validate and test every N epochs (and after the last one)')
+    parser.add_argument('--activation-checkpointing', default=None, metavar='SPEC', help='recompute encoder activations in backward: comma-separated groups (all, intra, inter, t, a, v or an encoder like a_t), :ffn for the feed-forward blocks only')
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='GB', help='split training batches into the largest micro-batches that fit this much memory and accumulate their gradients')
+    parser.add_argument('--micro-batch', default='dialogues', choices=['dialogues', 'tokens'], help='with --memory-budget, bound micro-batches by dialogues or by padded utterances')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help='instead of training, profile N training steps per module and exit')
+    parser.add_argument('--profile-all', action='store_true', default=False, help='with --profile, profile every modality (t, a, at, atv) and setting')
+    parser.add_argument('--profile-trace', default=None, metavar='DIR', help='with --profile, also write a torch.profiler (chrome) trace per model here')
+    parser.add_argument('--results', default=None, metavar='PATH', help='append the result of the run to this JSON lines store instead of record_*.pk')
+    return parser
+
+
+# arguments that shape the training trajectory besides the model config; a resumed run must use the same
+TRAINING_ARGS = ['lr', 'l2', 'batch_size', 'epochs', 'gamma_1', 'gamma_2', 'gamma_3', 'teacher', 'gamma_distill', 'distill_temp',
+                 'bucket', 'max_tokens', 'valid', 'eval_every', 'precision', 'seed']
+
+def changed_training_args(args, saved):
+    return [name for name in TRAINING_ARGS if saved.get(name) != getattr(args, name)]
+
+
+'''/
+one training run. The helpers above read device, modality, setting, args, writer and
+data_path as module globals, so main sets them for the run. datasets: (trainset, testset)
+already loaded, e.g. shared by run_seeds.py. report(epoch, valid_fscore) is called after
+every epoch and stops the run when it returns True (sweep.py). Returns the result record
+/'''
+def main(arguments, datasets=None, report=None):
+    global args, device, modality, setting, writer, telemetry, data_path, n_classes
+    args = arguments
+    start = time.time()
     today = datetime.datetime.now()
     print(args)
 
+    # a resumed run that already recorded its result returns it instead of recording it again
+    if args.resume and args.checkpoint_dir and os.path.exists(os.path.join(args.checkpoint_dir, 'result.pk')):
+        with open(os.path.join(args.checkpoint_dir, 'result.pk'), 'rb') as f:
+            result = pk.load(f)
+        changed = changed_training_args(args, result['args'])
+        assert not changed, 'the run in {} was trained with different {}'.format(args.checkpoint_dir, ', '.join('--' + name for name in changed))
+        print('the run in {} is complete (F-Score: {}), not recording it again'.format(args.checkpoint_dir, result['best_fscore']))
+        return result
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        random.seed(args.seed)
+
     args.cuda = torch.cuda.is_available() and not args.no_cuda
     if args.cuda:
         print('Running on GPU')
     else:
         print('Running on CPU')
 
+    writer = None
     if args.tensorboard:
         from tensorboardX import SummaryWriter
         writer = SummaryWriter()
+    telemetry = Telemetry(writer, args.histogram_every, enabled=args.telemetry, synchronize=args.cuda)
 
     cuda = args.cuda
+    device = torch.device('cuda' if cuda else 'cpu')
     n_epochs = args.epochs
     batch_size = args.batch_size
-    data_path = f'{args.Data_dir}/{args.Dataset.lower()}_multimodal_features.pkl'
+    # batches sized by padded utterances are always bucketed (get_loaders)
+    bucket = args.bucket or args.max_tokens is not None
+    if args.feature_store:
+        data_path = f'{args.Data_dir}/{args.Dataset.lower()}_features'
+    else:
+        data_path = f'{args.Data_dir}/{args.Dataset.lower()}_multimodal_features.pkl'
     modality = args.modality
     setting = args.setting
     feat2dim = {'IS10':1582, 'denseface':342, 'MELD_audio':300}
@@ -246,37 +413,50 @@ if __name__ == '__main__':
 
     '''/
     Ritesh:
-    model selection depending on the argument 'setting'
+    model selection depending on the argument 'setting' (build_model picks
+    Transformer_Based_Model_diverse for realtime)
     /'''
-    if setting =='realtime':
-        model = Transformer_Based_Model_diverse(args.Dataset, args.temp, D_text, D_visual, D_audio, args.n_head,
-                                        n_classes=n_classes,
-                                        hidden_dim=args.hidden_dim,
-                                        n_speakers=n_speakers,
-                                        dropout=args.dropout)
-    else:
-        model = Transformer_Based_Model(args.Dataset, args.temp, D_text, D_visual, D_audio, args.n_head,
-                                        n_classes=n_classes,
-                                        hidden_dim=args.hidden_dim,
-                                        n_speakers=n_speakers,
-                                        dropout=args.dropout)
+    config = dict(dataset=args.Dataset, temp=args.temp, D_text=D_text, D_visual=D_visual, D_audio=D_audio, n_head=args.n_head,
+                  n_classes=n_classes, hidden_dim=args.hidden_dim, n_speakers=n_speakers, dropout=args.dropout,
+                  modality=modality, attention=args.attention, grouped=args.grouped, setting=setting,
+                  window=args.window, summary=args.window_summary, positions=args.positions)
+    model = build_model(config)
+    model.set_checkpointing(args.activation_checkpointing)
 
     total_params = sum(p.numel() for p in model.parameters())
     print('total parameters: {}'.format(total_params))
     total_trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('training parameters: {}'.format(total_trainable_params))
 
-    if cuda:
-        model.cuda()
-        
+    model.to(device)
+    # modality and setting are fixed in the model, so one graph (with dynamic batch and dialogue sizes) covers every step.
+    # Only training runs compiled: evaluation would compile a second graph, and compiled inference was no faster on IEMOCAP
+    # shapes (bench_compile.py --step inference)
+    forward_model = compile_model(model) if args.compile else model
+
+    # distillation: a frozen teacher of any size, modality or setting trained on the same dataset
+    teacher = None
+    if args.teacher:
+        teacher, teacher_config = load_checkpoint(args.teacher)
+        assert teacher_config['dataset'] == args.Dataset, 'the teacher was trained on {}'.format(teacher_config['dataset'])
+        teacher.to(device).requires_grad_(False)
+
     kl_loss = MaskedKLDivLoss()
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.l2)
 
     if args.Dataset == 'MELD':
         loss_function = MaskedNLLLoss()
-        train_loader, valid_loader, test_loader = get_MELD_loaders(valid=0.0,
+        train_loader, valid_loader, test_loader = get_MELD_loaders(valid=args.valid,
                                                                     batch_size=batch_size,
-                                                                    num_workers=0)
+                                                                    num_workers=0,
+                                                                    pin_memory=cuda,
+                                                                    store=args.feature_store,
+                                                                    bucket=bucket,
+                                                                    max_tokens=args.max_tokens,
+                                                                    in_memory=args.in_memory,
+                                                                    device=device,
+                                                                    datasets=datasets,
+                                                                    eval_batch_size=args.eval_batch_size)
     elif args.Dataset == 'IEMOCAP':
         loss_weights = torch.FloatTensor([1/0.086747,
                                         1/0.144406,
@@ -284,48 +464,185 @@ if __name__ == '__main__':
                                         1/0.160585,
                                         1/0.127711,
                                         1/0.252668])
-        loss_function = MaskedNLLLoss(loss_weights.cuda() if cuda else loss_weights)
-        train_loader, valid_loader, test_loader = get_IEMOCAP_loaders(valid=0.0,
+        loss_function = MaskedNLLLoss(loss_weights.to(device))
+        train_loader, valid_loader, test_loader = get_IEMOCAP_loaders(valid=args.valid,
                                                                       batch_size=batch_size,
-                                                                      num_workers=0)
+                                                                      num_workers=0,
+                                                                      pin_memory=cuda,
+                                                                      store=args.feature_store,
+                                                                      bucket=bucket,
+                                                                      max_tokens=args.max_tokens,
+                                                                      in_memory=args.in_memory,
+                                                                      device=device,
+                                                                      datasets=datasets,
+                                                                      eval_batch_size=args.eval_batch_size)
     else:
         print("There is no such dataset")
 
-    best_fscore, best_loss, best_label, best_pred, best_mask = None, None, None, None, None
-    all_fscore, all_acc, all_loss = [], [], []
+    if args.profile:
+        # no training: profile the configured model (or every modality and setting) and return
+        combinations = [(m, s) for s in ['original', 'realtime'] for m in ['t', 'a', 'at', 'atv']] if args.profile_all else [(modality, setting)]
+        summary = []
+        for m, s in combinations:
+            rows, step_ms, memory = profile_model(dict(config, modality=m, setting=s), train_loader, loss_function, kl_loss, args.profile, args.profile_trace)
+            summary.append((m, s, step_ms, sum(r['forward_gflop'] + r['backward_gflop'] for r in rows), memory))
+        if len(summary) > 1:
+            # peak memory of the step on CUDA, the saved-for-backward proxy on the CPU
+            print('{:<9} {:<9} {:>10} {:>10} {:>10}'.format('modality', 'setting', 'step ms', 'GFLOP', 'peak MB' if args.cuda else 'saved MB*'))
+            for row in summary:
+                print('{:<9} {:<9} {:>10.3f} {:>10.4f} {:>10.2f}'.format(*row))
+        return None
+
+    micro_batcher = None
+    if args.memory_budget:
+        # probed on dialogues as long as the longest training dialogue; the batches of --batch-size stay the effective batches
+        lengths = (train_loader.packed if isinstance(train_loader, PackedLoader) else train_loader.dataset).dialogue_lengths()
+        loss = lambda outputs, labels_, umask: sdt_loss(outputs, labels_, umask, loss_function, kl_loss, args.gamma_1, args.gamma_2, args.gamma_3)[0]
+        limit = len(lengths) if args.max_tokens else batch_size
+        micro_batcher, dialogues, memory = tune(model, config, loss, max(lengths), args.memory_budget * 2**30, limit, args.micro_batch, device, args.precision)
+        print('memory budget {} GB: micro-batches of at most {} {} ({} dialogues of {} utterances need {:.0f} MB), gradients accumulated over each batch'.format(
+            args.memory_budget, dialogues if args.micro_batch == 'dialogues' else dialogues * max(lengths), args.micro_batch,
+            dialogues, max(lengths), memory / 2**20))
+
+    best_fscore, best_loss, best_metrics = None, None, None
+    all_fscore, all_acc, all_loss, all_valid_fscore, eval_epochs = [], [], [], [], []
+    best_state, start_epoch = None, 0
 
-    for e in range(n_epochs):
+    '''/
+    checkpoints hold everything the rest of the run depends on (weights, Adam state, RNG
+    state and the best-epoch bookkeeping), so a resumed run continues bit-for-bit
+    /'''
+    checkpointer = AsyncCheckpointer(args.checkpoint_dir) if args.checkpoint_dir else None
+    if args.resume and checkpointer and os.path.exists(checkpointer.path('last.pt')):
+        state = load_training_checkpoint(checkpointer.path('last.pt'))
+        assert state['config'] == config, 'the checkpoint was written with a different model config'
+        changed = changed_training_args(args, state['training'])
+        assert not changed, 'the checkpoint was written with different {}'.format(', '.join('--' + name for name in changed))
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        best_fscore, best_metrics, all_fscore, all_acc, all_loss, all_valid_fscore, eval_epochs, best_state = \
+            [state['history'][k] for k in ['best_fscore', 'best_metrics', 'all_fscore', 'all_acc', 'all_loss', 'all_valid_fscore',
+                                           'eval_epochs', 'best_state']]
+        set_rng_state(state['rng'])
+        start_epoch = state['epoch']
+        print('resumed from {} after epoch {}'.format(checkpointer.path('last.pt'), start_epoch))
+
+    def training_state(epoch):
+        return {'config': config, 'training': {name: getattr(args, name) for name in TRAINING_ARGS}, 'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'rng': rng_state(),
+                'history': {'best_fscore': best_fscore, 'best_metrics': best_metrics, 'all_fscore': all_fscore, 'all_acc': all_acc,
+                            'all_loss': all_loss, 'all_valid_fscore': all_valid_fscore, 'eval_epochs': eval_epochs, 'best_state': best_state}}
+
+    for e in range(start_epoch, n_epochs):
         start_time = time.time()
-
-        train_loss, train_acc, _, _, _, train_fscore = train_or_eval_model(model, loss_function, kl_loss, train_loader, e, optimizer, True)
-        valid_loss, valid_acc, _, _, _, valid_fscore = train_or_eval_model(model, loss_function, kl_loss, valid_loader, e)
-        test_loss, test_acc, test_label, test_pred, test_mask, test_fscore = train_or_eval_model(model, loss_function, kl_loss, test_loader, e)
-        all_fscore.append(test_fscore)
-
-        if best_fscore == None or best_fscore < test_fscore:
+        if bucket:
+            # batches are drawn from the RNG at the start of every epoch (also the first one after a resume)
+            train_loader.batch_sampler.set_epoch(e)
+
+        gammas = dict(gamma_1=args.gamma_1, gamma_2=args.gamma_2, gamma_3=args.gamma_3)
+        train_loss, train_metrics = train_or_eval_model(forward_model, loss_function, kl_loss, train_loader, e, optimizer, True, **gammas,
+                                                        precision=args.precision, teacher=teacher,
+                                                        gamma_4=args.gamma_distill, distill_temp=args.distill_temp, micro_batcher=micro_batcher)
+        train_acc, train_fscore = train_metrics.accuracy(), train_metrics.fscore()
+        train_time = time.time() - start_time
+
+        # validation (skipped when there is no validation split) and test every --eval-every epochs and after the last one
+        evaluated = (e+1) % args.eval_every == 0 or e+1 == n_epochs
+        valid_loss, valid_metrics = float('nan'), ConfusionMatrix(n_classes)
+        test_loss, test_metrics = float('nan'), ConfusionMatrix(n_classes)
+        if evaluated and len(valid_loader):
+            valid_loss, valid_metrics = evaluate_model(model, loss_function, kl_loss, valid_loader, args.precision, **gammas)
+        if evaluated:
+            test_loss, test_metrics = evaluate_model(model, loss_function, kl_loss, test_loader, args.precision, **gammas)
+        valid_acc, valid_fscore = valid_metrics.accuracy(), valid_metrics.fscore()
+        test_acc, test_fscore = test_metrics.accuracy(), test_metrics.fscore()
+        if evaluated:
+            all_fscore.append(test_fscore)
+            all_acc.append(test_acc)
+            all_loss.append(test_loss)
+            all_valid_fscore.append(valid_fscore)
+            eval_epochs.append(e+1)
+
+        improved = evaluated and (best_fscore == None or best_fscore < test_fscore)
+        if improved:
             best_fscore = test_fscore
-            best_label, best_pred, best_mask = test_label, test_pred, test_mask
-
-        if args.tensorboard:
-            writer.add_scalar('test: accuracy', test_acc, e)
-            writer.add_scalar('test: fscore', test_fscore, e)
-            writer.add_scalar('train: accuracy', train_acc, e)
-            writer.add_scalar('train: fscore', train_fscore, e)
-
-        print('epoch: {}, train_loss: {}, train_acc: {}, train_fscore: {}, valid_loss: {}, valid_acc: {}, valid_fscore: {}, test_loss: {}, test_acc: {}, test_fscore: {}, time: {} sec'.\
-                format(e+1, train_loss, train_acc, train_fscore, valid_loss, valid_acc, valid_fscore, test_loss, test_acc, test_fscore, round(time.time()-start_time, 2)))
-        if (e+1)%10 == 0:
-            print(classification_report(best_label, best_pred, sample_weight=best_mask,digits=4))
-            print(confusion_matrix(best_label,best_pred,sample_weight=best_mask))
-
-
+            best_metrics = test_metrics
+            if args.save_model:
+                best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        if checkpointer:
+            if (e+1) % args.checkpoint_every == 0 or e+1 == n_epochs:
+                checkpointer.save('last.pt', training_state(e+1))
+            if improved:
+                checkpointer.save('best.pt', training_state(e+1))
+
+        if evaluated:
+            telemetry.scalar('test: accuracy', test_acc, e)
+            telemetry.scalar('test: fscore', test_fscore, e)
+        telemetry.scalar('train: accuracy', train_acc, e)
+        telemetry.scalar('train: fscore', train_fscore, e)
+
+        print('epoch: {}, train_loss: {}, train_acc: {}, train_fscore: {}, valid_loss: {}, valid_acc: {}, valid_fscore: {}, test_loss: {}, test_acc: {}, test_fscore: {}, time: {} sec, train throughput: {} utt/sec'.\
+                format(e+1, train_loss, train_acc, train_fscore, valid_loss, valid_acc, valid_fscore, test_loss, test_acc, test_fscore, round(time.time()-start_time, 2),
+                       round(train_metrics.total()/train_time, 1)))
+        if args.telemetry:
+            print('step time (ms): {}'.format(telemetry.epoch_summary(e)))
+        if bucket:
+            print('padding ratio: train {}, test {}'.format(round(train_loader.batch_sampler.padding_ratio, 4),
+                                                            round(test_loader.batch_sampler.padding_ratio, 4)))
+        if (e+1)%10 == 0 and best_metrics is not None:
+            print(best_metrics.report(digits=4))
+            print(best_metrics.matrix())
+        if evaluated and report is not None and report(e+1, valid_fscore):
+            print('stopped after epoch {}'.format(e+1))
+            break
+
+
+    telemetry.close()
     if args.tensorboard:
         writer.close()
+    if checkpointer:
+        checkpointer.close()
+
+    if args.precision != 'fp32':
+        # the final model evaluated on the test split in both precisions
+        for precision in ['fp32', args.precision]:
+            start_time = time.time()
+            _, test_metrics = evaluate_model(model, loss_function, kl_loss, test_loader, precision)
+            print('{} inference: test_fscore: {}, throughput: {} utt/sec'.format(precision, test_metrics.fscore(),
+                                                                             round(test_metrics.total()/(time.time()-start_time), 1)))
+
+    if teacher is not None:
+        # accuracy/latency trade-off of the distilled model (final weights) against its teacher
+        for name, candidate, candidate_config in [('teacher', teacher, teacher_config), ('student', model, config)]:
+            test_fscore, throughput = eval_inference(candidate, test_loader, args.precision)
+            print('{}: modality {}, hidden_dim {}, n_head {}, parameters {}, test_fscore: {}, throughput: {} utt/sec'.format(
+                name, candidate_config['modality'], candidate_config['hidden_dim'], candidate_config['n_head'],
+                sum(p.numel() for p in candidate.parameters()), test_fscore, throughput))
+
+    best_epoch = eval_epochs[all_fscore.index(max(all_fscore))]
+    if args.save_model:
+        torch.save({'config': config, 'state_dict': best_state}, args.save_model)
+        print('saved the epoch {} model to {}'.format(best_epoch, args.save_model))
 
     print('Test performance..')
     print('F-Score: {}'.format(max(all_fscore)))
-    print('F-Score-index: {}'.format(all_fscore.index(max(all_fscore)) + 1))
-    
+    print('F-Score-index: {}'.format(best_epoch))
+
+    result = {'args': vars(args), 'config': config, 'best_fscore': max(all_fscore), 'best_epoch': best_epoch, 'eval_epochs': eval_epochs,
+              'all_fscore': all_fscore, 'all_valid_fscore': all_valid_fscore, 'time': round(time.time() - start, 1), 'date': today.isoformat()}
+    def recorded(result):
+        # marks the run complete for --resume
+        if checkpointer:
+            with open(checkpointer.path('result.pk'), 'wb') as f:
+                pk.dump(result, f)
+        return result
+
+    if args.results:
+        # one locked append per run, safe for concurrent runs (record_*.pk is read-modify-write)
+        ResultsStore(args.results).append(result)
+        print(best_metrics.report(digits=4))
+        print(best_metrics.matrix())
+        return recorded(result)
+
     if not os.path.exists("record_{}_{}_{}.pk".format(today.year, today.month, today.day)):
         with open("record_{}_{}_{}.pk".format(today.year, today.month, today.day),'wb') as f:
             pk.dump({}, f)
@@ -337,13 +654,16 @@ if __name__ == '__main__':
     else:
         record[key_] = [max(all_fscore)]
     if record.get(key_+'record', False):
-        record[key_+'record'].append(classification_report(best_label, best_pred, sample_weight=best_mask,digits=4))
+        record[key_+'record'].append(best_metrics.report(digits=4))
     else:
-        record[key_+'record'] = [classification_report(best_label, best_pred, sample_weight=best_mask,digits=4)]
+        record[key_+'record'] = [best_metrics.report(digits=4)]
     with open("record_{}_{}_{}.pk".format(today.year, today.month, today.day),'wb') as f:
         pk.dump(record, f)
 
-    print(classification_report(best_label, best_pred, sample_weight=best_mask,digits=4))
-    print(confusion_matrix(best_label,best_pred,sample_weight=best_mask))
+    print(best_metrics.report(digits=4))
+    print(best_metrics.matrix())
+    return recorded(result)
 
 
+if __name__ == '__main__':
+    main(get_parser().parse_args())